@@ -0,0 +1,154 @@
+"""
+benchmarks of the bot's hot paths against the in-memory storage.
+
+usage: python src/benchmark.py [--sizes 1000 10000 100000] [--output bench.json]
+
+every case runs on a SyntheticGuild with `size` members and `size` threads (each
+member is tagged to one thread). sends are only recorded. the result is printed (or written to --output) as json:
+{'backend': 'memory', 'python': str, 'timestamp': str, 'results': [
+    {'case': str, 'size': int, 'ops': int, 'seconds': float, 'ops_per_sec': float}, ...]}
+"""
+
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+import platform
+
+from components.embeds import EmbedHandler
+from memory_handler import (
+    MemoryMemberTaggerDBHandler,
+    MemoryMemberTaggerNotifyDBHandler,
+)
+from notify_handler import NotifyHandler
+from scheduler import JST
+from synthetic_guild import SendRecorder, SyntheticGuild, SyntheticInteraction
+
+
+GUILD_ID = 1000
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+
+
+def _result(case: str, size: int, ops: int, seconds: float) -> dict:
+    return {
+        "case": case,
+        "size": size,
+        "ops": ops,
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(ops / seconds, 2) if seconds else None,
+    }
+
+
+async def run_size(size: int) -> list[dict]:
+    recorder = SendRecorder()
+    guild = SyntheticGuild.generate(
+        GUILD_ID, members=size, threads=size, recorder=recorder
+    )
+    tag_db = MemoryMemberTaggerDBHandler()
+    notify_db = MemoryMemberTaggerNotifyDBHandler()
+    handler = NotifyHandler(guild, db=notify_db, tag_db=tag_db)
+
+    # 期限は今日から15日後までに散らす
+    today = datetime.datetime.now(JST).date()
+    deadlines = [
+        (today + datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+        for days in range(16)
+    ]
+    tags = [
+        (str(member.id), str(thread.id), deadlines[i % len(deadlines)])
+        for i, (member, thread) in enumerate(zip(guild.members, guild.threads))
+    ]
+    results = []
+
+    start = time.perf_counter()
+    for member_id, thread_id, deadline in tags:
+        await tag_db.tag_member(GUILD_ID, member_id, thread_id, deadline)
+    results.append(_result("tag_member", size, size, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for _, thread_id, _ in tags:
+        await tag_db.get_tagged_members(GUILD_ID, thread_id)
+    results.append(
+        _result("get_tagged_members", size, size, time.perf_counter() - start)
+    )
+
+    start = time.perf_counter()
+    await tag_db.get_all_tagged_threads(GUILD_ID)
+    results.append(
+        _result("get_all_tagged_threads", size, 1, time.perf_counter() - start)
+    )
+
+    # 1回目は全員がaddedになるので、2回目(定常状態)を測る
+    await handler.notify_member_db_sync()
+    start = time.perf_counter()
+    await handler.notify_member_db_sync()
+    results.append(
+        _result("notify_member_db_sync", size, 1, time.perf_counter() - start)
+    )
+
+    start = time.perf_counter()
+    threads = await handler.fetch_tagged_threads()
+    converted = await handler.convert_tagged_threads(threads)
+    await handler.refine_threads(converted)
+    results.append(
+        _result("fetch_convert_refine_pipeline", size, 1, time.perf_counter() - start)
+    )
+
+    # 送信は記録するだけなので、embedの組み立てと送信処理のオーバーヘッドを測る
+    start = time.perf_counter()
+    await handler.notify_now(list(range(16)))
+    results.append(
+        _result("notify_now", size, len(recorder.sent), time.perf_counter() - start)
+    )
+
+    # 1ページ目の取得と描画(/all_tagged_members)
+    embed_handler = EmbedHandler(SyntheticInteraction(guild))
+    start = time.perf_counter()
+    page = await tag_db.get_tagged_threads_page(GUILD_ID, None, 10)
+    embed_handler.get_embed_all_tagged_members(1, page["items"], 1)
+    results.append(
+        _result("all_tagged_members_first_page", size, 1, time.perf_counter() - start)
+    )
+
+    start = time.perf_counter()
+    for member_id, thread_id, _ in tags:
+        await tag_db.untag_member(GUILD_ID, member_id, thread_id)
+    results.append(_result("untag_member", size, size, time.perf_counter() - start))
+
+    return results
+
+
+async def run(sizes: list[int]) -> dict:
+    results = []
+    for size in sizes:
+        results.extend(await run_size(size))
+    return {
+        "backend": "memory",
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the bot's hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--output", help="write the json here instead of stdout")
+    args = parser.parse_args()
+
+    # 計測中のinfoログは邪魔なので抑える
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args.sizes))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
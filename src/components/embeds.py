@@ -3,16 +3,39 @@ from typing import Any
 
 import discord
 
-from db_handler import MemberTaggerDBHandler
-from utils import SingletonMeta
+from db_handler import DBHandler, MemberTaggerDBHandler
+from storage import get_backend
 
 
-class EmbedHandler(metaclass=SingletonMeta):
+# embedのdescriptionの最大文字数
+DESCRIPTION_LIMIT = 4096
+
+
+class EmbedHandler:
     def __init__(self, interaction: discord.Interaction):
         self.interaction = interaction
-        self.db_handler = MemberTaggerDBHandler()
+
+    @staticmethod
+    def fit_description(
+        blocks: list[str], separator: str = "\n\n", limit: int = DESCRIPTION_LIMIT
+    ) -> tuple[str, int]:
+        """
+        join as many whole blocks as fit in `limit` characters.
+        a first block longer than the limit is clipped, so that something is shown.
+        return: (description, the number of blocks used)
+        """
+        length = 0
+        for count, block in enumerate(blocks):
+            length += len(block) + (len(separator) if count else 0)
+            if length > limit:
+                if not count:
+                    return block[: limit - 1] + "…", 1
+                return separator.join(blocks[:count]), count
+        return separator.join(blocks), len(blocks)
 
     def get_embed_ping(self):
+        pool = DBHandler.executor_stats()
+        cache = MemberTaggerDBHandler.cache_stats()
         data = {
             "Latency": f"`{round(self.interaction.client.latency * 1000)}ms`",
             "Now": f'{datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))).strftime("%Y/%m/%d %H:%M:%S  timezone: %Z")}',
@@ -23,7 +46,15 @@ class EmbedHandler(metaclass=SingletonMeta):
             "Channel": f"{self.interaction.channel.mention} (`{self.interaction.channel.id}`)"
             if self.interaction.guild
             else "DM",
+            "Storage": f"`{get_backend()}`",
         }
+        if get_backend() == "dynamodb":
+            data["DB Pool"] = (
+                f"`running {pool['running']}/{pool['max_workers']}, queued {pool['queued']}/{pool['max_queue']}`"
+            )
+            data["Tag Cache"] = (
+                f"`{cache['size']} members, hit rate {cache['hit_rate']:.0%}`"
+            )
         return discord.Embed(
             title="Pong!",
             description="\n".join(
@@ -249,7 +280,13 @@ class EmbedHandler(metaclass=SingletonMeta):
                 )
         return embed
 
-    def format_member_threads(self, refined_threads: dict[str, dict[str, str]]):
+    def format_member_threads(
+        self, refined_threads: dict[str, dict[str, str]]
+    ) -> dict[str, str]:
+        """
+        return: {member_id: block} in the order of refined_threads
+        (members who left and members without existing threads are skipped)
+        """
         def format_thread(thread_id, deadline):
             channel = self.interaction.guild.get_channel_or_thread(int(thread_id))
             if channel:
@@ -271,30 +308,45 @@ class EmbedHandler(metaclass=SingletonMeta):
                     return f"- **{member.mention} :** \n    - {threads_str}"
             return None
 
-        return "\n\n".join(
-            member
-            for member in (
-                format_member(member_id, threads)
-                for member_id, threads in refined_threads.items()
-            )
-            if member
-        )
+        blocks = {
+            member_id: format_member(member_id, threads)
+            for member_id, threads in refined_threads.items()
+        }
+        return {member_id: block for member_id, block in blocks.items() if block}
+
+    def fit_all_tagged_members(self, threads: dict[str, dict[str, str]]) -> int:
+        """how many members of `threads` (in order) fit in one page"""
+        blocks = self.format_member_threads(threads)
+        _, shown = self.fit_description(list(blocks.values()))
+        if shown == len(blocks):
+            return len(threads)
+        return list(threads).index(list(blocks)[shown - 1]) + 1
 
-    def get_embed_all_tagged_members(self, step: int | None = None):
+    def get_embed_all_tagged_members(
+        self,
+        step: int | None = None,
+        threads: dict[str, dict[str, str]] | None = None,
+        page: int | None = None,
+    ):
+        # threadsは1ページ分 (TagStorage.get_tagged_threads_pageのitems)
         if step == 1:
-            all_threads = self.db_handler.get_all_tagged_threads()
             refined_threads = {
-                member_id: threads
-                for member_id, threads in all_threads.items()
-                if threads
+                member_id: thread_dict
+                for member_id, thread_dict in (threads or {}).items()
+                if thread_dict
             }
-            description = self.format_member_threads(refined_threads)
+            # 入り切らないメンバーは呼び出す側が次のページに回す(fit_all_tagged_members)
+            description, _ = self.fit_description(
+                list(self.format_member_threads(refined_threads).values())
+            )
             if description:
                 embed = discord.Embed(
                     title="取得結果：",
                     description=description,
                     color=discord.Color.green(),
                 )
+                if page:
+                    embed.set_footer(text=f"{page}ページ目")
             elif not description:
                 embed = discord.Embed(
                     title="取得結果：",
@@ -320,6 +372,59 @@ class EmbedHandler(metaclass=SingletonMeta):
                 )
         return embed
 
+    def get_embed_due_soon(
+        self,
+        step: int,
+        threads: dict[str, dict[str, str]] | None = None,
+        days: int | None = None,
+    ):
+        if step == 1:
+            # {member_id: {thread_id: deadline}} -> {thread_id: (deadline, [member, ...])}
+            due = {}
+            for member_id, thread_dict in (threads or {}).items():
+                member = self.interaction.guild.get_member(int(member_id))
+                for thread_id, deadline in thread_dict.items():
+                    due.setdefault(thread_id, (deadline, []))[1].append(member)
+
+            lines = []
+            for thread_id, (deadline, members) in sorted(
+                due.items(), key=lambda item: item[1][0]
+            ):
+                channel = self.interaction.guild.get_channel_or_thread(int(thread_id))
+                if not channel:
+                    continue
+                mentions = ", ".join([member.mention for member in members if member])
+                lines.append(
+                    f"・{channel.mention}\n    提出期限 : {deadline}\n    提出者 : {mentions}"
+                )
+
+            description, shown = self.fit_description(lines)
+            embed = discord.Embed(
+                title=f"取得結果： ({days}日後まで)",
+                description=description
+                if lines
+                else "期限が近い投稿はありませんでした",
+                color=discord.Color.green(),
+            )
+            if shown < len(lines):
+                embed.set_footer(
+                    text=f"期限が近い順に{shown}件を表示しています (全{len(lines)}件)"
+                )
+        else:
+            if not step:
+                embed = self.get_embed_error(
+                    title="エラーが発生しました (step is None or invalid)"
+                )
+            elif not self.interaction:
+                embed = self.get_embed_error(
+                    title="エラーが発生しました (interaction is None or invalid)"
+                )
+            else:
+                embed = self.get_embed_error(
+                    title="エラーが発生しました (unknown error)"
+                )
+        return embed
+
     def get_embed_notify_toggle(self, step: int, current_state: bool | None = None):
         if step == 1:
             title = f'通知のON/OFFを切り替えますか？ (現在の設定: **{"ON" if current_state else "OFF"}**)'
@@ -1,14 +1,25 @@
+import os
+import asyncio
 import datetime
+import logging
+from typing import Any, Awaitable, Callable
 
 import discord
+from colorama import Fore, Style
 
 from components.embeds import EmbedHandler
-from db_handler import MemberTaggerDBHandler, MemberTaggerNotifyDBHandler
+from storage import get_notify_db, get_tag_db
+from tracing import trace_callback
 
 # ? クラス側で__new__でシングルトンにしたほうがいい？
 # TODO: インスタンスの管理、リソース管理をもっと考える
-db_handler = MemberTaggerDBHandler()
-notify_handler = MemberTaggerNotifyDBHandler()
+db_handler = get_tag_db()
+notify_handler = get_notify_db()
+
+# 遅延応答でDBの処理を待つ最大秒数
+DEFERRED_TIMEOUT = float(os.getenv("DEFERRED_RESPONSE_TIMEOUT", "30"))
+# /all_tagged_membersの1ページあたりのメンバー数
+ALL_TAGGED_PAGE_SIZE = int(os.getenv("ALL_TAGGED_PAGE_SIZE", "10"))
 
 # FIXME: もっといい変数名と仕組み
 select_types = [
@@ -33,6 +44,7 @@ class ChannelSelect(discord.ui.ChannelSelect):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         channels = interaction.data["values"]
         if self.current_mode == "tag":
@@ -41,10 +53,15 @@ class ChannelSelect(discord.ui.ChannelSelect):
                 embed=EmbedHandler(interaction).get_embed_tag(2),
             )
         elif self.current_mode == "untag":
-            members = db_handler.get_tagged_members(str(channels[0]))
-            await interaction.response.edit_message(
-                view=UntagMemberView2(channels=channels),
-                embed=EmbedHandler(interaction).get_embed_untag(2, members),
+            await respond_deferred(
+                interaction,
+                lambda: db_handler.get_tagged_members(
+                    interaction.guild.id, str(channels[0])
+                ),
+                lambda members: {
+                    "view": UntagMemberView2(channels=channels),
+                    "embed": EmbedHandler(interaction).get_embed_untag(2, members),
+                },
             )
         else:
             raise ValueError('current_mode must be either "tag" or "untag"')
@@ -62,6 +79,7 @@ class MemberSelect(discord.ui.UserSelect):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         members = interaction.data["values"]
         if self.current_mode == "tag":
@@ -70,17 +88,18 @@ class MemberSelect(discord.ui.UserSelect):
                 embed=EmbedHandler(interaction).get_embed_tag(3),
             )
         elif self.current_mode == "untag":
+            # batch_writeの失敗は例外ではなくFalseで返ってくる
             try:
-                for member in members:
-                    for channel in self.channels:
-                        db_handler.untag_member(member, channel)
-                await interaction.response.edit_message(
-                    view=None, embed=EmbedHandler(interaction).get_embed_untag(3)
+                untagged = await db_handler.untag_members(
+                    interaction.guild.id, members, self.channels
                 )
             except Exception as e:
-                await interaction.response.edit_message(
-                    view=None, embed=EmbedHandler(interaction).get_embed_untag(0)
-                )
+                logging.error(f"Error untagging members: {e}")
+                untagged = False
+            await interaction.response.edit_message(
+                view=None,
+                embed=EmbedHandler(interaction).get_embed_untag(3 if untagged else 0),
+            )
         else:
             raise ValueError('current_mode must be either "tag" or "untag"')
 
@@ -100,22 +119,23 @@ class DeadlineInputModal(discord.ui.Modal):
         self.channels = channels
         self.members = members
 
+    @trace_callback
     async def on_submit(self, interaction: discord.Interaction):
         deadline = (
             datetime.datetime.now()
             + datetime.timedelta(days=float(self.children[0].value))
         ).strftime("%Y-%m-%d")
+        # batch_writeの失敗は例外ではなくFalseで返ってくる
         try:
-            for member in self.members:
-                for channel in self.channels:
-                    db_handler.tag_member(member, channel, deadline)
-            await interaction.response.edit_message(
-                view=None, embed=EmbedHandler(interaction).get_embed_tag(4)
+            tagged = await db_handler.tag_members(
+                interaction.guild.id, self.members, self.channels, deadline
             )
         except Exception as e:
-            await interaction.response.edit_message(
-                view=None, embed=EmbedHandler(interaction).get_embed_tag(0)
-            )
+            logging.error(f"Error tagging members: {e}")
+            tagged = False
+        await interaction.response.edit_message(
+            view=None, embed=EmbedHandler(interaction).get_embed_tag(4 if tagged else 0)
+        )
 
 
 # TODO: 任意の日数を選択出来るようにする(selectで任意の日数みたいなのを選ばせて、modalで入力させる?)
@@ -136,6 +156,7 @@ class DeadlineSelect(discord.ui.Select):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         if interaction.data["values"][0] == "0":
             await interaction.response.send_modal(
@@ -148,17 +169,18 @@ class DeadlineSelect(discord.ui.Select):
                 + datetime.timedelta(days=float(interaction.data["values"][0]))
             ).strftime("%Y-%m-%d")
 
+            # batch_writeの失敗は例外ではなくFalseで返ってくる
             try:
-                for member in self.members:
-                    for channel in self.channels:
-                        db_handler.tag_member(member, channel, deadline)
-                await interaction.response.edit_message(
-                    view=None, embed=EmbedHandler(interaction).get_embed_tag(4)
+                tagged = await db_handler.tag_members(
+                    interaction.guild.id, self.members, self.channels, deadline
                 )
             except Exception as e:
-                await interaction.response.edit_message(
-                    view=None, embed=EmbedHandler(interaction).get_embed_tag(0)
-                )
+                logging.error(f"Error tagging members: {e}")
+                tagged = False
+            await interaction.response.edit_message(
+                view=None,
+                embed=EmbedHandler(interaction).get_embed_tag(4 if tagged else 0),
+            )
 
 
 # TODO: 複数のメンバーを選択出来るようにする
@@ -172,12 +194,20 @@ class GetTaggedthreadsSelect(discord.ui.UserSelect):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         selected_member = str(interaction.data["values"][0])
-        threads = db_handler.get_tagged_threads(selected_member)
-        await interaction.response.edit_message(
-            view=None,
-            embed=EmbedHandler(interaction).get_embed_get_tagged_threads(2, threads),
+        await respond_deferred(
+            interaction,
+            lambda: db_handler.get_tagged_threads(
+                interaction.guild.id, selected_member
+            ),
+            lambda threads: {
+                "view": None,
+                "embed": EmbedHandler(interaction).get_embed_get_tagged_threads(
+                    2, threads
+                ),
+            },
         )
 
 
@@ -192,14 +222,20 @@ class GetTaggedMembersSelect(discord.ui.ChannelSelect):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         target_channels = str(interaction.data["values"][0])
-        tagged_members = db_handler.get_tagged_members(target_channels)
-        await interaction.response.edit_message(
-            view=None,
-            embed=EmbedHandler(interaction).get_embed_get_tagged_members(
-                2, tagged_members
+        await respond_deferred(
+            interaction,
+            lambda: db_handler.get_tagged_members(
+                interaction.guild.id, target_channels
             ),
+            lambda tagged_members: {
+                "view": None,
+                "embed": EmbedHandler(interaction).get_embed_get_tagged_members(
+                    2, tagged_members
+                ),
+            },
         )
 
 
@@ -209,6 +245,7 @@ class CancelButton(discord.ui.Button):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.edit_message(
             view=None, embed=EmbedHandler(interaction).get_embed_cancel()
@@ -222,10 +259,11 @@ class ConfirmButton(discord.ui.Button):
         self.on_error = on_error
         self.current_mode = str(current_mode)
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         # TODO: 処理系は別の関数に移す
         if self.current_mode == "notify_toggle":
-            modified_state = notify_handler.toggle_notify_state(
+            modified_state = await notify_handler.toggle_notify_state(
                 interaction.guild.id, interaction.user.id
             )
             await interaction.response.edit_message(
@@ -240,6 +278,27 @@ class ConfirmButton(discord.ui.Button):
             )
 
 
+class PageButton(discord.ui.Button):
+    def __init__(self, step: int):
+        super().__init__(
+            label="前へ" if step < 0 else "次へ",
+            style=discord.ButtonStyle.secondary,
+            row=0,
+        )
+        self.step = step
+        self.interaction_check = interaction_check
+        self.on_error = on_error
+
+    @trace_callback
+    async def callback(self, interaction: discord.Interaction):
+        view: AllTaggedMembersView = self.view
+        await respond_deferred(
+            interaction,
+            lambda: view.show(interaction, view.index + self.step),
+            lambda embed: {"embed": embed, "view": view},
+        )
+
+
 class UrlButton(discord.ui.Button):
     def __init__(
         self,
@@ -250,12 +309,50 @@ class UrlButton(discord.ui.Button):
         self.interaction_check = interaction_check
         self.on_error = on_error
 
+    @trace_callback
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.edit_message(
             view=None, embed=EmbedHandler(interaction).get_embed_invite(2)
         )
 
 
+async def respond_deferred(
+    interaction: discord.Interaction,
+    fetch: Callable[[], Awaitable[Any]],
+    render: Callable[[Any], dict[str, Any]],
+    ephemeral: bool = False,
+    timeout: float | None = None,
+):
+    """
+    acknowledge the interaction right away, then run fetch (the DB work) with a
+    timeout and edit the original response with render(result), e.g.
+    {'embed': embed, 'view': view}. on a timeout or an error, the original response
+    shows get_embed_error instead.
+
+    for a component the deferred response edits its message. for a slash command
+    it is a "thinking..." message (ephemeral if ephemeral is True).
+    """
+    is_component = interaction.type == discord.InteractionType.component
+    await interaction.response.defer(ephemeral=ephemeral, thinking=not is_component)
+    try:
+        result = await asyncio.wait_for(
+            fetch(), timeout if timeout else DEFERRED_TIMEOUT
+        )
+        content = render(result)
+    except Exception as e:
+        logging.error(
+            Fore.RED
+            + f"Deferred response failed: {e.__class__.__name__} {e}"
+            + Style.RESET_ALL
+        )
+        title = "エラーが発生しました (timeout)" if isinstance(e, asyncio.TimeoutError) else None
+        content = {
+            "view": None,
+            "embed": EmbedHandler(interaction).get_embed_error(title=title),
+        }
+    await interaction.edit_original_response(**content)
+
+
 async def interaction_check(self, interaction: discord.Interaction):
     if interaction.user == interaction.message.author:
         return True
@@ -336,3 +433,61 @@ class InviteView(discord.ui.View):
         super().__init__(timeout=60)
         self.add_item(UrlButton(url=url, label=label))
         self.add_item(ConfirmButton(label="完了"))
+
+
+class AllTaggedMembersView(discord.ui.View):
+    """
+    /all_tagged_members (the members of the guild), page_size members per page.
+    a page is read from the storage cursor only when it is first shown, and the
+    rendered pages are cached in the view, so going back never reads the DB again.
+    a page that does not fit in one embed ends early, and the next page starts
+    after its last shown member.
+    """
+
+    def __init__(self, page_size: int | None = None):
+        super().__init__(timeout=300)
+        self.page_size = page_size if page_size else ALL_TAGGED_PAGE_SIZE
+        self.pages: list[discord.Embed] = []
+        # cursors[i]はページiを読むためのcursor (Noneならページiは存在しない)
+        self.cursors: list[str | None] = [None]
+        self.index = 0
+        # ボタンが続けて押されても、ページの追加を1つずつ行う
+        self._lock = asyncio.Lock()
+        self.prev_button = PageButton(-1)
+        self.next_button = PageButton(1)
+        self.add_item(self.prev_button)
+        self.add_item(self.next_button)
+
+    async def show(self, interaction: discord.Interaction, index: int) -> discord.Embed:
+        """move to page `index` (fetching it if needed) and return its embed"""
+        async with self._lock:
+            index = min(max(index, 0), len(self.pages))
+            if index == len(self.pages) and (index == 0 or self.cursors[index]):
+                await self._fetch_page(interaction, index)
+            self.index = min(index, len(self.pages) - 1)
+            self.prev_button.disabled = self.index == 0
+            self.next_button.disabled = (
+                self.index + 1 >= len(self.pages) and not self.cursors[self.index + 1]
+            )
+            return self.pages[self.index]
+
+    async def _fetch_page(self, interaction: discord.Interaction, index: int):
+        page = await db_handler.get_tagged_threads_page(
+            interaction.guild.id, self.cursors[index], self.page_size
+        )
+        if not page["items"] and index:
+            # cursorはあったが次のページは空だった
+            self.cursors[index] = None
+            return
+        embed_handler = EmbedHandler(interaction)
+        items = page["items"]
+        cursor = page["cursor"]
+        shown = embed_handler.fit_all_tagged_members(items)
+        if shown < len(items):
+            # 入り切らなかったメンバーから次のページを始める
+            cursor = list(items)[shown - 1]
+            items = dict(list(items.items())[:shown])
+        self.pages.append(
+            embed_handler.get_embed_all_tagged_members(1, items, index + 1)
+        )
+        self.cursors.append(cursor)
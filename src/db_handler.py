@@ -1,7 +1,21 @@
 import os
+import time
+import uuid
+import asyncio
 import logging
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable
 
-import boto3
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from cachetools import TTLCache
+
+import metrics
+from storage import NotifyStorage, TagStorage
+from utils import chunked
 
 
 logging.basicConfig(
@@ -10,19 +24,155 @@ logging.basicConfig(
 
 
 class DBHandler:
+    # aiobotocoreのclientはプロセス全体で1つを共有する(コネクションプールも共有される)
+    _client = None
+    _exit_stack: contextlib.AsyncExitStack | None = None
+    _client_lock = asyncio.Lock()
+
+    # ブロッキングな処理(大きなページのデシリアライズなど)を流すスレッドプール
+    # max_workersはbotocoreのmax_pool_connectionsと揃える
+    max_workers = int(os.getenv("DB_MAX_WORKERS", "10"))
+    max_queue = int(os.getenv("DB_MAX_QUEUE", "100"))
+    # parallel_scan_pagesでテーブルを何分割して読むか
+    scan_segments = int(os.getenv("DB_SCAN_SEGMENTS", "4"))
+    _executor: ThreadPoolExecutor | None = None
+    _executor_slots: asyncio.Semaphore | None = None
+    _in_flight = 0
+    _waiting = 0
+
     def __init__(
         self, table_name: str | None = None, region_name: str = "ap-northeast-1"
     ):
-        region_name = os.getenv("AWS_DEFAULT_REGION", region_name)
-        self.dynamodb = boto3.resource(
-            "dynamodb",
-            region_name=region_name,
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        self.region_name = os.getenv("AWS_DEFAULT_REGION", region_name)
+        self.table_name = table_name
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    async def get_client(self):
+        if DBHandler._client is None:
+            async with DBHandler._client_lock:
+                if DBHandler._client is None:
+                    exit_stack = contextlib.AsyncExitStack()
+                    DBHandler._client = await exit_stack.enter_async_context(
+                        get_session().create_client(
+                            "dynamodb",
+                            region_name=self.region_name,
+                            endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL"),
+                            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                            config=AioConfig(
+                                max_pool_connections=DBHandler.max_workers
+                            ),
+                        )
+                    )
+                    DBHandler._exit_stack = exit_stack
+        return DBHandler._client
+
+    @staticmethod
+    async def close():
+        """close the shared client and executor. call this once on shutdown."""
+        async with DBHandler._client_lock:
+            if DBHandler._exit_stack:
+                await DBHandler._exit_stack.aclose()
+            DBHandler._client = None
+            DBHandler._exit_stack = None
+        if DBHandler._executor:
+            DBHandler._executor.shutdown(wait=False, cancel_futures=True)
+            DBHandler._executor = None
+            DBHandler._executor_slots = None
+
+    async def run_in_executor(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        run a blocking function on the shared, size-limited thread pool.
+        when more than max_workers + max_queue calls are pending, callers wait here.
+        """
+        if DBHandler._executor is None:
+            DBHandler._executor = ThreadPoolExecutor(
+                max_workers=DBHandler.max_workers, thread_name_prefix="db_handler"
+            )
+            DBHandler._executor_slots = asyncio.Semaphore(
+                DBHandler.max_workers + DBHandler.max_queue
+            )
+        slots = DBHandler._executor_slots
+
+        DBHandler._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            DBHandler._waiting -= 1
+
+        DBHandler._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                DBHandler._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            DBHandler._in_flight -= 1
+            slots.release()
+
+    @staticmethod
+    def executor_stats() -> dict[str, int]:
+        """e.g. {'max_workers': 10, 'max_queue': 100, 'running': 3, 'queued': 0, 'waiting': 0}"""
+        return {
+            "max_workers": DBHandler.max_workers,
+            "max_queue": DBHandler.max_queue,
+            "running": min(DBHandler._in_flight, DBHandler.max_workers),
+            "queued": max(DBHandler._in_flight - DBHandler.max_workers, 0),
+            "waiting": DBHandler._waiting,
+        }
+
+    async def _call(self, operation: str, **params) -> dict[str]:
+        """
+        call a client operation, recording its latency, errors and item count
+        (per table and operation) in metrics.
+        """
+        client = await self.get_client()
+        table = params.get("TableName", self.table_name) or ""
+        started = time.perf_counter()
+        try:
+            response = await getattr(client, operation)(**params)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            metrics.db_errors_total.inc(
+                table, operation, code if code else type(e).__name__
+            )
+            raise
+        finally:
+            metrics.db_operation_seconds.observe(
+                time.perf_counter() - started, table, operation
+            )
+            metrics.db_operations_total.inc(table, operation)
+        metrics.db_items_total.inc(
+            table, operation, amount=self._count_items(operation, params, response)
         )
-        self.table = self.dynamodb.Table(table_name) if table_name else None
+        return response
+
+    @staticmethod
+    def _count_items(operation: str, params: dict[str], response: dict[str]) -> int:
+        if "Items" in response:  # query, scan
+            return len(response["Items"])
+        if "Responses" in response:  # batch_get_item
+            return sum(len(items) for items in response["Responses"].values())
+        if operation == "batch_write_item":
+            sent = sum(len(requests) for requests in params["RequestItems"].values())
+            unprocessed = response.get("UnprocessedItems", {})
+            return sent - sum(len(requests) for requests in unprocessed.values())
+        if operation == "get_item":
+            return 1 if "Item" in response else 0
+        if operation in ("put_item", "update_item", "delete_item"):
+            return 1
+        return 0
+
+    def _serialize(self, item: dict[str]) -> dict[str, dict]:
+        return {k: self._serializer.serialize(v) for k, v in item.items()}
+
+    def _deserialize(self, item: dict[str, dict]) -> dict[str]:
+        return {k: self._deserializer.deserialize(v) for k, v in item.items()}
 
-    def create_table(
+    def _deserialize_items(self, items: list[dict[str, dict]]) -> list[dict[str]]:
+        return [self._deserialize(item) for item in items]
+
+    async def create_table(
         self,
         table_name: str,
         key_schema: list[dict[str, str]],
@@ -30,7 +180,8 @@ class DBHandler:
         provisioned_throughput: dict[str, int],
     ):
         try:
-            self.dynamodb.create_table(
+            await self._call(
+                "create_table",
                 TableName=table_name,
                 KeySchema=key_schema,
                 AttributeDefinitions=attribute_definitions,
@@ -39,189 +190,1108 @@ class DBHandler:
         except Exception as e:
             logging.error(f"Error creating table: {e}")
 
-    def put(self, item: dict[str]):
+    async def _create_table_if_missing(self, **params) -> bool:
+        """
+        create self.table_name (on-demand capacity) with create_table params.
+        return: False if it already exists. other errors are raised
+        """
         try:
-            self.table.put_item(Item=item)
+            await self._call(
+                "create_table",
+                TableName=self.table_name,
+                BillingMode="PAY_PER_REQUEST",
+                **params,
+            )
+            return True
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == (
+                "ResourceInUseException"
+            ):
+                return False
+            logging.error(f"Error creating table: {e}")
+            raise
+
+    async def table_exists(self, table_name: str | None = None) -> bool:
+        """whether the table (default: self.table_name) exists. other errors are raised"""
+        try:
+            await self._call(
+                "describe_table",
+                TableName=table_name if table_name else self.table_name,
+            )
+            return True
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == (
+                "ResourceNotFoundException"
+            ):
+                return False
+            raise
+
+    async def put(self, item: dict[str]):
+        try:
+            await self._call(
+                "put_item", TableName=self.table_name, Item=self._serialize(item)
+            )
             return True
         except Exception as e:
             logging.error(f"Error putting item: {e}")
 
-    def get(
-        self, key: dict[str, str]
+    async def get(
+        self, key: dict[str, str], raise_errors: bool = False
     ) -> dict[str, str | int | float | list[str] | list[int] | list[float]] | None:
+        """
+        None if the item does not exist. errors are logged and also return None,
+        unless raise_errors is True (for results that are cached).
+        """
         try:
-            response = self.table.get_item(Key=key)
-            return response.get("Item", None)
+            response = await self._call(
+                "get_item", TableName=self.table_name, Key=self._serialize(key)
+            )
+            item = response.get("Item", None)
+            return self._deserialize(item) if item else None
         except Exception as e:
             logging.error(f"Error getting item: {e}")
+            if raise_errors:
+                raise
             return None
 
-    def delete(self, key: dict[str, str]):
+    async def delete(self, key: dict[str, str]):
         try:
-            self.table.delete_item(Key=key)
+            await self._call(
+                "delete_item", TableName=self.table_name, Key=self._serialize(key)
+            )
             return True
         except Exception as e:
             logging.error(f"Error deleting item: {e}")
 
-    def update(
+    async def update(
         self,
         key: dict[str, str],
         update_expression: str,
-        expression_attribute_values: dict[
-            str, str | int | float | list[str] | list[int] | list[float]
-        ],
-    ):
+        expression_attribute_values: (
+            dict[str, str | int | float | list[str] | list[int] | list[float]] | None
+        ) = None,
+        expression_attribute_names: dict[str, str] | None = None,
+        condition_expression: str | None = None,
+        raise_errors: bool = False,
+    ) -> bool:
+        """
+        returns False if condition_expression was not met. other errors are logged
+        and also return False, unless raise_errors is True (so that a caller retrying
+        on a failed condition can tell the two apart).
+        """
+        kwargs = {}
+        if expression_attribute_values:
+            kwargs["ExpressionAttributeValues"] = self._serialize(
+                expression_attribute_values
+            )
+        if expression_attribute_names:
+            kwargs["ExpressionAttributeNames"] = expression_attribute_names
+        if condition_expression:
+            kwargs["ConditionExpression"] = condition_expression
         try:
-            self.table.update_item(
-                Key=key,
+            await self._call(
+                "update_item",
+                TableName=self.table_name,
+                Key=self._serialize(key),
                 UpdateExpression=update_expression,
-                ExpressionAttributeValues=expression_attribute_values,
+                **kwargs,
             )
             return True
         except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == (
+                "ConditionalCheckFailedException"
+            ):
+                return False
             logging.error(f"Error updating item: {e}")
+            if raise_errors:
+                raise
+            return False
+
+    async def _pages(
+        self, operation: str, params: dict[str]
+    ) -> AsyncIterator[list[dict[str]]]:
+        """call scan/query repeatedly, following LastEvaluatedKey"""
+        while True:
+            response = await self._call(operation, TableName=self.table_name, **params)
+            yield await self.run_in_executor(
+                self._deserialize_items, response.get("Items", [])
+            )
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                return
+            params = {**params, "ExclusiveStartKey": last_key}
 
-    def query(
+    def _read_params(
+        self,
+        page_size: int | None,
+        projection_expression: str | None,
+        expression_attribute_names: dict[str, str] | None,
+    ) -> dict[str]:
+        params = {}
+        if page_size:
+            params["Limit"] = page_size
+        if projection_expression:
+            params["ProjectionExpression"] = projection_expression
+        if expression_attribute_names:
+            params["ExpressionAttributeNames"] = expression_attribute_names
+        return params
+
+    async def query_pages(
         self,
         key_condition_expression: str,
         expression_attribute_values: dict[
             str, str | int | float | list[str] | list[int] | list[float]
         ],
-    ) -> list[dict[str, str | int | float | list[str] | list[int] | list[float]]]:
+        page_size: int | None = None,
+        projection_expression: str | None = None,
+        expression_attribute_names: dict[str, str] | None = None,
+        index_name: str | None = None,
+        raise_errors: bool = False,
+    ) -> AsyncIterator[
+        list[dict[str, str | int | float | list[str] | list[int] | list[float]]]
+    ]:
+        """
+        errors are logged and end the pages early,
+        unless raise_errors is True (for results that are cached).
+        """
+        params = self._read_params(
+            page_size, projection_expression, expression_attribute_names
+        )
+        if index_name:
+            params["IndexName"] = index_name
+        params["KeyConditionExpression"] = key_condition_expression
+        params["ExpressionAttributeValues"] = self._serialize(
+            expression_attribute_values
+        )
         try:
-            response = self.table.query(
-                KeyConditionExpression=key_condition_expression,
-                ExpressionAttributeValues=expression_attribute_values,
-            )
-            return response.get("Items", [])
+            async for page in self._pages("query", params):
+                yield page
         except Exception as e:
             logging.error(f"Error querying items: {e}")
+            if raise_errors:
+                raise
+
+    async def query(
+        self,
+        key_condition_expression: str,
+        expression_attribute_values: dict[
+            str, str | int | float | list[str] | list[int] | list[float]
+        ],
+        **kwargs,
+    ) -> list[dict[str, str | int | float | list[str] | list[int] | list[float]]]:
+        """collects every page of query_pages. kwargs are passed to query_pages"""
+        return [
+            item
+            async for page in self.query_pages(
+                key_condition_expression, expression_attribute_values, **kwargs
+            )
+            for item in page
+        ]
+
+    async def scan_pages(
+        self,
+        page_size: int | None = None,
+        projection_expression: str | None = None,
+        expression_attribute_names: dict[str, str] | None = None,
+        segment: int | None = None,
+        total_segments: int | None = None,
+    ) -> AsyncIterator[
+        list[dict[str, str | int | float | list[str] | list[int] | list[float]]]
+    ]:
+        """
+        yield the table page by page (at most page_size items or 1MB per page).
+        the table is never held in memory at once.
+        """
+        params = self._read_params(
+            page_size, projection_expression, expression_attribute_names
+        )
+        if total_segments:
+            params["Segment"] = segment
+            params["TotalSegments"] = total_segments
+        try:
+            async for page in self._pages("scan", params):
+                yield page
+        except Exception as e:
+            logging.error(f"Error scanning items: {e}")
+
+    async def scan_page(
+        self,
+        page_size: int | None = None,
+        exclusive_start_key: dict[str, str] | None = None,
+        projection_expression: str | None = None,
+        expression_attribute_names: dict[str, str] | None = None,
+        segment: int | None = None,
+        total_segments: int | None = None,
+    ) -> tuple[
+        list[dict[str, str | int | float | list[str] | list[int] | list[float]]],
+        dict[str, str] | None,
+    ]:
+        """
+        read a single page of the table (or of one segment of a parallel scan).
+        return: (items, last_key). pass last_key as exclusive_start_key to read the
+        next page. last_key is None at the end of the table.
+        errors are raised (not logged), so that the caller can retry from the same key.
+        """
+        params = self._read_params(
+            page_size, projection_expression, expression_attribute_names
+        )
+        if exclusive_start_key:
+            params["ExclusiveStartKey"] = self._serialize(exclusive_start_key)
+        if total_segments:
+            params["Segment"] = segment
+            params["TotalSegments"] = total_segments
+        response = await self._call("scan", TableName=self.table_name, **params)
+        items = await self.run_in_executor(
+            self._deserialize_items, response.get("Items", [])
+        )
+        last_key = response.get("LastEvaluatedKey")
+        return items, self._deserialize(last_key) if last_key else None
+
+    async def parallel_scan_pages(
+        self,
+        total_segments: int | None = None,
+        start_keys: dict[int, dict[str, str] | None] | None = None,
+        page_size: int | None = None,
+        projection_expression: str | None = None,
+        expression_attribute_names: dict[str, str] | None = None,
+    ) -> AsyncIterator[
+        tuple[
+            int,
+            list[dict[str, str | int | float | list[str] | list[int] | list[float]]],
+            dict[str, str] | None,
+        ]
+    ]:
+        """
+        scan total_segments (default: scan_segments) segments of the table concurrently
+        and yield (segment, items, last_key) in the order the pages arrive.
+        the pages of one segment arrive in order, and last_key is None on its last page.
+        start_keys: {segment: exclusive_start_key} to scan only these segments
+        (None as the key starts the segment from the beginning), e.g. to resume.
+        the read ahead is bounded: at most two pages per segment wait for the caller.
+        errors are raised (like scan_page) and cancel the other segments.
+        """
+        total_segments = total_segments or self.scan_segments
+        if start_keys is None:
+            start_keys = {segment: None for segment in range(total_segments)}
+        if not start_keys:
+            return
+        pages = asyncio.Queue(maxsize=len(start_keys))
+
+        async def scan_segment(segment: int, last_key: dict[str, str] | None):
+            try:
+                while True:
+                    items, last_key = await self.scan_page(
+                        page_size,
+                        last_key,
+                        projection_expression,
+                        expression_attribute_names,
+                        segment,
+                        total_segments,
+                    )
+                    await pages.put((segment, items, last_key))
+                    if last_key is None:
+                        return
+            except Exception as e:
+                await pages.put((segment, e, None))
+
+        tasks = [
+            asyncio.create_task(scan_segment(segment, last_key))
+            for segment, last_key in start_keys.items()
+        ]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                segment, items, last_key = await pages.get()
+                if isinstance(items, Exception):
+                    raise items
+                if last_key is None:
+                    remaining -= 1
+                yield segment, items, last_key
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def scan_iter(
+        self, **kwargs
+    ) -> AsyncIterator[
+        dict[str, str | int | float | list[str] | list[int] | list[float]]
+    ]:
+        """yield items one by one. kwargs are passed to scan_pages"""
+        async for page in self.scan_pages(**kwargs):
+            for item in page:
+                yield item
+
+    async def batch_write(
+        self,
+        put_items: list[dict[str]] | None = None,
+        delete_keys: list[dict[str, str]] | None = None,
+        max_retries: int = 5,
+    ) -> bool:
+        """
+        put/delete many items with BatchWriteItem (25 requests per call).
+        unprocessed items are retried with exponential backoff.
+        the same key must not appear twice in one call.
+        """
+        requests = [
+            {"PutRequest": {"Item": self._serialize(item)}} for item in put_items or []
+        ] + [
+            {"DeleteRequest": {"Key": self._serialize(key)}}
+            for key in delete_keys or []
+        ]
+        try:
+            for chunk in chunked(requests, 25):
+                pending = {self.table_name: chunk}
+                for attempt in range(max_retries + 1):
+                    response = await self._call(
+                        "batch_write_item", RequestItems=pending
+                    )
+                    pending = response.get("UnprocessedItems", {})
+                    if not pending:
+                        break
+                    await asyncio.sleep(min(0.05 * 2**attempt, 2.0))
+                else:
+                    logging.error(
+                        f"Error batch writing items: {len(pending[self.table_name])} items left unprocessed"
+                    )
+                    return False
+            return True
+        except Exception as e:
+            logging.error(f"Error batch writing items: {e}")
+            return False
+
+    async def batch_get(
+        self, keys: list[dict[str, str]], max_retries: int = 5
+    ) -> list[dict[str, str | int | float | list[str] | list[int] | list[float]]]:
+        """
+        get many items with BatchGetItem (100 keys per call).
+        unprocessed keys are retried with exponential backoff. missing items are skipped.
+        """
+        items = []
+        try:
+            for chunk in chunked([self._serialize(key) for key in keys], 100):
+                pending = {self.table_name: {"Keys": chunk}}
+                for attempt in range(max_retries + 1):
+                    response = await self._call("batch_get_item", RequestItems=pending)
+                    items.extend(response["Responses"].get(self.table_name, []))
+                    pending = response.get("UnprocessedKeys", {})
+                    if not pending:
+                        break
+                    await asyncio.sleep(min(0.05 * 2**attempt, 2.0))
+                else:
+                    logging.error(
+                        f"Error batch getting items: {len(pending[self.table_name]['Keys'])} keys left unprocessed"
+                    )
+            return await self.run_in_executor(self._deserialize_items, items)
+        except Exception as e:
+            logging.error(f"Error batch getting items: {e}")
             return []
 
-    def scan_tables(self) -> list[str]:
+    async def scan_tables(self) -> list[str]:
         try:
-            response = self.dynamodb.list_tables()
+            response = await self._call("list_tables")
             return response.get("TableNames", [])
         except Exception as e:
             logging.error(f"Error scanning tables: {e}")
             return []
 
 
-class MemberTaggerDBHandler(DBHandler):
+class MemberTaggerChangeLogDBHandler(DBHandler):
     """
+    a short-lived log of which tags / notify states changed, so that the local
+    snapshot (see snapshot.py) can catch up a guild without reading all of it.
+    written only while the snapshot is enabled (Snapshot.enable).
+
     db architecture:
     {
-        'member_id': {
-            'thread_id': 'deadline'
+        'guild_id': guild_id(int, partition key),
+        'change_id': 'changed_at(epoch seconds)#random'(str, sort key),
+        'members': [member_id(str), ...] (members whose tags changed),
+        'notify': bool (the notify states of the guild changed),
+        'expires_at': epoch seconds(int, DynamoDB TTL)
+    }
+    """
+
+    # CHANGE_LOG_TTLより古いスナップショットは追いつけないので読み直す
+    ttl = int(os.getenv("CHANGE_LOG_TTL", str(7 * 24 * 3600)))
+
+    def __init__(self):
+        super().__init__("member_tagger_changes")
+
+    @staticmethod
+    def _change_id(changed_at: float) -> str:
+        # 固定長にして文字列の順序と時刻の順序を揃える
+        return f"{changed_at:017.6f}"
+
+    async def create_table_if_missing(self) -> bool:
+        """create member_tagger_changes with TTL on expires_at"""
+        created = await self._create_table_if_missing(
+            KeySchema=[
+                {"AttributeName": "guild_id", "KeyType": "HASH"},
+                {"AttributeName": "change_id", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "guild_id", "AttributeType": "N"},
+                {"AttributeName": "change_id", "AttributeType": "S"},
+            ],
+        )
+        if created:
+            await self._call(
+                "update_time_to_live",
+                TableName=self.table_name,
+                TimeToLiveSpecification={
+                    "Enabled": True,
+                    "AttributeName": "expires_at",
+                },
+            )
+        return created
+
+    async def record(
+        self, guild_id: int, member_ids: list[str] | None = None, notify: bool = False
+    ) -> bool:
+        """
+        errors are only logged: a lost change is corrected when the snapshot
+        rebuilds the guild (SNAPSHOT_REBUILD_INTERVAL).
+        """
+        now = time.time()
+        members = [str(member_id) for member_id in dict.fromkeys(member_ids or [])]
+        return await self.batch_write(
+            put_items=[
+                {
+                    "guild_id": int(guild_id),
+                    "change_id": f"{self._change_id(now)}#{uuid.uuid4().hex[:8]}",
+                    "members": chunk,
+                    "notify": notify,
+                    "expires_at": int(now) + self.ttl,
+                }
+                # 1アイテム400KBの上限に収まるように分ける
+                for chunk in chunked(members, 1000) or [[]]
+            ]
+        )
+
+    async def get_changes(
+        self, guild_id: int, since: float
+    ) -> dict[str, set[str] | bool] | None:
+        """
+        changes of the guild recorded after `since` (epoch seconds).
+        return: {'members': {member_id, ...}, 'notify': bool}, None on error
+        """
+        params = {
+            "KeyConditionExpression": "guild_id = :guild_id AND change_id > :since",
+            "ExpressionAttributeValues": self._serialize(
+                {":guild_id": int(guild_id), ":since": self._change_id(since)}
+            ),
         }
+        changes = {"members": set(), "notify": False}
+        try:
+            async for page in self._pages("query", params):
+                for item in page:
+                    changes["members"].update(item.get("members", []))
+                    changes["notify"] = changes["notify"] or item.get("notify", False)
+        except Exception as e:
+            logging.error(f"Error querying changes: {e}")
+            return None
+        return changes
+
+
+class MemberTaggerDBHandler(DBHandler, TagStorage):
+    """
+    one item per tag, partitioned by guild. every read is a Query on one guild.
+
+    db architecture:
+    {
+        'guild_id': guild_id(int, partition key),
+        'member_thread': 'member_id#thread_id'(str, sort key),
+        'member_id': member_id(str),
+        'thread_id': thread_id(str),
+        'deadline': deadline(str)
     }
+
+    local secondary indexes (guild_id partition key, all attributes projected):
+        'thread_id-index': thread_id(str, sort key) -> members of a thread
+        'deadline-index': deadline(str, sort key) -> tags due in a date range
+    deadlines are 'YYYY-MM-DD', so they sort in date order.
+    (with local secondary indexes, the tags of one guild are limited to 10GB)
     """
 
+    thread_index = "thread_id-index"
+    deadline_index = "deadline-index"
+    # 移行前のテーブル(member_id -> {thread_id: deadline}, guildなし)
+    legacy_table = "member_tagger_posts"
+    # migrate.pyが移行を終えたことを示すitem(guild_id 0のguildは存在しない)
+    migrated_key = {"guild_id": 0, "member_thread": "#migrated"}
+
+    # get_tagged_threadsの結果を(guild_id, member_id)ごとにキャッシュする(全インスタンスで共有)
+    # tag/untagのたびに該当メンバーのキャッシュを破棄する
+    _cache = TTLCache(
+        maxsize=int(os.getenv("TAG_CACHE_SIZE", "4096")),
+        ttl=float(os.getenv("TAG_CACHE_TTL", "300")),
+    )
+    # 読み込み中にinvalidateされた場合に古い値を書き戻さないための世代番号
+    _cache_generation = 0
+    cache_hits = 0
+    cache_misses = 0
+
     def __init__(self):
-        super().__init__("member_tagger_posts")
+        super().__init__("member_tagger_tags")
+        # スナップショットが有効な時だけSnapshot.enableで設定される(Noneなら変更を記録しない)
+        self.change_log: MemberTaggerChangeLogDBHandler | None = None
 
-    def tag_member(self, member_id: str, thread_id: str, deadline: str):
-        item = self.get({"member_id": member_id})
-        if item:
-            item[thread_id] = deadline
-            self.put(item)
-        else:
-            self.put({"member_id": member_id, thread_id: deadline})
+    async def _record_change(self, guild_id: int, member_ids: list[str]):
+        if self.change_log:
+            await self.change_log.record(guild_id, member_ids)
 
-    def untag_member(self, member_id: str, thread_id: str):
-        item = self.get({"member_id": member_id})
-        if item:
-            item.pop(thread_id, None)
-            self.put(item)
+    @staticmethod
+    def invalidate_cache(guild_id: int | None = None, member_id: str | None = None):
+        """drop the cached threads of the member (or every member if None)"""
+        MemberTaggerDBHandler._cache_generation += 1
+        if guild_id is None or member_id is None:
+            MemberTaggerDBHandler._cache.clear()
         else:
-            return False
+            MemberTaggerDBHandler._cache.pop((int(guild_id), str(member_id)), None)
+
+    @staticmethod
+    def cache_stats() -> dict[str, int | float]:
+        """e.g. {'size': 120, 'hits': 300, 'misses': 120, 'hit_rate': 0.71}"""
+        hits = MemberTaggerDBHandler.cache_hits
+        misses = MemberTaggerDBHandler.cache_misses
+        return {
+            "size": len(MemberTaggerDBHandler._cache),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
 
-    def get_tagged_threads(self, member_id: str) -> dict[str, str] | None:
+    @staticmethod
+    def warm_cache(guild_id: int, threads: dict[str, dict[str, str]]) -> int:
         """
-        Returns a dictionary of tagged threads and their deadlines. If the member is not tagged, returns None.
-        e.g. {'thread_id': 'deadline'}
+        cache {member_id: {thread_id: deadline}} (e.g. from a snapshot) while the
+        cache has room. members already cached are kept.
+        return: the number of members cached
         """
-        item = self.get({"member_id": member_id})
-        if item:
-            result = {k: v for k, v in item.items() if k != "member_id"}
-            return result
-        else:
-            return {}
+        cache = MemberTaggerDBHandler._cache
+        count = 0
+        for member_id, tagged in threads.items():
+            if len(cache) >= cache.maxsize:
+                break
+            key = (int(guild_id), str(member_id))
+            if key not in cache:
+                cache[key] = dict(tagged)
+                count += 1
+        return count
 
-    def get_tagged_members(
-        self, thread_id: str
-    ) -> dict[str, str | int | list[str] | list[int]]:
-        items = self.table.scan().get("Items", [])
-        member_ids = [item["member_id"] for item in items if str(thread_id) in item]
-        deadline = [item[str(thread_id)] for item in items if str(thread_id) in item]
-        deadline = deadline[0] if deadline else None
-        result = {"ids": member_ids, "deadline": deadline}
-        return result
+    async def create_table_if_missing(self) -> bool:
+        """create member_tagger_tags with its indexes"""
+        return await self._create_table_if_missing(
+            KeySchema=[
+                {"AttributeName": "guild_id", "KeyType": "HASH"},
+                {"AttributeName": "member_thread", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "guild_id", "AttributeType": "N"},
+                {"AttributeName": "member_thread", "AttributeType": "S"},
+                {"AttributeName": "thread_id", "AttributeType": "S"},
+                {"AttributeName": "deadline", "AttributeType": "S"},
+            ],
+            LocalSecondaryIndexes=[
+                {
+                    "IndexName": index_name,
+                    "KeySchema": [
+                        {"AttributeName": "guild_id", "KeyType": "HASH"},
+                        {"AttributeName": sort_key, "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+                for index_name, sort_key in [
+                    (self.thread_index, "thread_id"),
+                    (self.deadline_index, "deadline"),
+                ]
+            ],
+        )
 
-    def get_deadline(self, member_id: str, thread_id: str) -> str | None:
-        item = self.get({"member_id": member_id})
-        return item.get(str(thread_id), None)
+    async def check_migrated(self) -> bool:
+        """
+        False while the legacy table exists and migrate.py has not finished the
+        tags job, i.e. member_tagger_tags does not have the legacy tags yet.
+        errors are raised
+        """
+        if not await self.table_exists(self.legacy_table):
+            return True
+        if not await self.table_exists():
+            return False
+        return await self.get(self.migrated_key, raise_errors=True) is not None
+
+    async def mark_migrated(self) -> bool:
+        """called by migrate.py after the tags job is verified"""
+        return bool(
+            await self.put({**self.migrated_key, "migrated_at": int(time.time())})
+        )
 
-    def get_all_tagged_threads(self) -> dict[str, dict[str, str]]:
-        """return: {member_id: {thread_id: deadline}}"""
-        items = self.table.scan().get("Items", [])
+    @staticmethod
+    def _key(guild_id: int, member_id: str, thread_id: str) -> dict[str, int | str]:
+        return {
+            "guild_id": int(guild_id),
+            "member_thread": f"{member_id}#{thread_id}",
+        }
+
+    @staticmethod
+    def _group(items: list[dict[str, str]]) -> dict[str, dict[str, str]]:
+        """[item, ...] -> {member_id: {thread_id: deadline}}"""
         result = {}
         for item in items:
-            member_id = item.pop("member_id")
-            result[member_id] = {k: v for k, v in item.items()}
+            result.setdefault(item["member_id"], {})[item["thread_id"]] = item[
+                "deadline"
+            ]
         return result
 
+    async def tag_member(
+        self, guild_id: int, member_id: str, thread_id: str, deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], [thread_id], deadline)
+
+    async def untag_member(self, guild_id: int, member_id: str, thread_id: str):
+        return await self.untag_members(guild_id, [member_id], [thread_id])
+
+    async def tag_threads(
+        self, guild_id: int, member_id: str, thread_ids: list[str], deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], thread_ids, deadline)
+
+    async def untag_threads(self, guild_id: int, member_id: str, thread_ids: list[str]):
+        return await self.untag_members(guild_id, [member_id], thread_ids)
+
+    async def tag_members(
+        self,
+        guild_id: int,
+        member_ids: list[str],
+        thread_ids: list[str],
+        deadline: str,
+    ):
+        """tag every member to every thread with batch writes (no read)"""
+        member_ids = [str(member_id) for member_id in dict.fromkeys(member_ids)]
+        write = self.batch_write(
+            put_items=[
+                {
+                    **self._key(guild_id, member_id, thread_id),
+                    "member_id": member_id,
+                    "thread_id": str(thread_id),
+                    "deadline": deadline,
+                }
+                for member_id in member_ids
+                for thread_id in dict.fromkeys(thread_ids)
+            ]
+        )
+        result, _ = await asyncio.gather(
+            write, self._record_change(guild_id, member_ids)
+        )
+        for member_id in member_ids:
+            self.invalidate_cache(guild_id, member_id)
+        return result
+
+    async def untag_members(
+        self, guild_id: int, member_ids: list[str], thread_ids: list[str]
+    ):
+        """untag every member from every thread with batch writes (no read)"""
+        member_ids = [str(member_id) for member_id in dict.fromkeys(member_ids)]
+        write = self.batch_write(
+            delete_keys=[
+                self._key(guild_id, member_id, thread_id)
+                for member_id in member_ids
+                for thread_id in dict.fromkeys(thread_ids)
+            ]
+        )
+        result, _ = await asyncio.gather(
+            write, self._record_change(guild_id, member_ids)
+        )
+        for member_id in member_ids:
+            self.invalidate_cache(guild_id, member_id)
+        return result
+
+    async def put_tags(self, rows: list[dict[str, int | str]]) -> bool:
+        """bulk upsert with batch writes. the tag cache is cleared"""
+        items = {}
+        members: dict[int, list[str]] = {}  # guild_id -> member_ids
+        for row in rows:
+            key = self._key(row["guild_id"], row["member_id"], row["thread_id"])
+            # 1回のbatch_writeに同じキーを2回含めることはできない
+            items[(key["guild_id"], key["member_thread"])] = {
+                **key,
+                "member_id": str(row["member_id"]),
+                "thread_id": str(row["thread_id"]),
+                "deadline": row["deadline"],
+            }
+            members.setdefault(key["guild_id"], []).append(str(row["member_id"]))
+        result, *_ = await asyncio.gather(
+            self.batch_write(put_items=list(items.values())),
+            *[
+                self._record_change(guild_id, member_ids)
+                for guild_id, member_ids in members.items()
+            ],
+        )
+        self.invalidate_cache()
+        return result
+
+    async def get_tagged_threads(self, guild_id: int, member_id: str) -> dict[str, str]:
+        """
+        Returns a dictionary of tagged threads and their deadlines (empty if the member is not tagged).
+        e.g. {'thread_id': 'deadline'}
+        read errors are raised, so that an empty result is never cached for them.
+        """
+        key = (int(guild_id), str(member_id))
+        cached = MemberTaggerDBHandler._cache.get(key)
+        if cached is not None:
+            MemberTaggerDBHandler.cache_hits += 1
+            return dict(cached)
 
-class MemberTaggerNotifyDBHandler(DBHandler):
+        MemberTaggerDBHandler.cache_misses += 1
+        generation = MemberTaggerDBHandler._cache_generation
+        items = await self.query(
+            "guild_id = :guild_id AND begins_with(member_thread, :member)",
+            {":guild_id": int(guild_id), ":member": f"{member_id}#"},
+            raise_errors=True,
+        )
+        result = {item["thread_id"]: item["deadline"] for item in items}
+        if generation == MemberTaggerDBHandler._cache_generation:
+            MemberTaggerDBHandler._cache[key] = result
+        return dict(result)
+
+    async def get_tagged_members(
+        self, guild_id: int, thread_id: str
+    ) -> dict[str, str | int | list[str] | list[int]]:
+        items = await self.query(
+            "guild_id = :guild_id AND thread_id = :thread_id",
+            {":guild_id": int(guild_id), ":thread_id": str(thread_id)},
+            index_name=self.thread_index,
+        )
+        return {
+            "ids": [item["member_id"] for item in items],
+            "deadline": items[0]["deadline"] if items else None,
+        }
+
+    async def get_deadline(
+        self, guild_id: int, member_id: str, thread_id: str
+    ) -> str | None:
+        threads = await self.get_tagged_threads(guild_id, member_id)
+        return threads.get(str(thread_id), None)
+
+    async def get_all_tagged_threads(self, guild_id: int) -> dict[str, dict[str, str]]:
+        """return: {member_id: {thread_id: deadline}} of the guild"""
+        return self._group(
+            await self.query("guild_id = :guild_id", {":guild_id": int(guild_id)})
+        )
+
+    async def get_tagged_threads_page(
+        self, guild_id: int, cursor: str | None = None, limit: int = 10
+    ) -> dict[str, dict[str, dict[str, str]] | str | None]:
+        """
+        at most `limit` members of the guild in sort key order, starting after the member `cursor`.
+        return: {'items': {member_id: {thread_id: deadline}}, 'cursor': str | None}
+        """
+        condition = "guild_id = :guild_id"
+        values = {":guild_id": int(guild_id)}
+        if cursor:
+            # '$'は'#'の次の文字なので、'cursor#...'の行を全て飛ばせる
+            condition += " AND member_thread > :after"
+            values[":after"] = f"{cursor}$"
+        items = {}
+        async with contextlib.aclosing(
+            self.query_pages(condition, values, page_size=max(limit * 4, 25))
+        ) as pages:
+            async for page in pages:
+                for item in page:
+                    if item["member_id"] not in items and len(items) == limit:
+                        return {"items": items, "cursor": list(items)[-1]}
+                    items.setdefault(item["member_id"], {})[item["thread_id"]] = item[
+                        "deadline"
+                    ]
+        return {"items": items, "cursor": None}
+
+    async def get_due_threads(
+        self, guild_id: int, end: str, start: str | None = None
+    ) -> dict[str, dict[str, str]]:
+        """
+        tags of the guild whose deadline is between start and end ('YYYY-MM-DD', inclusive).
+        without start, every tag due up to end is returned.
+        return: {member_id: {thread_id: deadline}}
+        """
+        values = {":guild_id": int(guild_id), ":end": end}
+        if start:
+            condition = "guild_id = :guild_id AND deadline BETWEEN :start AND :end"
+            values[":start"] = start
+        else:
+            condition = "guild_id = :guild_id AND deadline <= :end"
+        return self._group(
+            await self.query(condition, values, index_name=self.deadline_index)
+        )
+
+
+class MemberTaggerNotifyDBHandler(DBHandler, NotifyStorage):
     """
     db architecture:
     {
         'guild_id': guild_id(int),
         'info': {
             member_id(int): notify(bool)
-        }
+        },
+        'version': int (incremented by every write, missing on old items)
     }
     """
 
+    # sync_membersの条件付き書き込みが他の書き込みと競合した場合に読み直す回数
+    sync_retries = 3
+
+    # guildごとのinfoをメモリに保持する(全インスタンスで共有)
+    # 読み込みでは期限を延長しないので、他のプロセスの変更もNOTIFY_CACHE_TTL秒以内に読み直される
+    _cache = TTLCache(
+        maxsize=int(os.getenv("NOTIFY_CACHE_SIZE", "256")),
+        ttl=float(os.getenv("NOTIFY_CACHE_TTL", "1800")),
+    )
+    _cache_generation = 0
+
     def __init__(self):
         super().__init__("member_tagger_notify")
+        # スナップショットが有効な時だけSnapshot.enableで設定される(Noneなら変更を記録しない)
+        self.change_log: MemberTaggerChangeLogDBHandler | None = None
+
+    async def _get_info(self, guild_id: int) -> dict[str, bool] | None:
+        """
+        cached info map of the guild. None if the guild is not registered.
+        read errors are raised (and not cached), so that a failed read is never
+        mistaken for a missing guild and overwritten.
+        """
+        guild_id = int(guild_id)
+        cache = MemberTaggerNotifyDBHandler._cache
+        if guild_id in cache:
+            return cache[guild_id]
+
+        generation = MemberTaggerNotifyDBHandler._cache_generation
+        item = await self.get({"guild_id": guild_id}, raise_errors=True)
+        info = item["info"] if item else None
+        if generation == MemberTaggerNotifyDBHandler._cache_generation:
+            cache[guild_id] = info
+        return info
+
+    def _set_cached_info(
+        self,
+        guild_id: int,
+        info: dict[str, bool] | None,
+        generation: int | None = None,
+    ):
+        """
+        cache the info written. pass the generation read before the write: if the
+        cache changed in between, it is dropped instead of replaced by an older map.
+        """
+        if (
+            generation is not None
+            and generation != MemberTaggerNotifyDBHandler._cache_generation
+        ):
+            self.invalidate_cache(guild_id)
+            return
+        MemberTaggerNotifyDBHandler._cache_generation += 1
+        MemberTaggerNotifyDBHandler._cache[int(guild_id)] = info
+
+    async def _record_change(self, guild_id: int):
+        if self.change_log:
+            await self.change_log.record(guild_id, notify=True)
+
+    @staticmethod
+    def invalidate_cache(guild_id: int | None = None):
+        MemberTaggerNotifyDBHandler._cache_generation += 1
+        if guild_id is None:
+            MemberTaggerNotifyDBHandler._cache.clear()
+        else:
+            MemberTaggerNotifyDBHandler._cache.pop(int(guild_id), None)
 
-    def set_guild_id(self, guild_id: int):
-        self.put({"guild_id": guild_id, "info": {}})
+    def warm_cache(self, guild_id: int, info: dict[str, bool]) -> bool:
+        """
+        cache the info map of the guild (e.g. from a snapshot) if the cache has room.
+        a guild already cached is kept.
+        """
+        cache = MemberTaggerNotifyDBHandler._cache
+        if int(guild_id) in cache or len(cache) >= cache.maxsize:
+            return False
+        self._set_cached_info(guild_id, dict(info))
         return True
 
-    def set_notify_state(self, guild_id: int, member_id: int, notify: bool):
+    async def _put_info(
+        self,
+        guild_id: int,
+        info: dict[str, bool],
+        conditional: bool = False,
+        version: int | None = None,
+        raise_errors: bool = False,
+    ) -> bool:
+        """
+        write the whole info map, logging the change.
+        with conditional=True, the write only succeeds if the item is still at
+        `version` (None: the item does not exist, 0: it has no version yet).
+        return: False if the condition was not met or on errors
+        (other errors are raised with raise_errors=True, see DBHandler.update)
+        """
+        condition = None
+        values = {":info": info, ":one": 1}
+        if conditional:
+            if version is None:
+                condition = "attribute_not_exists(guild_id)"
+            elif version == 0:
+                condition = "attribute_not_exists(version)"
+            else:
+                condition = "version = :version"
+                values[":version"] = version
+        result, _ = await asyncio.gather(
+            self.update(
+                {"guild_id": guild_id},
+                "SET info = :info ADD version :one",
+                values,
+                condition_expression=condition,
+                raise_errors=raise_errors,
+            ),
+            self._record_change(guild_id),
+        )
+        return result
+
+    async def set_guild_id(self, guild_id: int):
+        generation = MemberTaggerNotifyDBHandler._cache_generation
+        if await self._put_info(guild_id, {}):
+            self._set_cached_info(guild_id, {}, generation)
+        else:
+            self.invalidate_cache(guild_id)
+        return True
+
+    async def set_notify_state(self, guild_id: int, member_id: int, notify: bool):
+        guild_id = int(guild_id)
         member_id = str(member_id)
-        item = self.get({"guild_id": guild_id})
-        data = item["info"] if item else {}
-        data[member_id] = notify
-        self.put({"guild_id": guild_id, "info": data})
+        info = await self._get_info(guild_id)
+        generation = MemberTaggerNotifyDBHandler._cache_generation
+        if info is None:
+            # 他の書き込みで作られたitemを上書きしないように、存在しない場合だけ作る
+            created = await self._put_info(
+                guild_id, {member_id: notify}, conditional=True
+            )
+            if created:
+                self._set_cached_info(guild_id, {member_id: notify}, generation)
+                return
+            # 他の書き込みで作られていれば、該当メンバーの値だけを書き換える
+            self.invalidate_cache(guild_id)
+        # info全体ではなく、該当メンバーの値だけを書き換える
+        updated, _ = await asyncio.gather(
+            self.update(
+                {"guild_id": guild_id},
+                "SET info.#member = :notify ADD version :one",
+                {":notify": notify, ":one": 1},
+                {"#member": member_id},
+            ),
+            self._record_change(guild_id),
+        )
+        cached = MemberTaggerNotifyDBHandler._cache.get(guild_id)
+        if (
+            updated
+            and cached is not None
+            and generation == MemberTaggerNotifyDBHandler._cache_generation
+        ):
+            # キャッシュが書き込み前に読んだinfoのままなら、その値だけを書き換える
+            # (期限は延長しない)。他の書き込みで変わっていれば読み直させる
+            cached[member_id] = notify
+            MemberTaggerNotifyDBHandler._cache_generation += 1
+        else:
+            self.invalidate_cache(guild_id)
 
-    def get_notify_state(self, guild_id: int, member_id: int) -> bool | None:
+    async def get_notify_state(self, guild_id: int, member_id: int) -> bool | None:
         member_id = str(member_id)
-        item = self.get({"guild_id": guild_id})
-        return item["info"].get(member_id, None) if item else None
+        info = await self._get_info(guild_id)
+        return info.get(member_id, None) if info is not None else None
 
-    def get_guild_notify_states(self, guild_id: int) -> dict[int, bool]:
-        item = self.get({"guild_id": guild_id})
-        return item["info"] if item else {}
+    async def get_guild_notify_states(self, guild_id: int) -> dict[int, bool]:
+        info = await self._get_info(guild_id)
+        return dict(info) if info is not None else {}
+
+    async def set_guild_notify_states(
+        self, guild_id: int, states: dict[str, bool]
+    ) -> bool:
+        info = {str(member_id): notify for member_id, notify in states.items()}
+        generation = MemberTaggerNotifyDBHandler._cache_generation
+        result = await self._put_info(int(guild_id), info)
+        if result:
+            self._set_cached_info(guild_id, info, generation)
+        else:
+            self.invalidate_cache(guild_id)
+        return result
 
-    def get_guilds(self) -> list[int]:
-        items = self.table.scan().get("Items", [])
-        return [item["guild_id"] for item in items]
+    async def get_guilds(self) -> list[int]:
+        return [
+            item["guild_id"]
+            async for item in self.scan_iter(projection_expression="guild_id")
+        ]
 
-    def toggle_notify_state(self, guild_id: int, member_id: int) -> bool:
+    async def toggle_notify_state(self, guild_id: int, member_id: int) -> bool:
         member_id = str(member_id)
-        item = self.get({"guild_id": guild_id})
-        data = item["info"] if item else {}
-        data[member_id] = not data.get(member_id, False)
-        self.put({"guild_id": guild_id, "info": data})
-        return data[member_id]
+        info = await self._get_info(guild_id) or {}
+        notify = not info.get(member_id, False)
+        await self.set_notify_state(guild_id, member_id, notify)
+        return notify
+
+    async def sync_members(
+        self, guild_id: int, member_ids: list[int], remove_missing: bool = True
+    ) -> dict[str, int]:
+        """
+        make the stored members of the guild match member_ids with a single write.
+        new members are set to notify=True, members who left are removed
+        (only with remove_missing=True) and the states of the others are kept.
+        the write is conditional on the version read, so that a state changed
+        in between is not overwritten (the item is read again and the diff redone).
+        errors (and repeated conflicts) are raised without writing.
+        return: {'added': int, 'removed': int, 'unchanged': int}
+        """
+        guild_id = int(guild_id)
+        live = {str(member_id) for member_id in member_ids}
+        info = await self._get_info(guild_id)
+        # 差分がなければキャッシュだけで済ませる(書き込まないので競合もしない)
+        if info is not None and (
+            info.keys() == live if remove_missing else live <= info.keys()
+        ):
+            return {"added": 0, "removed": 0, "unchanged": len(live)}
+
+        for _ in range(self.sync_retries):
+            # 書き込みの条件に使うversionはキャッシュにないので、itemを読み直す
+            generation = MemberTaggerNotifyDBHandler._cache_generation
+            item = await self.get({"guild_id": guild_id}, raise_errors=True)
+            stored = dict(item["info"]) if item else {}
+            added = live - stored.keys()
+            removed = stored.keys() - live if remove_missing else set()
+            result = {
+                "added": len(added),
+                "removed": len(removed),
+                "unchanged": len(live) - len(added),
+            }
+            if item is not None and not added and not removed:
+                if generation == MemberTaggerNotifyDBHandler._cache_generation:
+                    MemberTaggerNotifyDBHandler._cache[guild_id] = stored
+                return result
+
+            synced = {
+                member_id: stored.get(member_id, True)
+                for member_id in (live | stored.keys()) - removed
+            }
+            written = await self._put_info(
+                guild_id,
+                synced,
+                conditional=True,
+                version=item.get("version", 0) if item else None,
+                raise_errors=True,
+            )
+            if written:
+                self._set_cached_info(guild_id, synced, generation)
+                return result
+            # 読み込みから書き込みまでの間に他の書き込みがあったので、やり直す
+            self.invalidate_cache(guild_id)
+        raise RuntimeError(
+            f"the members of guild {guild_id} kept changing during the sync"
+        )
 
-    def get_members(self, guild_id: int) -> list[int]:
+    async def get_members(self, guild_id: int) -> list[int]:
         """for sync with guild members"""
-        item = self.get({"guild_id": guild_id})
-        return list(item["info"].keys()) if item else []
+        info = await self._get_info(guild_id)
+        return list(info.keys()) if info is not None else []
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+import time
 import asyncio
 import datetime
 import logging
@@ -8,7 +9,7 @@ from discord import app_commands
 from discord.ext import tasks
 from colorama import Fore, Style
 
-from db_handler import MemberTaggerNotifyDBHandler
+from storage import get_notify_db, get_tag_db
 from components.embeds import EmbedHandler
 from components.views import (
     TagMemberView1,
@@ -17,8 +18,15 @@ from components.views import (
     GetTaggedMembersView,
     NotifyToggleView,
     InviteView,
+    AllTaggedMembersView,
+    respond_deferred,
 )
 from notify_handler import NotifyHandler
+from notify_dispatcher import NotifyDispatcher
+from scheduler import ReminderScheduler, next_jst_midnight
+from metrics import MetricsServer
+from snapshot import Snapshot
+import tracing
 
 
 # TODO: DBのローカル化(sqlite3, mysql ...)？(もはやjsonでもいいかも)
@@ -38,10 +46,60 @@ class Client(discord.Client):
     def __init__(self):
         super().__init__(intents=intents)
         self.synced = False
-        self.notify_handler = NotifyHandler()
+        # NotifyHandlerはguildごとに作り、DBハンドラだけを共有する
+        self.notify_db = get_notify_db()
+        self.tag_db = get_tag_db()
+        self.notify_dispatcher = NotifyDispatcher()
+        # 起動時のguild同期を同時に何guildまで走らせるか
+        self.guild_sync_concurrency = int(os.getenv("GUILD_SYNC_CONCURRENCY", "5"))
+        self.guild_sync_task: asyncio.Task | None = None
+        self.scheduler = ReminderScheduler()
+        self.scheduler.add_job("daily_notify", self.notify, next_jst_midnight)
+        # タグと通知設定のローカルスナップショット(起動時にキャッシュを温める)
+        self.snapshot = (
+            Snapshot(self.tag_db, self.notify_db)
+            if Snapshot.supports(self.tag_db)
+            else None
+        )
+        # Prometheus形式の/metricsを同じプロセス内で配信する
+        self.metrics_server = MetricsServer()
+        # 全interactionの初回応答までの時間を記録する
+        tracing.install()
 
     ############## discord.py events ##############
 
+    # ログイン前に一度だけ呼ばれる
+    async def setup_hook(self):
+        # 旧テーブルのタグを移す前に起動すると、全てのタグが消えたように見える
+        if hasattr(self.tag_db, "check_migrated") and not (
+            await self.tag_db.check_migrated()
+        ):
+            raise RuntimeError(
+                f"{self.tag_db.legacy_table} has not been migrated yet. "
+                "run python src/migrate.py before starting the bot"
+            )
+        self.metrics_server.start()
+        # 変更ログのテーブルは起動時に一度だけ確かめ、無ければスナップショットを使わない
+        if self.snapshot:
+            try:
+                enabled = await self.snapshot.enable()
+            except Exception as e:
+                logging.error(f"Error enabling snapshot: {e}")
+                enabled = False
+            if enabled:
+                self.scheduler.add_job(
+                    "snapshot", self.refresh_snapshot, self.snapshot.next_time
+                )
+                try:
+                    await self.snapshot.restore()
+                except Exception as e:
+                    logging.error(f"Error restoring snapshot: {e}")
+            else:
+                self.snapshot = None
+        if not self.snapshot:
+            # 変更が記録されないので、残っているスナップショットは次の起動で追いつけない
+            Snapshot.discard()
+
     async def on_ready(self):
         logging.info(Fore.YELLOW + "Bot is starting..." + Style.RESET_ALL)
 
@@ -49,68 +107,31 @@ class Client(discord.Client):
             await self.sync_commands()  # treeコマンドの同期
         logging.info(Fore.GREEN + "Commands synced" + Style.RESET_ALL)
 
-        # botが参加しているguildのメンバーとDBを同期
-        for guild in self.guilds:
-            try:
-                logging.info(
-                    Fore.GREEN
-                    + f"Joined guild {guild.name} ({guild.id})"
-                    + Style.RESET_ALL
-                )
-                self.notify_handler.guild = guild
-                await self.notify_handler.notify_member_db_sync()
-            except discord.errors.Forbidden:
-                logging.warning(
-                    Fore.RED
-                    + f"Failed to join guild {guild.name} ({guild.id})"
-                    + Style.RESET_ALL
-                )
+        # botが参加しているguildのメンバーとDBを同期(バックグラウンドで行い、その間もコマンドは受け付ける)
+        # 再接続でon_readyが再度呼ばれた場合は、実行中の同期をそのまま使う
+        if not self.guild_sync_task or self.guild_sync_task.done():
+            self.guild_sync_task = asyncio.create_task(self.sync_guilds(self.guilds))
         logging.info(
             Fore.BLUE
             + f"Logged in as {self.user.name} ({self.user.id})"
             + Style.RESET_ALL
         )
 
-        # 10分ごとにpresenceを更新するループタスクを開始
-        self.set_presence.start()
+        # 10分ごとにpresenceを更新するループタスクを開始(再接続時は既に動いている)
+        if not self.set_presence.is_running():
+            self.set_presence.start()
 
-        logging.info(Fore.GREEN + Style.BRIGHT + "Bot is ready" + Style.RESET_ALL)
+        # 通知はschedulerが毎日0:00(JST)に実行する。再起動をまたいでも予定は保持される
+        self.scheduler.start()
 
-        ######## ここから通知タスク ########
-        timezone = datetime.timezone(datetime.timedelta(hours=9))  # JST
-        today = datetime.datetime.now(timezone).date()
-        midnight = datetime.datetime.combine(
-            today, datetime.time(0, 0), tzinfo=timezone
-        )
-
-        # 通知タスクを開始するまでの時間を計算
-        time_to_notify = (
-            midnight + datetime.timedelta(days=1) - datetime.datetime.now(timezone)
-        )
-        # 時刻を算出
-        time_to_notify_dt = datetime.datetime.now(timezone) + time_to_notify
-
-        time_to_notify_dt = (
-            Fore.LIGHTMAGENTA_EX
-            + datetime.datetime.strftime(time_to_notify_dt, "%Y/%m/%d %H:%M:%S")
-            + Style.RESET_ALL
-            + Fore.GREEN
-        )
-        logging.info(Fore.GREEN + f"Wait for {time_to_notify_dt}" + Style.RESET_ALL)
-
-        # 算出した時間まで待機
-        await asyncio.sleep(time_to_notify.total_seconds())
-
-        # 通知タスクを開始
-        self.notify.start()
+        logging.info(Fore.GREEN + Style.BRIGHT + "Bot is ready" + Style.RESET_ALL)
 
     # ギルド参加時にDBとメンバーを同期
     async def on_guild_join(self, guild: discord.Guild):
         logging.info(
             Fore.GREEN + f"Joined guild {guild.name} ({guild.id})" + Style.RESET_ALL
         )
-        self.notify_handler.guild = guild
-        await self.notify_handler.notify_member_db_sync()
+        await self.get_notify_handler(guild).notify_member_db_sync()
         logging.info(Fore.GREEN + "Notify task started" + Style.RESET_ALL)
         client.sync_commands()
 
@@ -120,6 +141,7 @@ class Client(discord.Client):
         interaction: discord.Interaction,
         command: app_commands.Command | app_commands.ContextMenu,
     ):
+        tracing.record_completion(interaction)
         command_name = Fore.YELLOW + command.name + Style.RESET_ALL
         user_name = Fore.BLUE + str(interaction.user.name) + Style.RESET_ALL
         user_id = Fore.BLUE + str(interaction.user.id) + Style.RESET_ALL
@@ -135,8 +157,58 @@ class Client(discord.Client):
             f"{command_name} called by {user_name} ({user_id}) on {guild}, {channel} at {time}"
         )
 
+    # 終了時に共有しているDBのclientを閉じる
+    async def close(self):
+        self.scheduler.stop()
+        await self.metrics_server.stop()
+        await super().close()
+        if self.snapshot:
+            await self.snapshot.save()
+            self.snapshot.close()
+        await self.tag_db.close()
+        await self.notify_db.close()
+
     ############## my utils ##############
 
+    async def sync_guilds(self, guilds: list[discord.Guild]):
+        """sync guilds concurrently (at most guild_sync_concurrency at a time)"""
+        semaphore = asyncio.Semaphore(self.guild_sync_concurrency)
+        started = time.perf_counter()
+
+        async def sync_guild(guild: discord.Guild) -> bool:
+            async with semaphore:
+                guild_started = time.perf_counter()
+                try:
+                    await self.get_notify_handler(guild).notify_member_db_sync()
+                except Exception as e:
+                    logging.warning(
+                        Fore.RED
+                        + f"Failed to sync guild {guild.name} ({guild.id}): {e}"
+                        + Style.RESET_ALL
+                    )
+                    return False
+                logging.info(
+                    Fore.GREEN
+                    + f"Synced guild {guild.name} ({guild.id}) in {time.perf_counter() - guild_started:.2f}s"
+                    + Style.RESET_ALL
+                )
+                return True
+
+        results = await asyncio.gather(*[sync_guild(guild) for guild in guilds])
+        logging.info(
+            Fore.GREEN
+            + f"Synced {sum(results)}/{len(guilds)} guilds in {time.perf_counter() - started:.2f}s"
+            + Style.RESET_ALL
+        )
+
+    async def refresh_snapshot(self):
+        await self.snapshot.refresh([guild.id for guild in self.guilds])
+
+    def get_notify_handler(self, guild: discord.Guild) -> NotifyHandler:
+        return NotifyHandler(
+            guild, self.notify_db, self.tag_db, self.notify_dispatcher
+        )
+
     async def sync_commands(self):
         if self.synced:
             return
@@ -157,20 +229,43 @@ class Client(discord.Client):
             Fore.GREEN + f"Presence updated at {now_fmt_ymd_hms}" + Style.RESET_ALL
         )
 
-    @tasks.loop(hours=24)
     async def notify(self):
-        guild_ids = self.notify_handler.db.get_guilds()
-        guilds = [self.get_guild(guild_id) for guild_id in guild_ids]
+        guild_ids = await self.notify_db.get_guilds()
+        guilds = [self.get_guild(int(guild_id)) for guild_id in guild_ids]
+        guilds = [guild for guild in guilds if guild]
         dates = [i for i in range(16)]
-        for guild in guilds:
-            self.notify_handler.guild = guild
-            await self.notify_handler.notify_now(dates)
+        # guildごとに独立したNotifyHandlerで並行して通知する(期限が近いものだけを読み込む)
+        results = await asyncio.gather(
+            *[self.get_notify_handler(guild).notify_now(dates) for guild in guilds],
+            return_exceptions=True,
+        )
+        for guild, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    Fore.RED
+                    + f"Failed to notify guild {guild.name} ({guild.id}): {result}"
+                    + Style.RESET_ALL
+                )
 
 
 client = Client()
 tree = discord.app_commands.CommandTree(client)
 
 
+# on_app_command_completionは成功した時しか呼ばれないので、失敗したコマンドはここで記録する
+@tree.error
+async def on_app_command_error(
+    interaction: discord.Interaction, error: app_commands.AppCommandError
+):
+    tracing.record_error(interaction)
+    logging.error(
+        Fore.RED
+        + f"Error in command {tracing.command_name(interaction)}: {error}"
+        + Style.RESET_ALL,
+        exc_info=error,
+    )
+
+
 ############## slash commands ##############
 
 
@@ -244,15 +339,39 @@ async def get_tagged_members_command(interaction: discord.Interaction):
     description="全てのタグ付けされたメンバーとそのタグ付けされたスレッドを表示します",
 )
 async def all_tagged_members_command(interaction: discord.Interaction):
-    await interaction.response.send_message(
-        ephemeral=True, embed=EmbedHandler(interaction).get_embed_all_tagged_members(1)
+    # 1ページ目だけを読み、残りはボタンが押されたときに読む
+    view = AllTaggedMembersView()
+    await respond_deferred(
+        interaction,
+        lambda: view.show(interaction, 0),
+        lambda embed: {"embed": embed, "view": view},
+        ephemeral=True,
+    )
+
+
+@tree.command(name="due_soon", description="提出期限が近い投稿を表示します")
+@app_commands.describe(days="何日後までの投稿を表示するか")
+async def due_soon_command(
+    interaction: discord.Interaction, days: app_commands.Range[int, 0, 365] = 7
+):
+    timezone = datetime.timezone(datetime.timedelta(hours=9))  # JST
+    today = datetime.datetime.now(timezone).date()
+    end = today + datetime.timedelta(days=days)
+    await respond_deferred(
+        interaction,
+        lambda: client.tag_db.get_due_threads(
+            interaction.guild.id, end.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")
+        ),
+        lambda threads: {
+            "embed": EmbedHandler(interaction).get_embed_due_soon(1, threads, days)
+        },
+        ephemeral=True,
     )
 
 
 @tree.command(name="notify_toggle", description="通知のON/OFFを切り替えます")
 async def notify_toggle_command(interaction: discord.Interaction):
-    notify_db_handler = MemberTaggerNotifyDBHandler()
-    current_notify_state = notify_db_handler.get_notify_state(
+    current_notify_state = await client.notify_db.get_notify_state(
         interaction.guild.id, interaction.user.id
     )
     await interaction.response.send_message(
@@ -262,7 +381,6 @@ async def notify_toggle_command(interaction: discord.Interaction):
             1, current_notify_state
         ),
     )
-    del notify_db_handler
 
 
 @tree.command(
@@ -270,8 +388,7 @@ async def notify_toggle_command(interaction: discord.Interaction):
     description="タグ付けされたメンバーに、今すぐ通知を送ります。send_hereをTrueにすると、このチャンネルにまとめて通知を送ります。",
 )
 async def notify_now_command(interaction: discord.Interaction, send_here: bool = False):
-    notify_handler = client.notify_handler
-    notify_handler.guild = interaction.guild
+    notify_handler = client.get_notify_handler(interaction.guild)
     await notify_handler.notify_now_to_channel(
         interaction.channel, interaction
     ) if send_here else await notify_handler.notify_now()
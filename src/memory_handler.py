@@ -0,0 +1,178 @@
+from storage import NotifyStorage, TagStorage
+
+
+class MemoryMemberTaggerDBHandler(TagStorage):
+    """
+    in-memory stand-in of MemberTaggerDBHandler for benchmarks and local runs.
+    nothing is persisted. every instance has its own data.
+    """
+
+    def __init__(self):
+        # guild_id -> member_id -> {thread_id: deadline}
+        self.tags: dict[int, dict[str, dict[str, str]]] = {}
+        # guild_id -> thread_id -> {member_id: deadline}
+        self.threads: dict[int, dict[str, dict[str, str]]] = {}
+
+    async def tag_member(
+        self, guild_id: int, member_id: str, thread_id: str, deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], [thread_id], deadline)
+
+    async def untag_member(self, guild_id: int, member_id: str, thread_id: str):
+        return await self.untag_members(guild_id, [member_id], [thread_id])
+
+    async def tag_threads(
+        self, guild_id: int, member_id: str, thread_ids: list[str], deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], thread_ids, deadline)
+
+    async def untag_threads(self, guild_id: int, member_id: str, thread_ids: list[str]):
+        return await self.untag_members(guild_id, [member_id], thread_ids)
+
+    async def tag_members(
+        self,
+        guild_id: int,
+        member_ids: list[str],
+        thread_ids: list[str],
+        deadline: str,
+    ):
+        tags = self.tags.setdefault(int(guild_id), {})
+        threads = self.threads.setdefault(int(guild_id), {})
+        for member_id in map(str, member_ids):
+            for thread_id in map(str, thread_ids):
+                tags.setdefault(member_id, {})[thread_id] = deadline
+                threads.setdefault(thread_id, {})[member_id] = deadline
+        return True
+
+    async def untag_members(
+        self, guild_id: int, member_ids: list[str], thread_ids: list[str]
+    ):
+        tags = self.tags.get(int(guild_id), {})
+        threads = self.threads.get(int(guild_id), {})
+        for member_id in map(str, member_ids):
+            for thread_id in map(str, thread_ids):
+                tags.get(member_id, {}).pop(thread_id, None)
+                threads.get(thread_id, {}).pop(member_id, None)
+            if member_id in tags and not tags[member_id]:
+                del tags[member_id]
+        return True
+
+    async def put_tags(self, rows: list[dict[str, int | str]]) -> bool:
+        for row in rows:
+            await self.tag_member(
+                row["guild_id"], row["member_id"], row["thread_id"], row["deadline"]
+            )
+        return True
+
+    async def get_tagged_threads(self, guild_id: int, member_id: str) -> dict[str, str]:
+        return dict(self.tags.get(int(guild_id), {}).get(str(member_id), {}))
+
+    async def get_tagged_members(
+        self, guild_id: int, thread_id: str
+    ) -> dict[str, str | int | list[str] | list[int]]:
+        members = self.threads.get(int(guild_id), {}).get(str(thread_id), {})
+        return {
+            "ids": list(members),
+            "deadline": next(iter(members.values())) if members else None,
+        }
+
+    async def get_deadline(
+        self, guild_id: int, member_id: str, thread_id: str
+    ) -> str | None:
+        return (
+            self.tags.get(int(guild_id), {}).get(str(member_id), {}).get(str(thread_id))
+        )
+
+    async def get_all_tagged_threads(self, guild_id: int) -> dict[str, dict[str, str]]:
+        """return: {member_id: {thread_id: deadline}} of the guild"""
+        return {
+            member_id: dict(threads)
+            for member_id, threads in self.tags.get(int(guild_id), {}).items()
+        }
+
+    async def get_tagged_threads_page(
+        self, guild_id: int, cursor: str | None = None, limit: int = 10
+    ) -> dict[str, dict[str, dict[str, str]] | str | None]:
+        tags = self.tags.get(int(guild_id), {})
+        member_ids = sorted(
+            member_id for member_id in tags if member_id > (cursor if cursor else "")
+        )
+        page = member_ids[:limit]
+        return {
+            "items": {member_id: dict(tags[member_id]) for member_id in page},
+            "cursor": page[-1] if len(member_ids) > limit else None,
+        }
+
+    async def get_due_threads(
+        self, guild_id: int, end: str, start: str | None = None
+    ) -> dict[str, dict[str, str]]:
+        result = {}
+        for member_id, threads in self.tags.get(int(guild_id), {}).items():
+            for thread_id, deadline in threads.items():
+                if (start or "") <= deadline <= end:
+                    result.setdefault(member_id, {})[thread_id] = deadline
+        return result
+
+    async def close(self):
+        pass
+
+
+class MemoryMemberTaggerNotifyDBHandler(NotifyStorage):
+    """
+    in-memory stand-in of MemberTaggerNotifyDBHandler for benchmarks and local runs.
+    """
+
+    def __init__(self):
+        self.info: dict[int, dict[str, bool]] = {}  # guild_id -> {member_id: notify}
+
+    async def set_guild_id(self, guild_id: int):
+        self.info[int(guild_id)] = {}
+        return True
+
+    async def set_notify_state(self, guild_id: int, member_id: int, notify: bool):
+        self.info.setdefault(int(guild_id), {})[str(member_id)] = notify
+
+    async def get_notify_state(self, guild_id: int, member_id: int) -> bool | None:
+        return self.info.get(int(guild_id), {}).get(str(member_id), None)
+
+    async def get_guild_notify_states(self, guild_id: int) -> dict[str, bool]:
+        return dict(self.info.get(int(guild_id), {}))
+
+    async def set_guild_notify_states(
+        self, guild_id: int, states: dict[str, bool]
+    ) -> bool:
+        self.info[int(guild_id)] = {
+            str(member_id): notify for member_id, notify in states.items()
+        }
+        return True
+
+    async def get_guilds(self) -> list[int]:
+        return list(self.info)
+
+    async def toggle_notify_state(self, guild_id: int, member_id: int) -> bool:
+        info = self.info.setdefault(int(guild_id), {})
+        info[str(member_id)] = not info.get(str(member_id), False)
+        return info[str(member_id)]
+
+    async def sync_members(
+        self, guild_id: int, member_ids: list[int], remove_missing: bool = True
+    ) -> dict[str, int]:
+        stored = self.info.get(int(guild_id), {})
+        live = {str(member_id) for member_id in member_ids}
+        added = live - stored.keys()
+        removed = stored.keys() - live if remove_missing else set()
+        self.info[int(guild_id)] = {
+            member_id: stored.get(member_id, True)
+            for member_id in (live | stored.keys()) - removed
+        }
+        return {
+            "added": len(added),
+            "removed": len(removed),
+            "unchanged": len(live) - len(added),
+        }
+
+    async def get_members(self, guild_id: int) -> list[str]:
+        return list(self.info.get(int(guild_id), {}))
+
+    async def close(self):
+        pass
@@ -0,0 +1,335 @@
+"""
+a small in-process metrics registry, exported in the Prometheus text format on
+GET /metrics by a FastAPI app served with uvicorn inside the bot's event loop.
+
+metrics are only updated from the event loop, so no locking is done.
+"""
+
+import os
+import math
+import socket
+import asyncio
+import logging
+from collections import deque
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from colorama import Fore, Style
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not labelnames:
+        return ""
+    escaped = [
+        str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        for value in values
+    ]
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, escaped))
+        + "}"
+    )
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts(累積ではない)..., +Inf count], sum
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self._counts.setdefault(labels, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[labels] = self._sums.get(labels, 0.0) + value
+
+    def count(self, *labels: str) -> int:
+        return sum(self._counts.get(labels, []))
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bucket_labelnames = self.labelnames + ("le",)
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket"
+                    + _format_labels(
+                        bucket_labelnames, labels + (_format_value(bound),)
+                    )
+                    + f" {cumulative}"
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(
+                f"{self.name}_sum{label_str} {_format_value(self._sums[labels])}"
+            )
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Summary:
+    """
+    quantiles over the last `window` observations (per label set),
+    plus the total sum and count of every observation.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        quantiles: tuple[float, ...] = (0.5, 0.95, 0.99),
+        window: int = 1000,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.quantiles = quantiles
+        self.window = window
+        self._windows: dict[tuple[str, ...], deque[float]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._counts: dict[tuple[str, ...], int] = {}
+
+    def observe(self, value: float, *labels: str):
+        self._windows.setdefault(labels, deque(maxlen=self.window)).append(value)
+        self._sums[labels] = self._sums.get(labels, 0.0) + value
+        self._counts[labels] = self._counts.get(labels, 0) + 1
+
+    def quantile(self, q: float, *labels: str) -> float | None:
+        values = sorted(self._windows.get(labels, []))
+        if not values:
+            return None
+        # nearest-rank
+        return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} summary"]
+        quantile_labelnames = self.labelnames + ("quantile",)
+        for labels in self._windows:
+            for q in self.quantiles:
+                lines.append(
+                    self.name
+                    + _format_labels(quantile_labelnames, labels + (str(q),))
+                    + f" {_format_value(self.quantile(q, *labels))}"
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(
+                f"{self.name}_sum{label_str} {_format_value(self._sums[labels])}"
+            )
+            lines.append(f"{self.name}_count{label_str} {self._counts[labels]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | Summary] = {}
+
+    def register(
+        self, metric: Counter | Histogram | Summary
+    ) -> Counter | Histogram | Summary:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# DBHandlerの全操作(テーブル・操作ごと)
+db_operation_seconds = REGISTRY.register(
+    Histogram(
+        "db_operation_seconds",
+        "latency of storage operations",
+        ("table", "operation"),
+    )
+)
+db_operations_total = REGISTRY.register(
+    Counter("db_operations_total", "storage operations", ("table", "operation"))
+)
+db_errors_total = REGISTRY.register(
+    Counter(
+        "db_errors_total",
+        "failed storage operations by error code (e.g. ProvisionedThroughputExceededException)",
+        ("table", "operation", "error"),
+    )
+)
+db_items_total = REGISTRY.register(
+    Counter(
+        "db_items_total",
+        "items read or written by storage operations",
+        ("table", "operation"),
+    )
+)
+
+# スラッシュコマンドとViewのコールバック(interactionの作成時刻から)
+command_first_response_seconds = REGISTRY.register(
+    Summary(
+        "command_first_response_seconds",
+        "time from interaction creation to the first response",
+        ("command",),
+    )
+)
+command_completion_seconds = REGISTRY.register(
+    Summary(
+        "command_completion_seconds",
+        "time from interaction creation to the end of the command or callback",
+        ("command",),
+    )
+)
+command_deadline_near_total = REGISTRY.register(
+    Counter(
+        "command_deadline_near_total",
+        "interactions first responded to close to (or after) the 3s deadline",
+        ("command",),
+    )
+)
+command_deadline_missed_total = REGISTRY.register(
+    Counter(
+        "command_deadline_missed_total",
+        "interactions first responded to after the 3s deadline",
+        ("command",),
+    )
+)
+command_errors_total = REGISTRY.register(
+    Counter(
+        "command_errors_total",
+        "slash commands and callbacks that ended with an error",
+        ("command",),
+    )
+)
+
+
+app = FastAPI()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+class MetricsServer:
+    """
+    serve `app` with uvicorn on the running event loop.
+    the address is METRICS_HOST (default 127.0.0.1, set 0.0.0.0 to scrape from
+    other hosts) and METRICS_PORT (default 8000). METRICS_PORT=0 disables the server.
+    the bot keeps running without metrics if the port cannot be bound.
+    """
+
+    def __init__(self, host: str | None = None, port: int | None = None):
+        self.host = host if host else os.getenv("METRICS_HOST", "127.0.0.1")
+        self.port = port if port is not None else int(os.getenv("METRICS_PORT", "8000"))
+        self._server: uvicorn.Server | None = None
+        self._task: asyncio.Task | None = None
+
+    def _bind(self) -> socket.socket | None:
+        """bind the socket here, because uvicorn calls sys.exit when it cannot"""
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+        except OSError as e:
+            sock.close()
+            logging.error(
+                Fore.RED
+                + f"Metrics are disabled, could not bind {self.host}:{self.port}: {e}"
+                + Style.RESET_ALL
+            )
+            return None
+        return sock
+
+    async def _serve(self, sock: socket.socket):
+        try:
+            await self._server.serve(sockets=[sock])
+        except (Exception, SystemExit) as e:
+            # SystemExitがイベントループまで伝わるとbotごと止まる
+            logging.error(Fore.RED + f"Metrics server stopped: {e!r}" + Style.RESET_ALL)
+        finally:
+            sock.close()
+
+    def start(self):
+        """does nothing if it is disabled, already running or the port is in use"""
+        if not self.port or (self._task and not self._task.done()):
+            return
+        sock = self._bind()
+        if sock is None:
+            return
+        self._server = uvicorn.Server(
+            uvicorn.Config(
+                app, host=self.host, port=self.port, log_level="warning", lifespan="off"
+            )
+        )
+        # uvicornにシグナルハンドラを登録させない(discord.pyの終了処理と競合する)
+        self._server.install_signal_handlers = lambda: None
+        self._task = asyncio.create_task(self._serve(sock))
+        logging.info(
+            Fore.GREEN
+            + f"Metrics are served on http://{self.host}:{self.port}/metrics"
+            + Style.RESET_ALL
+        )
+
+    async def stop(self):
+        if self._server:
+            self._server.should_exit = True
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._server = None
+        self._task = None
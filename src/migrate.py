@@ -0,0 +1,571 @@
+"""
+resumable, parallel migration of the legacy DynamoDB tables to the current storage.
+
+usage: python src/migrate.py --target dynamodb [--jobs tags notify] [--segments 4]
+       [--workers 8] [--page-size 500] [--checkpoint migrate_checkpoint.json]
+       [--create-tables] [--resolve-with-discord] [--drop-unresolved] [--verify-only]
+
+jobs:
+- tags: member_tagger_posts ({'member_id': str, thread_id: deadline, ...}) ->
+  TagStorage.put_tags. the legacy tags have no guild, so the guild of each tag is
+  resolved from the legacy notify table (the guilds whose member map has the member).
+  a member found in several guilds (or in none) is resolved with the Discord API
+  (GET /channels/{thread_id}, the bot token in DISCORD_BOT_TOKEN_MT) when
+  --resolve-with-discord is given. once verified, the target is marked as migrated
+  (the bot does not start on DynamoDB before that while member_tagger_posts exists).
+- notify: member_tagger_notify ({'guild_id': int, 'info': {member_id: bool}}) ->
+  NotifyStorage.set_guild_notify_states (rewriting a guild is idempotent).
+  skipped with --target dynamodb, where the target is member_tagger_notify itself.
+
+every source table is read with a parallel scan (--segments). each segment saves
+its last key, row count and checksum to the checkpoint file after every page, so an
+interrupted run continues from there when started again with the same checkpoint.
+tags whose guild could not be resolved are kept in the checkpoint and retried on
+the next run. a job is done only when every segment is scanned and no tag is left
+unresolved (--drop-unresolved gives up on them, logging each one).
+at the end every guild is read back from the target and compared by row count and
+checksum. the exit code is 1 if a source table cannot be read, a job is not done
+or the target does not match.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import decimal
+import hashlib
+import logging
+import argparse
+from abc import ABC, abstractmethod
+from typing import Any
+
+import discord
+from colorama import Fore, Style
+
+from db_handler import DBHandler, MemberTaggerChangeLogDBHandler
+from snapshot import Snapshot
+from storage import get_notify_db, get_tag_db
+from utils import chunked
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_CHECKPOINT = "migrate_checkpoint.json"
+JOBS = ["tags", "notify"]
+
+
+def _checksum(rows: list[tuple]) -> int:
+    """order independent checksum: the sum of a 64bit hash of every row"""
+    total = 0
+    for row in rows:
+        digest = hashlib.sha256("|".join(map(str, row)).encode()).digest()
+        total += int.from_bytes(digest[:8], "big")
+    return total % 2**64
+
+
+def _json_default(value: Any) -> Any:
+    # DynamoDBのキーはDecimalで返ってくる
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class Checkpoint:
+    """
+    {'jobs': {job: {'total_segments': int, 'segments': {
+        segment: {'last_key': dict | None, 'scanned': bool, 'count': int,
+                  'checksum': int, 'unresolved': [[...], ...], 'dropped': int,
+                  'guilds': [int, ...]}}}}}
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data: dict = {"jobs": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def job(self, name: str, total_segments: int) -> dict:
+        """the state of a job. a saved job keeps the segment count it was started with"""
+        job = self.data["jobs"].setdefault(
+            name, {"total_segments": total_segments, "segments": {}}
+        )
+        for segment in range(job["total_segments"]):
+            job["segments"].setdefault(
+                str(segment),
+                {
+                    "last_key": None,
+                    "scanned": False,
+                    "count": 0,
+                    "checksum": 0,
+                    "unresolved": [],
+                    "dropped": 0,
+                    "guilds": [],
+                },
+            )
+        return job
+
+    def save(self):
+        # 途中で落ちても壊れたファイルが残らないように置き換える
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, default=_json_default)
+        os.replace(tmp_path, self.path)
+
+
+class DiscordThreadResolver:
+    """the guild of a thread, read with the Discord API (without connecting to the gateway)"""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.client = discord.Client(intents=discord.Intents.none())
+        self.guilds: dict[str, int | None] = {}
+
+    async def start(self):
+        await self.client.login(self.token)
+
+    async def close(self):
+        await self.client.close()
+
+    async def guild_of(self, thread_id: str) -> int | None:
+        """None if the thread was deleted or cannot be seen by the bot"""
+        if thread_id not in self.guilds:
+            try:
+                channel = await self.client.fetch_channel(int(thread_id))
+                self.guilds[thread_id] = channel.guild.id
+            except (discord.NotFound, discord.Forbidden):
+                self.guilds[thread_id] = None
+        return self.guilds[thread_id]
+
+
+class MigrationJob(ABC):
+    """a source table, how to turn its items into rows, and how to write them"""
+
+    name: str
+    source_table: str
+
+    def __init__(self, target, page_size: int):
+        self.target = target
+        self.page_size = page_size
+        self.source = DBHandler(self.source_table)
+
+    def in_place(self) -> bool:
+        """whether the target is the source table itself (there is nothing to migrate)"""
+        return getattr(self.target, "table_name", None) == self.source_table
+
+    async def prepare(self):
+        """read what transform needs. called once before migrating"""
+
+    @abstractmethod
+    async def transform(self, items: list[dict]) -> tuple[list[tuple], list[tuple]]:
+        """
+        return: (rows, unresolved). every row starts with guild_id.
+        unresolved values are saved in the checkpoint and passed to resolve later
+        """
+
+    async def resolve(self, unresolved: list[tuple]) -> tuple[list[tuple], list[tuple]]:
+        """retry values left unresolved by transform. return: (rows, still unresolved)"""
+        return [], unresolved
+
+    def chunks(self, rows: list[tuple], size: int) -> list[list[tuple]]:
+        """split rows into the units written in parallel"""
+        return chunked(rows, size)
+
+    @abstractmethod
+    async def write(self, rows: list[tuple]):
+        """raise on failure"""
+
+    @abstractmethod
+    async def read_target(self, guild_id: int) -> list[tuple]:
+        ...
+
+
+class TagsJob(MigrationJob):
+    name = "tags"
+    source_table = "member_tagger_posts"
+    notify_table = "member_tagger_notify"
+
+    def __init__(
+        self,
+        target,
+        page_size: int,
+        resolver: DiscordThreadResolver | None = None,
+    ):
+        super().__init__(target, page_size)
+        self.resolver = resolver
+        self.member_guilds: dict[str, set[int]] = {}  # member_id -> guild_ids
+
+    async def prepare(self):
+        # ページごとに読み、テーブル全体をメモリに持たない
+        async for _, items, _ in DBHandler(self.notify_table).parallel_scan_pages(
+            page_size=self.page_size
+        ):
+            for item in items:
+                for member_id in item.get("info") or {}:
+                    self.member_guilds.setdefault(str(member_id), set()).add(
+                        int(item["guild_id"])
+                    )
+        logging.info(
+            f"tags: read the guilds of {len(self.member_guilds)} members "
+            f"from {self.notify_table}"
+        )
+
+    async def _guild_of(self, member_id: str, thread_id: str) -> int | None:
+        guilds = self.member_guilds.get(member_id, set())
+        if len(guilds) == 1:
+            return next(iter(guilds))
+        # 複数のguildにいる(またはどのguildにもいない)メンバーはthreadから決める
+        if self.resolver:
+            return await self.resolver.guild_of(thread_id)
+        return None
+
+    async def transform(self, items: list[dict]) -> tuple[list[tuple], list[tuple]]:
+        return await self.resolve(
+            [
+                (str(item["member_id"]), str(thread_id), deadline)
+                for item in items
+                for thread_id, deadline in item.items()
+                if thread_id != "member_id"
+            ]
+        )
+
+    async def resolve(self, unresolved: list[tuple]) -> tuple[list[tuple], list[tuple]]:
+        rows = []
+        left = []
+        for member_id, thread_id, deadline in unresolved:
+            guild_id = await self._guild_of(member_id, thread_id)
+            if guild_id is None:
+                left.append((member_id, thread_id, deadline))
+            else:
+                rows.append((guild_id, member_id, thread_id, deadline))
+        return rows, left
+
+    async def write(self, rows: list[tuple]):
+        result = await self.target.put_tags(
+            [
+                {
+                    "guild_id": guild_id,
+                    "member_id": member_id,
+                    "thread_id": thread_id,
+                    "deadline": deadline,
+                }
+                for guild_id, member_id, thread_id, deadline in rows
+            ]
+        )
+        if not result:
+            raise RuntimeError(f"put_tags failed for {len(rows)} rows")
+
+    async def read_target(self, guild_id: int) -> list[tuple]:
+        threads = await self.target.get_all_tagged_threads(guild_id)
+        return [
+            (guild_id, member_id, thread_id, deadline)
+            for member_id, tagged in threads.items()
+            for thread_id, deadline in tagged.items()
+        ]
+
+
+class NotifyJob(MigrationJob):
+    name = "notify"
+    source_table = "member_tagger_notify"
+
+    async def transform(self, items: list[dict]) -> tuple[list[tuple], list[tuple]]:
+        rows = [
+            (int(item["guild_id"]), str(member_id), bool(notify))
+            for item in items
+            for member_id, notify in (item.get("info") or {}).items()
+        ]
+        # メンバーのいないギルドも移す
+        rows.extend(
+            (int(item["guild_id"]), None, None)
+            for item in items
+            if not item.get("info")
+        )
+        return rows, []
+
+    def chunks(self, rows: list[tuple], size: int) -> list[list[tuple]]:
+        # ギルド単位で丸ごと書き換えるので、1つのギルドを分割しない
+        guilds: dict[int, list[tuple]] = {}
+        for row in rows:
+            guilds.setdefault(row[0], []).append(row)
+        return list(guilds.values())
+
+    async def write(self, rows: list[tuple]):
+        states: dict[int, dict[str, bool]] = {}
+        for guild_id, member_id, notify in rows:
+            guild_states = states.setdefault(guild_id, {})
+            if member_id is not None:
+                guild_states[member_id] = notify
+        for guild_id, guild_states in states.items():
+            if not await self.target.set_guild_notify_states(guild_id, guild_states):
+                raise RuntimeError(
+                    f"set_guild_notify_states failed for guild {guild_id}"
+                )
+
+    async def read_target(self, guild_id: int) -> list[tuple]:
+        states = await self.target.get_guild_notify_states(guild_id)
+        if not states:
+            return [(guild_id, None, None)]
+        return [(guild_id, member_id, notify) for member_id, notify in states.items()]
+
+
+class Migrator:
+    def __init__(
+        self,
+        checkpoint: Checkpoint,
+        segments: int = 4,
+        workers: int = 8,
+        chunk_size: int = 100,
+        drop_unresolved: bool = False,
+    ):
+        self.checkpoint = checkpoint
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.drop_unresolved = drop_unresolved
+        self.semaphore = asyncio.Semaphore(workers)
+
+    async def _write(self, job: MigrationJob, rows: list[tuple]):
+        async with self.semaphore:
+            await job.write(rows)
+
+    async def _apply(self, job: MigrationJob, progress: dict, rows: list[tuple]):
+        """write rows in parallel and add them to the progress (saved by the caller)"""
+        await asyncio.gather(
+            *[self._write(job, chunk) for chunk in job.chunks(rows, self.chunk_size)]
+        )
+        progress["count"] += len(rows)
+        progress["checksum"] = (progress["checksum"] + _checksum(rows)) % 2**64
+        progress["guilds"] = sorted(set(progress["guilds"]) | {row[0] for row in rows})
+
+    async def _retry_unresolved(self, job: MigrationJob, progress: dict):
+        rows, unresolved = await job.resolve(
+            [tuple(value) for value in progress["unresolved"]]
+        )
+        await self._apply(job, progress, rows)
+        progress["unresolved"] = unresolved
+        self.checkpoint.save()
+
+    async def migrate(self, job: MigrationJob):
+        state = self.checkpoint.job(job.name, self.segments)
+        total_segments = state["total_segments"]
+        pending = {
+            int(segment): progress
+            for segment, progress in state["segments"].items()
+            if not progress["scanned"] or progress["unresolved"]
+        }
+        if not pending:
+            logging.info(f"{job.name}: already migrated")
+            return
+        logging.info(
+            f"{job.name}: migrating {job.source_table} "
+            f"({len(pending)}/{total_segments} segments left)"
+        )
+        await job.prepare()
+        # 前回解決できなかった行から試す
+        await asyncio.gather(
+            *[
+                self._retry_unresolved(job, progress)
+                for progress in pending.values()
+                if progress["unresolved"]
+            ]
+        )
+        # 各セグメントは保存された最後のキーから読み直す
+        async for segment, items, last_key in job.source.parallel_scan_pages(
+            total_segments,
+            {
+                segment: progress["last_key"]
+                for segment, progress in pending.items()
+                if not progress["scanned"]
+            },
+            page_size=job.page_size,
+        ):
+            progress = pending[segment]
+            rows, unresolved = await job.transform(items)
+            # ページ内は並列に書き込み、全部終わってから進捗を保存する
+            await self._apply(job, progress, rows)
+            progress["unresolved"] = progress["unresolved"] + unresolved
+            progress["last_key"] = last_key
+            progress["scanned"] = last_key is None
+            self.checkpoint.save()
+        if self.drop_unresolved:
+            for progress in pending.values():
+                for value in progress["unresolved"]:
+                    logging.warning(f"{job.name}: dropped unresolved {list(value)}")
+                progress["dropped"] += len(progress["unresolved"])
+                progress["unresolved"] = []
+            self.checkpoint.save()
+        totals = self.totals(job)
+        logging.info(
+            f"{job.name}: wrote {totals['count']} rows of {len(totals['guilds'])} guilds "
+            f"({len(totals['unresolved'])} unresolved, {totals['dropped']} dropped)"
+        )
+
+    def totals(self, job: MigrationJob) -> dict:
+        state = self.checkpoint.job(job.name, self.segments)
+        segments = state["segments"].values()
+        unresolved = [
+            value for progress in segments for value in progress["unresolved"]
+        ]
+        return {
+            "done": all(progress["scanned"] for progress in segments)
+            and not unresolved,
+            "count": sum(progress["count"] for progress in segments),
+            "checksum": sum(progress["checksum"] for progress in segments) % 2**64,
+            "unresolved": unresolved,
+            "dropped": sum(progress["dropped"] for progress in segments),
+            "guilds": sorted(
+                {guild for progress in segments for guild in progress["guilds"]}
+            ),
+        }
+
+    async def verify(self, job: MigrationJob) -> bool:
+        """compare the row count and checksum of the target with the checkpoint"""
+        totals = self.totals(job)
+        if totals["unresolved"]:
+            logging.error(
+                Fore.RED
+                + f"{job.name}: {len(totals['unresolved'])} rows could not be resolved "
+                + f"(e.g. {totals['unresolved'][:5]}). run again with "
+                + "--resolve-with-discord, or --drop-unresolved to give up on them"
+                + Style.RESET_ALL
+            )
+            return False
+        if not totals["done"]:
+            logging.error(
+                Fore.RED
+                + f"{job.name}: not migrated yet, run without --verify-only"
+                + Style.RESET_ALL
+            )
+            return False
+        # キャッシュではなく書き込まれた内容を読む
+        if hasattr(job.target, "invalidate_cache"):
+            job.target.invalidate_cache()
+        count = 0
+        checksum = 0
+        for guild_id in totals["guilds"]:
+            rows = await job.read_target(guild_id)
+            count += len(rows)
+            checksum = (checksum + _checksum(rows)) % 2**64
+        if count == totals["count"] and checksum == totals["checksum"]:
+            logging.info(
+                Fore.GREEN
+                + f"{job.name}: verified {count} rows of {len(totals['guilds'])} guilds"
+                + Style.RESET_ALL
+            )
+            return True
+        logging.error(
+            Fore.RED + f"{job.name}: mismatch, source {totals['count']} rows "
+            f"(checksum {totals['checksum']}), target {count} rows (checksum {checksum})"
+            + Style.RESET_ALL
+        )
+        return False
+
+
+async def run(args: argparse.Namespace) -> bool:
+    # バックエンドはget_tag_db/get_notify_dbの初回呼び出し時に決まる
+    os.environ["STORAGE_BACKEND"] = args.target
+    targets = {"tags": get_tag_db(), "notify": get_notify_db()}
+    migrator = Migrator(
+        Checkpoint(args.checkpoint),
+        args.segments,
+        args.workers,
+        args.chunk_size,
+        args.drop_unresolved,
+    )
+    resolver = None
+    try:
+        if args.resolve_with_discord:
+            token = os.getenv("DISCORD_BOT_TOKEN_MT")
+            if not token:
+                logging.error(
+                    Fore.RED
+                    + "--resolve-with-discord needs DISCORD_BOT_TOKEN_MT"
+                    + Style.RESET_ALL
+                )
+                return False
+            resolver = DiscordThreadResolver(token)
+            await resolver.start()
+        if args.create_tables and hasattr(targets["tags"], "create_table_if_missing"):
+            await targets["tags"].create_table_if_missing()
+            # 変更ログはスナップショットを使う場合だけ作る
+            if Snapshot.supports(targets["tags"]):
+                await MemberTaggerChangeLogDBHandler().create_table_if_missing()
+        jobs = {
+            "tags": lambda: TagsJob(targets["tags"], args.page_size, resolver),
+            "notify": lambda: NotifyJob(targets["notify"], args.page_size),
+        }
+        ok = True
+        for name in args.jobs:
+            job = jobs[name]()
+            # 稼働中のbotの書き込みを古い内容で上書きしないように、同じテーブルには書き戻さない
+            if job.in_place():
+                logging.info(
+                    f"{job.name}: the target is {job.source_table} itself, skipped"
+                )
+                continue
+            try:
+                if not args.verify_only:
+                    await migrator.migrate(job)
+                verified = await migrator.verify(job)
+                # 移行を終えるまでbotは起動しない(MemberTaggerDBHandler.check_migrated)
+                if verified and hasattr(job.target, "mark_migrated"):
+                    verified = await job.target.mark_migrated()
+                ok = verified and ok
+            except Exception as e:
+                # 読めない元テーブルなどは、移行済みにせずに失敗にする
+                logging.error(
+                    Fore.RED
+                    + f"{job.name}: failed: {e.__class__.__name__} {e}"
+                    + Style.RESET_ALL
+                )
+                ok = False
+        return ok
+    finally:
+        if resolver:
+            await resolver.close()
+        for target in targets.values():
+            await target.close()
+        await DBHandler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="migrate the legacy DynamoDB tables to the current storage"
+    )
+    parser.add_argument(
+        "--target",
+        choices=["dynamodb", "sqlite", "memory"],
+        default=os.getenv("STORAGE_BACKEND", "dynamodb"),
+    )
+    parser.add_argument("--jobs", nargs="+", choices=JOBS, default=JOBS)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument(
+        "--create-tables",
+        action="store_true",
+        help="create member_tagger_tags and member_tagger_changes if they do not exist (dynamodb)",
+    )
+    parser.add_argument(
+        "--resolve-with-discord",
+        action="store_true",
+        help="resolve the guild of the tags the notify table cannot with the Discord API (DISCORD_BOT_TOKEN_MT)",
+    )
+    parser.add_argument(
+        "--drop-unresolved",
+        action="store_true",
+        help="give up on the tags whose guild cannot be resolved (each one is logged)",
+    )
+    parser.add_argument(
+        "--verify-only", action="store_true", help="only compare the target"
+    )
+    args = parser.parse_args()
+
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import asyncio
+import logging
+
+import discord
+from colorama import Fore, Style
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class NotifyDispatcher:
+    """
+    send notify messages to many threads concurrently.
+
+    at most `concurrency` sends run at the same time (shared by every caller of the
+    instance). discord.py already waits for the per-route rate limit buckets, so
+    each thread is only retried here when the send still fails with a rate limit
+    or a server error. permanent errors (Forbidden, NotFound, ...) are not retried.
+    """
+
+    def __init__(self, concurrency: int | None = None, max_retries: int = 3):
+        self.concurrency = (
+            concurrency if concurrency else int(os.getenv("NOTIFY_CONCURRENCY", "10"))
+        )
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def dispatch(
+        self,
+        contents: list[
+            tuple[discord.Thread | discord.TextChannel, dict[str, discord.Embed | str]]
+        ],
+    ) -> list[
+        dict[str, discord.Thread | discord.TextChannel | bool | int | str | None]
+    ]:
+        """
+        contents: [(thread, {'embed': embed, 'message': message}), ...]
+        return: [{'thread': thread, 'sent': bool, 'attempts': int, 'error': str | None}, ...]
+        """
+        return await asyncio.gather(
+            *[self._send(thread, content) for thread, content in contents]
+        )
+
+    async def _send(
+        self,
+        thread: discord.Thread | discord.TextChannel,
+        content: dict[str, discord.Embed | str],
+    ) -> dict[str, discord.Thread | discord.TextChannel | bool | int | str | None]:
+        error = None
+        for attempt in range(1, self.max_retries + 2):
+            async with self._semaphore:
+                try:
+                    await thread.send(
+                        content=content["message"], embed=content["embed"]
+                    )
+                    return {
+                        "thread": thread,
+                        "sent": True,
+                        "attempts": attempt,
+                        "error": None,
+                    }
+                except discord.RateLimited as e:
+                    error = e
+                    delay = e.retry_after
+                except discord.HTTPException as e:
+                    error = e
+                    if e.status != 429 and e.status < 500:
+                        break
+                    delay = 2**attempt
+                except (asyncio.TimeoutError, OSError) as e:
+                    error = e
+                    delay = 2**attempt
+            # 待機中はsemaphoreを解放して、他のthreadへの送信を進める
+            if attempt <= self.max_retries:
+                await asyncio.sleep(delay)
+
+        logging.error(
+            Fore.RED
+            + f"Failed to notify in {thread.name} ({thread.id}): {error}"
+            + Style.RESET_ALL
+        )
+        return {
+            "thread": thread,
+            "sent": False,
+            "attempts": attempt,
+            "error": str(error),
+        }
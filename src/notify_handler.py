@@ -1,82 +1,117 @@
+import asyncio
 import datetime
 import logging
 
 import discord
 from colorama import Fore, Style
 
-from db_handler import MemberTaggerNotifyDBHandler, MemberTaggerDBHandler
-from utils import SingletonMeta
+from notify_dispatcher import NotifyDispatcher
+from storage import NotifyStorage, TagStorage, get_notify_db, get_tag_db
 
 
 logging.basicConfig(level=logging.INFO)
 
 
-class NotifyHandler(metaclass=SingletonMeta):
+class NotifyHandler:
+    """
+    notify context of one guild. create one per guild (and per run) instead of
+    reassigning guild, so that runs for different guilds never interfere.
+    pass db/tag_db/dispatcher to share them between contexts.
+    """
+
     def __init__(
         self,
-        guild: discord.Guild | None = None,
-        interaction: discord.Interaction | None = None,
+        guild: discord.Guild,
+        db: NotifyStorage | None = None,
+        tag_db: TagStorage | None = None,
+        dispatcher: NotifyDispatcher | None = None,
     ):
-        if guild or interaction:
-            self.guild = guild if guild else interaction.guild
+        self._guild = guild
+        self.db = db if db else get_notify_db()
+        self.tag_db = tag_db if tag_db else get_tag_db()
+        self.dispatcher = dispatcher if dispatcher else NotifyDispatcher()
 
-        self._interaction = interaction  # it wont be used
-        self.db = MemberTaggerNotifyDBHandler()
-        self.tag_db = MemberTaggerDBHandler()
+    @property
+    def guild(self) -> discord.Guild:
+        return self._guild
 
     # 期限が過ぎたスレッドをDBから削除する
     async def _delete_threads_past_deadline(self):
         if not self.guild:
             raise ValueError("guild is not set")
 
+        # 期限が昨日以前のものを、期限順のindexから一度に取得する
         timezone = datetime.timezone(datetime.timedelta(hours=9))
-        now = datetime.datetime.now(timezone)
-        threads = await self.fetch_tagged_threads()
+        yesterday = datetime.datetime.now(timezone).date() - datetime.timedelta(days=1)
+        threads = await self.tag_db.get_due_threads(
+            self.guild.id, yesterday.strftime("%Y-%m-%d")
+        )
         for member_id, thread_dict in threads.items():
-            for thread_id, deadline in thread_dict.items():
-                deadline = datetime.datetime.strptime(deadline, "%Y-%m-%d").replace(
-                    tzinfo=timezone
+            await self.tag_db.untag_threads(self.guild.id, member_id, list(thread_dict))
+            for thread_id in thread_dict:
+                logging.info(
+                    Fore.GREEN
+                    + thread_id
+                    + Style.RESET_ALL
+                    + "has been deleted from"
+                    + Fore.BLUE
+                    + member_id
+                    + Style.RESET_ALL
                 )
-                deadline = deadline.replace(day=deadline.day + 1)
-                if deadline < now:
-                    self.tag_db.untag_member(member_id, thread_id)
-                    logging.info(
-                        Fore.GREEN
-                        + thread_id
-                        + Style.RESET_ALL
-                        + "has been deleted from"
-                        + Fore.BLUE
-                        + member_id
-                        + Style.RESET_ALL
-                    )
 
     # 現在参加しているguildとそのメンバーをDBに同期する
-    async def notify_member_db_sync(self) -> bool:
+    async def notify_member_db_sync(self) -> dict[str, int]:
+        """return: {'added': int, 'removed': int, 'unchanged': int}"""
         if not self.guild:
             raise ValueError("guild is not set")
 
-        if not self.guild.id in self.db.get_guilds():
-            self.db.set_guild_id(self.guild.id)
-
         await self._delete_threads_past_deadline()
 
-        members = self.guild.members
-
-        for member in members:
-            if not self.db.get_notify_state(self.guild.id, member.id):
-                self.db.set_notify_state(self.guild.id, member.id, True)
-        return True if members == self.db.get_members(self.guild.id) else False
+        # メンバーの取得(chunk)が終わっていなければ一部しか見えないので、誰も削除しない
+        if not self.guild.chunked:
+            logging.warning(
+                Fore.YELLOW
+                + f"Members of {self.guild.name} ({self.guild.id}) are not fully "
+                + "loaded yet, keeping the settings of members who are not seen"
+                + Style.RESET_ALL
+            )
+        result = await self.db.sync_members(
+            self.guild.id,
+            [member.id for member in self.guild.members],
+            remove_missing=self.guild.chunked,
+        )
+        logging.info(
+            Fore.GREEN
+            + f"Synced members of {self.guild.name} ({self.guild.id}): "
+            + f"{result['added']} added, {result['removed']} removed, {result['unchanged']} unchanged"
+            + Style.RESET_ALL
+        )
+        return result
 
     async def fetch_tagged_threads(self) -> dict[str, dict[str, str]]:
+        """the guild's tags are read with one query"""
         if not self.guild:
             raise ValueError("guild is not set")
 
         # データを取得して、{member_id: {thread_id: deadline}}の形式で返す
-        member_ids = self.db.get_members(self.guild.id)
-        threads = {}
-        for member_id in member_ids:
-            threads[member_id] = self.tag_db.get_tagged_threads(member_id)
-        return threads
+        member_ids = await self.db.get_members(self.guild.id)
+        all_threads = await self.tag_db.get_all_tagged_threads(self.guild.id)
+        return {member_id: all_threads.get(member_id, {}) for member_id in member_ids}
+
+    async def fetch_due_threads(self, max_days: int) -> dict[str, dict[str, str]]:
+        """
+        tags of the guild due today to max_days days later (JST), read with one range query.
+        return: {member_id: {thread_id: deadline}}
+        """
+        if not self.guild:
+            raise ValueError("guild is not set")
+
+        timezone = datetime.timezone(datetime.timedelta(hours=9))  # JST
+        today = datetime.datetime.now(timezone).date()
+        end = today + datetime.timedelta(days=max_days)
+        return await self.tag_db.get_due_threads(
+            self.guild.id, end.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")
+        )
 
     async def convert_tagged_threads(
         self, threads: dict[str, dict[str, str]]
@@ -102,13 +137,13 @@ class NotifyHandler(metaclass=SingletonMeta):
                     if deadline
                     else None
                 )
-                if not thread:
+                # 削除されたthreadや、guildを抜けたメンバーのタグは通知しない
+                member = self.guild.get_member(int(member_id))
+                if not thread or not member:
                     continue
                 if thread not in converted:
                     converted[thread] = {"members": [], "deadline": deadline}
-                converted[thread]["members"].append(
-                    self.guild.get_member(int(member_id))
-                )
+                converted[thread]["members"].append(member)
         return converted
 
     # TODO: 型エイリアスを使って、型を簡潔に表現するようにする
@@ -145,15 +180,34 @@ class NotifyHandler(metaclass=SingletonMeta):
         if not self.guild:
             raise ValueError("guild is not set")
 
-        await self.notify_member_db_sync()
-        threads = await self.fetch_tagged_threads()
-        converted = await self.convert_tagged_threads(threads)
-        refined = await self.refine_threads(converted)
         if isinstance(target_days, int):
             target_days = [target_days]
-        for days in target_days:
-            data = refined[days]
-            await self._notify_for_one_channel(days, data)
+
+        try:
+            await self.notify_member_db_sync()
+        except Exception as e:
+            # 通知はタグだけから組み立てるので、同期できなくても続ける
+            logging.error(
+                Fore.RED
+                + f"Error syncing members of {self.guild.name}: {e}"
+                + Style.RESET_ALL
+            )
+        threads = await self.fetch_due_threads(max(target_days))
+        converted = await self.convert_tagged_threads(threads)
+        refined = await self.refine_threads(converted)
+        # 全ての日数分をまとめて並行に送信する
+        reports = await asyncio.gather(
+            *[self._notify_for_one_channel(days, refined[days]) for days in target_days]
+        )
+        report = [result for results in reports for result in results]
+        failed = [result for result in report if not result["sent"]]
+        if failed:
+            logging.warning(
+                Fore.RED
+                + f"{len(failed)}/{len(report)} notifications failed in {self.guild.name}"
+                + Style.RESET_ALL
+            )
+        return report
 
     async def notify_now_to_channel(
         self,
@@ -164,7 +218,7 @@ class NotifyHandler(metaclass=SingletonMeta):
             raise ValueError("guild is not set")
 
         await self.notify_member_db_sync()
-        threads = await self.fetch_tagged_threads()
+        threads = await self.fetch_due_threads(5)
         converted = await self.convert_tagged_threads(threads)
         refined = await self.refine_threads(converted)
 
@@ -237,7 +291,6 @@ class NotifyHandler(metaclass=SingletonMeta):
                 ),
             )
 
-    # 呼び出す側がループを回す
     async def _notify_for_one_channel(
         self,
         days: int,
@@ -245,25 +298,48 @@ class NotifyHandler(metaclass=SingletonMeta):
             discord.Thread | discord.TextChannel,
             dict[str, list[discord.Member] | datetime.datetime],
         ],
-    ) -> dict[str, discord.Embed | str]:
-        try:
-            for thread, data in data.items():
-                content = await self._get_notify_content(days, data)
-                embed = content["embed"]
-                message = content["message"]
-                await thread.send(content=message, embed=embed)
-                sent_members = ", ".join([member.name for member in data["members"]])
-                logging.info(
-                    Fore.GREEN
-                    + sent_members
-                    + Style.RESET_ALL
-                    + "has been notified in"
-                    + Fore.BLUE
-                    + thread.name
+    ) -> list[
+        dict[str, discord.Thread | discord.TextChannel | bool | int | str | None]
+    ]:
+        """
+        return: the report of NotifyDispatcher.dispatch
+        (a thread whose content could not be built is reported as not sent)
+        """
+        contents = []
+        failed = []
+        for thread, thread_data in data.items():
+            # 1つのthreadの失敗で、guild全体の通知を止めない
+            try:
+                contents.append(
+                    (thread, await self._get_notify_content(days, thread_data))
+                )
+            except Exception as e:
+                logging.error(
+                    Fore.RED
+                    + f"Failed to build the notification for {thread.name} ({thread.id}): {e}"
                     + Style.RESET_ALL
                 )
-        except Exception as e:
-            logging.error(e)
+                failed.append(
+                    {"thread": thread, "sent": False, "attempts": 0, "error": str(e)}
+                )
+        report = await self.dispatcher.dispatch(contents) + failed
+        for result in report:
+            if not result["sent"]:
+                continue
+            thread = result["thread"]
+            sent_members = ", ".join(
+                [member.name for member in data[thread]["members"] if member]
+            )
+            logging.info(
+                Fore.GREEN
+                + sent_members
+                + Style.RESET_ALL
+                + "has been notified in"
+                + Fore.BLUE
+                + thread.name
+                + Style.RESET_ALL
+            )
+        return report
 
     # 呼び出す側がループを回す
     async def _get_notify_content(
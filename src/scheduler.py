@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import datetime
+import logging
+from typing import Awaitable, Callable
+
+from colorama import Fore, Style
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def next_jst_midnight(after: datetime.datetime) -> datetime.datetime:
+    """the first 0:00 (JST) strictly after `after`"""
+    date = after.astimezone(JST).date() + datetime.timedelta(days=1)
+    return datetime.datetime.combine(date, datetime.time(0, 0), tzinfo=JST)
+
+
+class ReminderScheduler:
+    """
+    runs recurring jobs from a min-heap of (fire_at, job name).
+
+    the next fire time of every job is saved to a json file, so a restart keeps the
+    schedule: a fire time that passed while the bot was down fires once right after
+    start, and the job then continues from its normal schedule.
+    the next fire time is saved before the job runs, so a due reminder never fires
+    twice (even if on_ready calls start() again).
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = (
+            path if path else os.getenv("SCHEDULER_STATE_PATH", "scheduler_state.json")
+        )
+        self._heap: list[tuple[float, str]] = []
+        self._jobs: dict[
+            str,
+            tuple[
+                Callable[[], Awaitable[None]],
+                Callable[[datetime.datetime], datetime.datetime],
+            ],
+        ] = {}
+        self._fire_at: dict[str, float] = {}
+        self._saved = self._load()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+
+    def _load(self) -> dict[str, float]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return {name: float(fire_at) for name, fire_at in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"Error loading scheduler state: {e}")
+            return {}
+
+    def _save(self):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self._fire_at, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving scheduler state: {e}")
+
+    def add_job(
+        self,
+        name: str,
+        callback: Callable[[], Awaitable[None]],
+        next_time: Callable[[datetime.datetime], datetime.datetime],
+    ):
+        """
+        next_time(after) returns the first fire time after `after` (e.g. next_jst_midnight).
+        """
+        self._jobs[name] = (callback, next_time)
+        fire_at = self._saved.get(name)
+        if fire_at is None:
+            fire_at = next_time(datetime.datetime.now(JST)).timestamp()
+        self._schedule(name, fire_at)
+
+    def _schedule(self, name: str, fire_at: float):
+        self._fire_at[name] = fire_at
+        heapq.heappush(self._heap, (fire_at, name))
+        self._save()
+        self._wakeup.set()
+        logging.info(
+            Fore.GREEN
+            + f"{name} is scheduled at "
+            + Fore.LIGHTMAGENTA_EX
+            + datetime.datetime.fromtimestamp(fire_at, JST).strftime(
+                "%Y/%m/%d %H:%M:%S"
+            )
+            + Style.RESET_ALL
+        )
+
+    def start(self):
+        """start the scheduler loop. does nothing if it is already running"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            fire_at, name = self._heap[0]
+            # 古いエントリ(再スケジュール済み)は捨てる
+            if self._fire_at.get(name) != fire_at:
+                heapq.heappop(self._heap)
+                continue
+
+            delay = fire_at - time.time()
+            if delay > 0:
+                # 次のリマインダーまで(もしくは新しいジョブが追加されるまで)眠る
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            heapq.heappop(self._heap)
+            callback, next_time = self._jobs[name]
+            # 実行前に次回の時刻を保存して、同じリマインダーが二度発火しないようにする
+            now = datetime.datetime.now(JST)
+            after = max(datetime.datetime.fromtimestamp(fire_at, JST), now)
+            self._schedule(name, next_time(after).timestamp())
+            task = asyncio.create_task(self._fire(name, callback))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, name: str, callback: Callable[[], Awaitable[None]]):
+        logging.info(Fore.GREEN + f"Running {name}" + Style.RESET_ALL)
+        try:
+            await callback()
+        except Exception as e:
+            logging.error(Fore.RED + f"{name} failed: {e}" + Style.RESET_ALL)
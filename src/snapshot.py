@@ -0,0 +1,374 @@
+"""
+a local snapshot of the tags and notify states of every guild, so that a restart
+does not read every guild from DynamoDB again.
+
+file layout (SNAPSHOT_PATH, default member_tagger_snapshot.bin):
+    MAGIC (8 bytes) | header length (8 bytes, big endian) | header (json) | sections
+    header: {'saved_at': float, 'guilds': {guild_id: {'offset': int, 'length': int,
+             'synced_at': float, 'built_at': float}}}
+    section (json, one per guild): {'tags': {member_id: {thread_id: deadline}},
+                                    'notify': {member_id: bool}}
+
+the file is mmapped and only the header is parsed on start. a section is decoded
+only when its guild is warmed or has changed, so the work before the bot is ready is
+bounded by SNAPSHOT_WARM_GUILDS (and the cache sizes), not by the size of the tables.
+
+every guild remembers when it was last synced (synced_at). catching up only reads
+the members recorded in member_tagger_changes since then (MemberTaggerChangeLogDBHandler).
+a guild is read again as a whole when it is not in the snapshot, when its changes
+may have expired from the log, or every SNAPSHOT_REBUILD_INTERVAL seconds
+(which also corrects changes whose log write failed).
+"""
+
+import os
+import json
+import mmap
+import time
+import asyncio
+import datetime
+import logging
+
+from colorama import Fore, Style
+
+from storage import NotifyStorage, TagStorage
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+MAGIC = b"MTSNAP1\n"
+# 複数のプロセスの時計のずれと、変更ログより後に完了した書き込みを拾うための余裕
+CLOCK_MARGIN = 60.0
+
+
+class Snapshot:
+    """
+    SNAPSHOT_INTERVAL: seconds between refreshes (0 disables the snapshot)
+    SNAPSHOT_WARM_GUILDS: how many guilds are warmed on start
+    SNAPSHOT_REBUILD_INTERVAL: seconds after which a guild is read again as a whole
+    """
+
+    interval = float(os.getenv("SNAPSHOT_INTERVAL", "600"))
+    warm_guilds = int(os.getenv("SNAPSHOT_WARM_GUILDS", "256"))
+    rebuild_interval = float(os.getenv("SNAPSHOT_REBUILD_INTERVAL", "86400"))
+    concurrency = int(os.getenv("SNAPSHOT_CONCURRENCY", "10"))
+
+    def __init__(
+        self, tag_db: TagStorage, notify_db: NotifyStorage, path: str | None = None
+    ):
+        # 変更ログはDynamoDBのバックエンドでだけ使うので、ここで読み込む
+        from db_handler import MemberTaggerChangeLogDBHandler
+
+        self.path = (
+            path if path else os.getenv("SNAPSHOT_PATH", "member_tagger_snapshot.bin")
+        )
+        self.tag_db = tag_db
+        self.notify_db = notify_db
+        self.change_log = MemberTaggerChangeLogDBHandler()
+        # guild_id -> {'offset', 'length', 'synced_at', 'built_at'}
+        # offset/lengthはmmap中のsectionの位置(decodedにあるguildでは使わない)
+        self._entries: dict[int, dict[str, int | float]] = {}
+        # 読み直したり変更を反映したりしたguildのsection
+        self._decoded: dict[int, dict[str, dict]] = {}
+        self._file = None
+        self._mmap: mmap.mmap | None = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def supports(tag_db: TagStorage) -> bool:
+        """
+        only the DynamoDB backend keeps a change log (sqlite is already local).
+        the log is written only after enable()
+        """
+        return Snapshot.interval > 0 and hasattr(tag_db, "change_log")
+
+    @staticmethod
+    def discard(path: str | None = None):
+        """
+        remove the snapshot file. call on start when the snapshot is not used:
+        changes made meanwhile are not logged, so the file could not catch up later
+        """
+        path = (
+            path if path else os.getenv("SNAPSHOT_PATH", "member_tagger_snapshot.bin")
+        )
+        try:
+            os.remove(path)
+            logging.info(
+                Fore.YELLOW + f"Removed unused snapshot {path}" + Style.RESET_ALL
+            )
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Error removing snapshot {path}: {e}")
+
+    async def enable(self) -> bool:
+        """
+        start logging the changes of tag_db and notify_db. call once on start.
+        return: False if member_tagger_changes does not exist (nothing is logged then)
+        """
+        if not await self.change_log.table_exists():
+            logging.warning(
+                Fore.YELLOW
+                + f"{self.change_log.table_name} does not exist, the snapshot is disabled. "
+                + "create it with python src/migrate.py --create-tables"
+                + Style.RESET_ALL
+            )
+            return False
+        self.tag_db.change_log = self.change_log
+        self.notify_db.change_log = self.change_log
+        return True
+
+    def next_time(self, after: datetime.datetime) -> datetime.datetime:
+        """for ReminderScheduler.add_job"""
+        return after + datetime.timedelta(seconds=self.interval)
+
+    ############## file ##############
+
+    def _open(self) -> bool:
+        """mmap the file and parse its header. return: False if there is no usable file"""
+        self._close_file()
+        self._entries = {}
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        try:
+            if os.fstat(file.fileno()).st_size < len(MAGIC) + 8:
+                raise ValueError("the file is too short")
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapped[: len(MAGIC)] != MAGIC:
+                mapped.close()
+                raise ValueError("unknown format")
+            header_end = (
+                len(MAGIC)
+                + 8
+                + int.from_bytes(mapped[len(MAGIC) : len(MAGIC) + 8], "big")
+            )
+            header = json.loads(mapped[len(MAGIC) + 8 : header_end])
+        except Exception as e:
+            file.close()
+            logging.error(f"Error loading snapshot {self.path}: {e}")
+            return False
+        self._file = file
+        self._mmap = mapped
+        self._entries = {
+            int(guild_id): {**entry, "offset": entry["offset"] + header_end}
+            for guild_id, entry in header["guilds"].items()
+        }
+        return True
+
+    def _close_file(self):
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _section(self, guild_id: int) -> dict[str, dict] | None:
+        if guild_id in self._decoded:
+            return self._decoded[guild_id]
+        entry = self._entries.get(guild_id)
+        if entry is None or self._mmap is None:
+            return None
+        section = json.loads(
+            self._mmap[entry["offset"] : entry["offset"] + entry["length"]]
+        )
+        self._decoded[guild_id] = section
+        return section
+
+    def _write(self):
+        """write every guild to a temporary file and replace the snapshot with it"""
+        encoded = {
+            guild_id: json.dumps(section, separators=(",", ":")).encode()
+            for guild_id, section in self._decoded.items()
+            if guild_id in self._entries
+        }
+        guilds = {}
+        offset = 0
+        for guild_id, entry in self._entries.items():
+            length = len(encoded[guild_id]) if guild_id in encoded else entry["length"]
+            guilds[str(guild_id)] = {
+                "offset": offset,
+                "length": length,
+                "synced_at": entry["synced_at"],
+                "built_at": entry["built_at"],
+            }
+            offset += length
+        header = json.dumps({"saved_at": time.time(), "guilds": guilds}).encode()
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "big"))
+            f.write(header)
+            for guild_id, entry in self._entries.items():
+                if guild_id in encoded:
+                    f.write(encoded[guild_id])
+                else:
+                    # 変更のないguildは古いファイルからそのままコピーする
+                    f.write(
+                        self._mmap[entry["offset"] : entry["offset"] + entry["length"]]
+                    )
+        os.replace(tmp_path, self.path)
+        self._decoded.clear()
+        # 古いmmapは_openで閉じる
+        self._open()
+
+    async def save(self):
+        """save the current state (no DB access). call on shutdown"""
+        async with self._lock:
+            if not self._entries:
+                return
+            try:
+                await asyncio.to_thread(self._write)
+            except Exception as e:
+                logging.error(f"Error saving snapshot {self.path}: {e}")
+
+    def close(self):
+        self._close_file()
+
+    ############## sync ##############
+
+    def _expired(self, entry: dict[str, float], now: float) -> bool:
+        return (
+            now - entry["synced_at"] > self.change_log.ttl - CLOCK_MARGIN
+            or now - entry["built_at"] > self.rebuild_interval
+        )
+
+    async def _build(self, guild_id: int):
+        """read the whole guild"""
+        started = time.time()
+        # 他のプロセスの変更が残っているかもしれないので、キャッシュを使わずに読む
+        self.notify_db.invalidate_cache(guild_id)
+        self._decoded[guild_id] = {
+            "tags": await self.tag_db.get_all_tagged_threads(guild_id),
+            "notify": await self.notify_db.get_guild_notify_states(guild_id),
+        }
+        self._entries[guild_id] = {"synced_at": started, "built_at": started}
+
+    async def _catch_up(self, guild_id: int) -> bool:
+        """
+        re-read only the members (and notify states) changed since the last sync.
+        return: False if the change log could not be read
+        """
+        entry = self._entries[guild_id]
+        started = time.time()
+        changes = await self.change_log.get_changes(
+            guild_id, entry["synced_at"] - CLOCK_MARGIN
+        )
+        if changes is None:
+            return False
+        if changes["members"] or changes["notify"]:
+            section = self._section(guild_id)
+            for member_id in changes["members"]:
+                self.tag_db.invalidate_cache(guild_id, member_id)
+                threads = await self.tag_db.get_tagged_threads(guild_id, member_id)
+                if threads:
+                    section["tags"][member_id] = threads
+                else:
+                    section["tags"].pop(member_id, None)
+            if changes["notify"]:
+                self.notify_db.invalidate_cache(guild_id)
+                section["notify"] = await self.notify_db.get_guild_notify_states(
+                    guild_id
+                )
+        entry["synced_at"] = started
+        return True
+
+    async def _sync_guild(self, guild_id: int, semaphore: asyncio.Semaphore) -> str:
+        """return: 'built', 'caught_up' or 'failed'"""
+        async with semaphore:
+            entry = self._entries.get(guild_id)
+            try:
+                if entry is None or self._expired(entry, time.time()):
+                    await self._build(guild_id)
+                    return "built"
+                return "caught_up" if await self._catch_up(guild_id) else "failed"
+            except Exception as e:
+                logging.error(f"Error syncing snapshot of guild {guild_id}: {e}")
+                return "failed"
+
+    async def restore(self) -> dict[str, int]:
+        """
+        on start: load the snapshot, catch up at most warm_guilds guilds and put them
+        in the caches. other guilds are caught up by the next refresh.
+        return: {'guilds': int, 'warmed': int, 'members': int}
+        """
+        started = time.perf_counter()
+        async with self._lock:
+            if not self._open():
+                logging.info(
+                    Fore.YELLOW
+                    + f"No snapshot at {self.path}, starting cold"
+                    + Style.RESET_ALL
+                )
+                return {"guilds": 0, "warmed": 0, "members": 0}
+
+            now = time.time()
+            # 期限切れのguildは温めずに、次のrefreshで読み直す
+            guild_ids = [
+                guild_id
+                for guild_id, entry in self._entries.items()
+                if not self._expired(entry, now)
+            ][: self.warm_guilds]
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(
+                *[self._sync_guild(guild_id, semaphore) for guild_id in guild_ids]
+            )
+
+            warmed = 0
+            members = 0
+            for guild_id, result in zip(guild_ids, results):
+                if result != "caught_up":
+                    continue
+                section = self._section(guild_id)
+                if section["notify"] and self.notify_db.warm_cache(
+                    guild_id, section["notify"]
+                ):
+                    warmed += 1
+                members += self.tag_db.warm_cache(guild_id, section["tags"])
+
+        logging.info(
+            Fore.GREEN
+            + f"Restored snapshot of {len(self._entries)} guilds "
+            + f"({warmed} guilds, {members} members warmed) "
+            + f"in {time.perf_counter() - started:.2f}s"
+            + Style.RESET_ALL
+        )
+        return {"guilds": len(self._entries), "warmed": warmed, "members": members}
+
+    async def refresh(self, guild_ids: list[int]) -> dict[str, int]:
+        """
+        catch up every guild (reading new or expired guilds as a whole),
+        drop guilds not in guild_ids and save.
+        return: {'built': int, 'caught_up': int, 'failed': int}
+        """
+        started = time.perf_counter()
+        guild_ids = [int(guild_id) for guild_id in guild_ids]
+        async with self._lock:
+            for guild_id in self._entries.keys() - set(guild_ids):
+                del self._entries[guild_id]
+                self._decoded.pop(guild_id, None)
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(
+                *[self._sync_guild(guild_id, semaphore) for guild_id in guild_ids]
+            )
+            counts = {
+                status: results.count(status)
+                for status in ("built", "caught_up", "failed")
+            }
+            try:
+                await asyncio.to_thread(self._write)
+            except Exception as e:
+                logging.error(f"Error saving snapshot {self.path}: {e}")
+
+        logging.info(
+            Fore.GREEN
+            + f"Refreshed snapshot of {len(guild_ids)} guilds "
+            + f"({counts['built']} built, {counts['caught_up']} caught up, "
+            + f"{counts['failed']} failed) in {time.perf_counter() - started:.2f}s"
+            + Style.RESET_ALL
+        )
+        return counts
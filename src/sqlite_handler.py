@@ -0,0 +1,492 @@
+import os
+import asyncio
+import logging
+import sqlite3
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from storage import NotifyStorage, TagStorage
+
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class SQLiteHandler:
+    """
+    local storage for small deployments.
+
+    the database runs in WAL mode, so reads do not wait for writes. every query runs
+    on a small thread pool (never on the event loop) and each worker thread keeps its
+    own connection.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS guild_tags (
+        guild_id INTEGER NOT NULL,
+        member_id TEXT NOT NULL,
+        thread_id TEXT NOT NULL,
+        deadline TEXT,
+        PRIMARY KEY (guild_id, member_id, thread_id)
+    );
+    CREATE INDEX IF NOT EXISTS guild_tags_thread ON guild_tags (guild_id, thread_id);
+    CREATE INDEX IF NOT EXISTS guild_tags_deadline ON guild_tags (guild_id, deadline);
+
+    CREATE TABLE IF NOT EXISTS guilds (
+        guild_id INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS notify (
+        guild_id INTEGER NOT NULL,
+        member_id TEXT NOT NULL,
+        notify INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, member_id)
+    );
+    """
+
+    path = os.getenv("SQLITE_PATH", "member_tagger.db")
+    max_workers = int(os.getenv("SQLITE_MAX_WORKERS", "4"))
+    _executor: ThreadPoolExecutor | None = None
+    _local = threading.local()
+    _connections: list[sqlite3.Connection] = []
+    _connections_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(SQLiteHandler._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                SQLiteHandler.path, timeout=30, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with SQLiteHandler._connections_lock:
+                if not SQLiteHandler._connections:
+                    connection.executescript(self.schema)
+                    self._migrate_legacy_tags(connection)
+                SQLiteHandler._connections.append(connection)
+            SQLiteHandler._local.connection = connection
+        return connection
+
+    async def run(self, func: Callable[..., Any], *args, write: bool = False) -> Any:
+        """
+        run func(connection, *args) on the thread pool.
+        with write=True, func runs inside a BEGIN IMMEDIATE transaction.
+        """
+        if SQLiteHandler._executor is None:
+            SQLiteHandler._executor = ThreadPoolExecutor(
+                max_workers=SQLiteHandler.max_workers, thread_name_prefix="sqlite"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            SQLiteHandler._executor,
+            functools.partial(self._call, func, args, write),
+        )
+
+    def _call(self, func: Callable[..., Any], args: tuple, write: bool) -> Any:
+        connection = self._connect()
+        if not write:
+            return func(connection, *args)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(connection, *args)
+        except Exception:
+            connection.rollback()
+            raise
+        connection.commit()
+        return result
+
+    @staticmethod
+    def _migrate_legacy_tags(connection: sqlite3.Connection):
+        """
+        move the rows of the old tags table (guild_id was optional) to guild_tags.
+        rows without a guild cannot be read by guild, so they are kept in
+        tags_without_guild instead of being dropped.
+        """
+        if not connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tags'"
+        ).fetchone():
+            return
+        with connection:
+            moved = connection.execute(
+                """
+                INSERT OR IGNORE INTO guild_tags (guild_id, member_id, thread_id, deadline)
+                SELECT guild_id, member_id, thread_id, deadline FROM tags
+                WHERE guild_id IS NOT NULL
+                """
+            ).rowcount
+            connection.execute("DELETE FROM tags WHERE guild_id IS NOT NULL")
+            (left,) = connection.execute("SELECT COUNT(*) FROM tags").fetchone()
+            if left:
+                connection.execute("ALTER TABLE tags RENAME TO tags_without_guild")
+            else:
+                connection.execute("DROP TABLE tags")
+        logging.info(
+            f"Moved {moved} tags to guild_tags"
+            + (
+                f", {left} tags without a guild kept in tags_without_guild"
+                if left
+                else ""
+            )
+        )
+
+    @staticmethod
+    async def close():
+        """close the thread pool and every connection. call this once on shutdown."""
+        if SQLiteHandler._executor:
+            SQLiteHandler._executor.shutdown(wait=True)
+            SQLiteHandler._executor = None
+        with SQLiteHandler._connections_lock:
+            for connection in SQLiteHandler._connections:
+                connection.close()
+            SQLiteHandler._connections.clear()
+        SQLiteHandler._local = threading.local()
+
+
+class SQLiteMemberTaggerDBHandler(SQLiteHandler, TagStorage):
+    """
+    db architecture:
+    guild_tags(guild_id, member_id, thread_id, deadline)
+    indexes: (guild_id, member_id, thread_id), (guild_id, thread_id), (guild_id, deadline)
+    """
+
+    async def tag_member(
+        self, guild_id: int, member_id: str, thread_id: str, deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], [thread_id], deadline)
+
+    async def untag_member(self, guild_id: int, member_id: str, thread_id: str):
+        return await self.untag_members(guild_id, [member_id], [thread_id])
+
+    async def tag_threads(
+        self, guild_id: int, member_id: str, thread_ids: list[str], deadline: str
+    ):
+        return await self.tag_members(guild_id, [member_id], thread_ids, deadline)
+
+    async def untag_threads(self, guild_id: int, member_id: str, thread_ids: list[str]):
+        return await self.untag_members(guild_id, [member_id], thread_ids)
+
+    async def tag_members(
+        self,
+        guild_id: int,
+        member_ids: list[str],
+        thread_ids: list[str],
+        deadline: str,
+    ):
+        def tag(connection: sqlite3.Connection):
+            connection.executemany(
+                """
+                INSERT INTO guild_tags (guild_id, member_id, thread_id, deadline)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (guild_id, member_id, thread_id) DO UPDATE SET
+                    deadline = excluded.deadline
+                """,
+                [
+                    (int(guild_id), str(member_id), str(thread_id), deadline)
+                    for member_id in dict.fromkeys(member_ids)
+                    for thread_id in dict.fromkeys(thread_ids)
+                ],
+            )
+            return True
+
+        return await self.run(tag, write=True)
+
+    async def untag_members(
+        self, guild_id: int, member_ids: list[str], thread_ids: list[str]
+    ):
+        def untag(connection: sqlite3.Connection) -> bool:
+            connection.executemany(
+                """
+                DELETE FROM guild_tags
+                WHERE guild_id = ? AND member_id = ? AND thread_id = ?
+                """,
+                [
+                    (int(guild_id), str(member_id), str(thread_id))
+                    for member_id in dict.fromkeys(member_ids)
+                    for thread_id in dict.fromkeys(thread_ids)
+                ],
+            )
+            return True
+
+        return await self.run(untag, write=True)
+
+    async def put_tags(self, rows: list[dict[str, int | str]]) -> bool:
+        def put(connection: sqlite3.Connection):
+            connection.executemany(
+                """
+                INSERT INTO guild_tags (guild_id, member_id, thread_id, deadline)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (guild_id, member_id, thread_id) DO UPDATE SET
+                    deadline = excluded.deadline
+                """,
+                [
+                    (
+                        int(row["guild_id"]),
+                        str(row["member_id"]),
+                        str(row["thread_id"]),
+                        row["deadline"],
+                    )
+                    for row in rows
+                ],
+            )
+            return True
+
+        return await self.run(put, write=True)
+
+    async def get_tagged_threads(self, guild_id: int, member_id: str) -> dict[str, str]:
+        rows = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT thread_id, deadline FROM guild_tags
+                WHERE guild_id = ? AND member_id = ?
+                """,
+                (int(guild_id), str(member_id)),
+            ).fetchall()
+        )
+        return dict(rows)
+
+    async def get_tagged_members(
+        self, guild_id: int, thread_id: str
+    ) -> dict[str, str | int | list[str] | list[int]]:
+        rows = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT member_id, deadline FROM guild_tags
+                WHERE guild_id = ? AND thread_id = ?
+                """,
+                (int(guild_id), str(thread_id)),
+            ).fetchall()
+        )
+        return {
+            "ids": [member_id for member_id, _ in rows],
+            "deadline": rows[0][1] if rows else None,
+        }
+
+    async def get_deadline(
+        self, guild_id: int, member_id: str, thread_id: str
+    ) -> str | None:
+        row = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT deadline FROM guild_tags
+                WHERE guild_id = ? AND member_id = ? AND thread_id = ?
+                """,
+                (int(guild_id), str(member_id), str(thread_id)),
+            ).fetchone()
+        )
+        return row[0] if row else None
+
+    async def get_all_tagged_threads(self, guild_id: int) -> dict[str, dict[str, str]]:
+        """return: {member_id: {thread_id: deadline}} of the guild"""
+        rows = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT member_id, thread_id, deadline FROM guild_tags
+                WHERE guild_id = ?
+                """,
+                (int(guild_id),),
+            ).fetchall()
+        )
+        result = {}
+        for member_id, thread_id, deadline in rows:
+            result.setdefault(member_id, {})[thread_id] = deadline
+        return result
+
+    async def get_tagged_threads_page(
+        self, guild_id: int, cursor: str | None = None, limit: int = 10
+    ) -> dict[str, dict[str, dict[str, str]] | str | None]:
+        """
+        at most `limit` members of the guild in member_id order, starting after the member `cursor`.
+        return: {'items': {member_id: {thread_id: deadline}}, 'cursor': str | None}
+        """
+        rows = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT member_id, thread_id, deadline FROM guild_tags
+                WHERE guild_id = ? AND member_id IN (
+                    SELECT DISTINCT member_id FROM guild_tags
+                    WHERE guild_id = ? AND member_id > ? ORDER BY member_id LIMIT ?
+                )
+                ORDER BY member_id
+                """,
+                (int(guild_id), int(guild_id), cursor if cursor else "", limit + 1),
+            ).fetchall()
+        )
+        items = {}
+        for member_id, thread_id, deadline in rows:
+            items.setdefault(member_id, {})[thread_id] = deadline
+        # 1件多く読んで、次のページがあるかを判定する
+        if len(items) <= limit:
+            return {"items": items, "cursor": None}
+        items.pop(list(items)[-1])
+        return {"items": items, "cursor": list(items)[-1]}
+
+    async def get_due_threads(
+        self, guild_id: int, end: str, start: str | None = None
+    ) -> dict[str, dict[str, str]]:
+        """
+        tags of the guild whose deadline is between start and end ('YYYY-MM-DD', inclusive).
+        return: {member_id: {thread_id: deadline}}
+        """
+        rows = await self.run(
+            lambda connection: connection.execute(
+                """
+                SELECT member_id, thread_id, deadline FROM guild_tags
+                WHERE guild_id = ? AND deadline BETWEEN ? AND ?
+                ORDER BY deadline
+                """,
+                (int(guild_id), start or "", end),
+            ).fetchall()
+        )
+        result = {}
+        for member_id, thread_id, deadline in rows:
+            result.setdefault(member_id, {})[thread_id] = deadline
+        return result
+
+
+class SQLiteMemberTaggerNotifyDBHandler(SQLiteHandler, NotifyStorage):
+    """
+    db architecture:
+    guilds(guild_id)
+    notify(guild_id, member_id, notify)
+    """
+
+    async def set_guild_id(self, guild_id: int):
+        def set_guild(connection: sqlite3.Connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (int(guild_id),)
+            )
+            connection.execute(
+                "DELETE FROM notify WHERE guild_id = ?", (int(guild_id),)
+            )
+            return True
+
+        return await self.run(set_guild, write=True)
+
+    def _set_notify_state(
+        self,
+        connection: sqlite3.Connection,
+        guild_id: int,
+        member_id: int,
+        notify: bool,
+    ):
+        connection.execute(
+            "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (int(guild_id),)
+        )
+        connection.execute(
+            """
+            INSERT INTO notify (guild_id, member_id, notify) VALUES (?, ?, ?)
+            ON CONFLICT (guild_id, member_id) DO UPDATE SET notify = excluded.notify
+            """,
+            (int(guild_id), str(member_id), int(notify)),
+        )
+
+    async def set_notify_state(self, guild_id: int, member_id: int, notify: bool):
+        await self.run(self._set_notify_state, guild_id, member_id, notify, write=True)
+
+    async def get_notify_state(self, guild_id: int, member_id: int) -> bool | None:
+        row = await self.run(
+            lambda connection: connection.execute(
+                "SELECT notify FROM notify WHERE guild_id = ? AND member_id = ?",
+                (int(guild_id), str(member_id)),
+            ).fetchone()
+        )
+        return bool(row[0]) if row else None
+
+    async def get_guild_notify_states(self, guild_id: int) -> dict[str, bool]:
+        rows = await self.run(
+            lambda connection: connection.execute(
+                "SELECT member_id, notify FROM notify WHERE guild_id = ?",
+                (int(guild_id),),
+            ).fetchall()
+        )
+        return {member_id: bool(notify) for member_id, notify in rows}
+
+    async def set_guild_notify_states(
+        self, guild_id: int, states: dict[str, bool]
+    ) -> bool:
+        def set_states(connection: sqlite3.Connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (int(guild_id),)
+            )
+            connection.execute(
+                "DELETE FROM notify WHERE guild_id = ?", (int(guild_id),)
+            )
+            connection.executemany(
+                "INSERT INTO notify (guild_id, member_id, notify) VALUES (?, ?, ?)",
+                [
+                    (int(guild_id), str(member_id), int(notify))
+                    for member_id, notify in states.items()
+                ],
+            )
+            return True
+
+        return await self.run(set_states, write=True)
+
+    async def get_guilds(self) -> list[int]:
+        rows = await self.run(
+            lambda connection: connection.execute(
+                "SELECT guild_id FROM guilds"
+            ).fetchall()
+        )
+        return [guild_id for guild_id, in rows]
+
+    async def toggle_notify_state(self, guild_id: int, member_id: int) -> bool:
+        def toggle(connection: sqlite3.Connection) -> bool:
+            row = connection.execute(
+                "SELECT notify FROM notify WHERE guild_id = ? AND member_id = ?",
+                (int(guild_id), str(member_id)),
+            ).fetchone()
+            notify = not (bool(row[0]) if row else False)
+            self._set_notify_state(connection, guild_id, member_id, notify)
+            return notify
+
+        return await self.run(toggle, write=True)
+
+    async def sync_members(
+        self, guild_id: int, member_ids: list[int], remove_missing: bool = True
+    ) -> dict[str, int]:
+        """
+        make the stored members of the guild match member_ids in one transaction.
+        new members are set to notify=True, members who left are removed
+        (only with remove_missing=True).
+        return: {'added': int, 'removed': int, 'unchanged': int}
+        """
+
+        def sync(connection: sqlite3.Connection) -> dict[str, int]:
+            connection.execute(
+                "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (int(guild_id),)
+            )
+            stored = {
+                member_id
+                for member_id, in connection.execute(
+                    "SELECT member_id FROM notify WHERE guild_id = ?", (int(guild_id),)
+                )
+            }
+            live = {str(member_id) for member_id in member_ids}
+            added = live - stored
+            removed = stored - live if remove_missing else set()
+            connection.executemany(
+                "INSERT INTO notify (guild_id, member_id, notify) VALUES (?, ?, 1)",
+                [(int(guild_id), member_id) for member_id in added],
+            )
+            connection.executemany(
+                "DELETE FROM notify WHERE guild_id = ? AND member_id = ?",
+                [(int(guild_id), member_id) for member_id in removed],
+            )
+            return {
+                "added": len(added),
+                "removed": len(removed),
+                "unchanged": len(live) - len(added),
+            }
+
+        return await self.run(sync, write=True)
+
+    async def get_members(self, guild_id: int) -> list[str]:
+        """for sync with guild members"""
+        rows = await self.run(
+            lambda connection: connection.execute(
+                "SELECT member_id FROM notify WHERE guild_id = ?", (int(guild_id),)
+            ).fetchall()
+        )
+        return [member_id for member_id, in rows]
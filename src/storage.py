@@ -0,0 +1,197 @@
+import os
+import functools
+from abc import ABC, abstractmethod
+
+
+class TagStorage(ABC):
+    """
+    storage of member -> thread tags, partitioned by guild.
+    every read and write is scoped to one guild.
+    implemented by MemberTaggerDBHandler (DynamoDB) and SQLiteMemberTaggerDBHandler.
+    """
+
+    @abstractmethod
+    async def tag_member(
+        self, guild_id: int, member_id: str, thread_id: str, deadline: str
+    ):
+        ...
+
+    @abstractmethod
+    async def untag_member(self, guild_id: int, member_id: str, thread_id: str):
+        ...
+
+    @abstractmethod
+    async def tag_threads(
+        self, guild_id: int, member_id: str, thread_ids: list[str], deadline: str
+    ):
+        ...
+
+    @abstractmethod
+    async def untag_threads(self, guild_id: int, member_id: str, thread_ids: list[str]):
+        ...
+
+    @abstractmethod
+    async def tag_members(
+        self,
+        guild_id: int,
+        member_ids: list[str],
+        thread_ids: list[str],
+        deadline: str,
+    ) -> bool:
+        """tag every member to every thread. return: False if the write failed"""
+
+    @abstractmethod
+    async def untag_members(
+        self, guild_id: int, member_ids: list[str], thread_ids: list[str]
+    ) -> bool:
+        """
+        return: False if the write failed.
+        tags that did not exist are not a failure (DynamoDB cannot tell without a read)
+        """
+
+    @abstractmethod
+    async def get_tagged_threads(self, guild_id: int, member_id: str) -> dict[str, str]:
+        """e.g. {'thread_id': 'deadline'}"""
+
+    @abstractmethod
+    async def get_tagged_members(
+        self, guild_id: int, thread_id: str
+    ) -> dict[str, str | int | list[str] | list[int]]:
+        """e.g. {'ids': ['member_id', ...], 'deadline': 'deadline'}"""
+
+    @abstractmethod
+    async def get_deadline(
+        self, guild_id: int, member_id: str, thread_id: str
+    ) -> str | None:
+        ...
+
+    @abstractmethod
+    async def get_all_tagged_threads(self, guild_id: int) -> dict[str, dict[str, str]]:
+        """return: {member_id: {thread_id: deadline}} of the guild"""
+
+    @abstractmethod
+    async def get_tagged_threads_page(
+        self, guild_id: int, cursor: str | None = None, limit: int = 10
+    ) -> dict[str, dict[str, dict[str, str]] | str | None]:
+        """
+        at most `limit` members of get_all_tagged_threads, starting after `cursor`.
+        pass the returned cursor to get the next page. it is None on the last page.
+        return: {'items': {member_id: {thread_id: deadline}}, 'cursor': str | None}
+        """
+
+    @abstractmethod
+    async def get_due_threads(
+        self, guild_id: int, end: str, start: str | None = None
+    ) -> dict[str, dict[str, str]]:
+        """
+        tags of the guild whose deadline is between start and end ('YYYY-MM-DD', inclusive).
+        return: {member_id: {thread_id: deadline}}
+        """
+
+    @abstractmethod
+    async def put_tags(self, rows: list[dict[str, int | str]]) -> bool:
+        """
+        bulk upsert, e.g. for migrations.
+        rows: [{'guild_id': int, 'member_id': str, 'thread_id': str, 'deadline': str}, ...]
+        """
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+
+class NotifyStorage(ABC):
+    """
+    storage of per-guild notify states.
+    implemented by MemberTaggerNotifyDBHandler (DynamoDB) and SQLiteMemberTaggerNotifyDBHandler.
+    """
+
+    @abstractmethod
+    async def set_guild_id(self, guild_id: int):
+        ...
+
+    @abstractmethod
+    async def set_notify_state(self, guild_id: int, member_id: int, notify: bool):
+        ...
+
+    @abstractmethod
+    async def get_notify_state(self, guild_id: int, member_id: int) -> bool | None:
+        ...
+
+    @abstractmethod
+    async def get_guild_notify_states(self, guild_id: int) -> dict[str, bool]:
+        ...
+
+    @abstractmethod
+    async def get_guilds(self) -> list[int]:
+        ...
+
+    @abstractmethod
+    async def toggle_notify_state(self, guild_id: int, member_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def sync_members(
+        self, guild_id: int, member_ids: list[int], remove_missing: bool = True
+    ) -> dict[str, int]:
+        """
+        store member_ids with notify=True if they are new. members missing from
+        member_ids are removed only with remove_missing=True: pass False when
+        member_ids may be incomplete (e.g. the guild is not chunked yet).
+        return: {'added': int, 'removed': int, 'unchanged': int}
+        """
+
+    @abstractmethod
+    async def get_members(self, guild_id: int) -> list[str]:
+        ...
+
+    @abstractmethod
+    async def set_guild_notify_states(
+        self, guild_id: int, states: dict[str, bool]
+    ) -> bool:
+        """replace every notify state of the guild (e.g. for migrations)"""
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+
+# STORAGE_BACKENDで使用するバックエンドを選ぶ (dynamodb | sqlite | memory)
+def get_backend() -> str:
+    return os.getenv("STORAGE_BACKEND", "dynamodb").lower()
+
+
+@functools.cache
+def get_tag_db() -> TagStorage:
+    backend = get_backend()
+    if backend == "dynamodb":
+        from db_handler import MemberTaggerDBHandler
+
+        return MemberTaggerDBHandler()
+    if backend == "sqlite":
+        from sqlite_handler import SQLiteMemberTaggerDBHandler
+
+        return SQLiteMemberTaggerDBHandler()
+    if backend == "memory":
+        from memory_handler import MemoryMemberTaggerDBHandler
+
+        return MemoryMemberTaggerDBHandler()
+    raise ValueError(f"unknown STORAGE_BACKEND: {backend}")
+
+
+@functools.cache
+def get_notify_db() -> NotifyStorage:
+    backend = get_backend()
+    if backend == "dynamodb":
+        from db_handler import MemberTaggerNotifyDBHandler
+
+        return MemberTaggerNotifyDBHandler()
+    if backend == "sqlite":
+        from sqlite_handler import SQLiteMemberTaggerNotifyDBHandler
+
+        return SQLiteMemberTaggerNotifyDBHandler()
+    if backend == "memory":
+        from memory_handler import MemoryMemberTaggerNotifyDBHandler
+
+        return MemoryMemberTaggerNotifyDBHandler()
+    raise ValueError(f"unknown STORAGE_BACKEND: {backend}")
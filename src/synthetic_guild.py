@@ -0,0 +1,215 @@
+"""
+synthetic stand-ins of discord.Guild / Thread / Member / Interaction for load tests.
+
+only the attributes used by NotifyHandler and EmbedHandler are implemented. every
+send is recorded by a SendRecorder instead of going to Discord, so the notify
+pipeline and the embed builders can be run offline and reproducibly:
+
+    recorder = SendRecorder()
+    guild = SyntheticGuild.generate(members=50_000, threads=5_000, recorder=recorder)
+    await populate_tags(tag_db, guild, seed=0)
+    await NotifyHandler(guild, db=notify_db, tag_db=tag_db).notify_now(list(range(16)))
+    len(recorder.sent)
+"""
+
+import time
+import random
+import asyncio
+import datetime
+
+import discord
+
+from scheduler import JST
+from storage import TagStorage
+
+
+class SendRecorder:
+    """
+    records every message sent to a synthetic channel or interaction.
+    latency (seconds) is awaited before each send to imitate the Discord API.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent: list[dict] = []
+
+    async def record(
+        self,
+        channel_id: int | None,
+        content: str | None = None,
+        embed: discord.Embed | None = None,
+        embeds: list[discord.Embed] | None = None,
+        **kwargs,
+    ):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append(
+            {
+                "channel_id": channel_id,
+                "content": content,
+                "embeds": embeds if embeds else [embed] if embed else [],
+                "kwargs": kwargs,
+                "time": time.perf_counter(),
+            }
+        )
+
+    def clear(self):
+        self.sent.clear()
+
+
+class SyntheticMember:
+    def __init__(self, id: int, name: str | None = None):
+        self.id = id
+        self.name = name if name else f"member-{id}"
+        self.display_name = self.name
+        self.mention = f"<@{id}>"
+        self.bot = False
+
+    def __repr__(self):
+        return f"<SyntheticMember id={self.id}>"
+
+
+class SyntheticThread:
+    def __init__(
+        self, id: int, recorder: SendRecorder | None = None, name: str | None = None
+    ):
+        self.id = id
+        self.name = name if name else f"thread-{id}"
+        self.mention = f"<#{id}>"
+        self.recorder = recorder if recorder else SendRecorder()
+
+    async def send(self, content: str | None = None, **kwargs):
+        await self.recorder.record(self.id, content, **kwargs)
+
+    def __repr__(self):
+        return f"<SyntheticThread id={self.id}>"
+
+
+class SyntheticGuild:
+    def __init__(
+        self,
+        id: int,
+        members: list[SyntheticMember],
+        threads: list[SyntheticThread],
+        name: str | None = None,
+    ):
+        self.id = id
+        self.name = name if name else f"guild-{id}"
+        self.members = members
+        self.threads = threads
+        # 全メンバーを持っている(discord.Guild.chunkedと同じ意味)
+        self.chunked = True
+        self._members = {member.id: member for member in members}
+        self._threads = {thread.id: thread for thread in threads}
+
+    @classmethod
+    def generate(
+        cls,
+        id: int = 1000,
+        members: int = 50_000,
+        threads: int = 5_000,
+        recorder: SendRecorder | None = None,
+    ) -> "SyntheticGuild":
+        """ids are sequential, so the same arguments always make the same guild"""
+        recorder = recorder if recorder else SendRecorder()
+        member_base = id * 10**7
+        thread_base = member_base + 5 * 10**6
+        return cls(
+            id,
+            [SyntheticMember(member_base + i) for i in range(members)],
+            [SyntheticThread(thread_base + i, recorder) for i in range(threads)],
+        )
+
+    @property
+    def member_count(self) -> int:
+        return len(self.members)
+
+    def get_member(self, id: int) -> SyntheticMember | None:
+        return self._members.get(id)
+
+    def get_channel_or_thread(self, id: int) -> SyntheticThread | None:
+        return self._threads.get(id)
+
+
+class _SyntheticResponse:
+    def __init__(self, interaction: "SyntheticInteraction"):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content: str | None = None, **kwargs):
+        self._done = True
+        await self._interaction.recorder.record(
+            self._interaction.channel.id, content, **kwargs
+        )
+
+    async def edit_message(self, content: str | None = None, **kwargs):
+        self._done = True
+        await self._interaction.recorder.record(
+            self._interaction.channel.id, content, **kwargs
+        )
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+
+class _SyntheticClient:
+    latency = 0.0
+
+
+class SyntheticInteraction:
+    """the part of discord.Interaction that EmbedHandler uses"""
+
+    def __init__(
+        self,
+        guild: SyntheticGuild,
+        user: SyntheticMember | None = None,
+        channel: SyntheticThread | None = None,
+        recorder: SendRecorder | None = None,
+        type: discord.InteractionType = discord.InteractionType.application_command,
+    ):
+        self.type = type
+        self.guild = guild
+        self.user = user if user else guild.members[0]
+        self.channel = channel if channel else guild.threads[0]
+        self.recorder = recorder if recorder else self.channel.recorder
+        self.application_id = 0
+        self.client = _SyntheticClient()
+        self.response = _SyntheticResponse(self)
+        self.extras: dict = {}
+
+    async def edit_original_response(self, content: str | None = None, **kwargs):
+        await self.recorder.record(self.channel.id, content, **kwargs)
+
+
+async def populate_tags(
+    tag_db: TagStorage,
+    guild: SyntheticGuild,
+    threads_per_member: int = 1,
+    days: int = 16,
+    seed: int = 0,
+) -> int:
+    """
+    tag every member of the guild to random threads, with deadlines from today to
+    days - 1 days later (JST). the same seed always makes the same tags.
+    return: the number of tags
+    """
+    rng = random.Random(seed)
+    today = datetime.datetime.now(JST).date()
+    deadlines = [
+        (today + datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+        for day in range(days)
+    ]
+    count = 0
+    for member in guild.members:
+        threads = rng.sample(guild.threads, min(threads_per_member, len(guild.threads)))
+        await tag_db.tag_threads(
+            guild.id,
+            str(member.id),
+            [str(thread.id) for thread in threads],
+            rng.choice(deadlines),
+        )
+        count += len(threads)
+    return count
@@ -0,0 +1,123 @@
+"""
+latency tracing of slash commands and view callbacks.
+
+every interaction is timed from its creation (the snowflake timestamp, which is also
+where Discord's 3 second acknowledgement deadline starts) to
+- the first response (send_message / defer / edit_message / send_modal), and
+- the completion of the slash command or the view callback (including errors).
+a response that fails (e.g. NotFound after the deadline) is still recorded, at the
+time it was attempted.
+results are exported on /metrics (see metrics.py) as p50/p95/p99 per command.
+"""
+
+import os
+import logging
+import functools
+from typing import Any, Awaitable, Callable
+
+import discord
+from colorama import Fore, Style
+
+import metrics
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+DEADLINE = 3.0
+# 初回応答がこれを超えたら締め切り間近として数える
+DEADLINE_WARNING = float(os.getenv("COMMAND_DEADLINE_WARNING", "2.5"))
+
+_RESPONSE_METHODS = ("send_message", "defer", "edit_message", "send_modal")
+_installed = False
+
+
+def _elapsed(interaction: discord.Interaction) -> float:
+    return max((discord.utils.utcnow() - interaction.created_at).total_seconds(), 0.0)
+
+
+def command_name(interaction: discord.Interaction) -> str:
+    """the slash command name, or the view item set by trace_callback"""
+    name = interaction.extras.get("trace_name")
+    if name:
+        return name
+    if interaction.command:
+        return interaction.command.qualified_name
+    return "unknown"
+
+
+def record_first_response(interaction: discord.Interaction):
+    if "first_response" in interaction.extras:
+        return
+    elapsed = _elapsed(interaction)
+    interaction.extras["first_response"] = elapsed
+    name = command_name(interaction)
+    metrics.command_first_response_seconds.observe(elapsed, name)
+    if elapsed > DEADLINE:
+        metrics.command_deadline_missed_total.inc(name)
+    if elapsed >= DEADLINE_WARNING:
+        metrics.command_deadline_near_total.inc(name)
+        logging.warning(
+            Fore.RED
+            + f"{name} took {elapsed:.2f}s to respond (deadline {DEADLINE:.0f}s)"
+            + Style.RESET_ALL
+        )
+
+
+def record_completion(interaction: discord.Interaction):
+    metrics.command_completion_seconds.observe(
+        _elapsed(interaction), command_name(interaction)
+    )
+
+
+def record_error(interaction: discord.Interaction):
+    """a command or callback that raised. it is timed like a completion too"""
+    metrics.command_errors_total.inc(command_name(interaction))
+    record_completion(interaction)
+
+
+def install():
+    """
+    wrap the InteractionResponse methods so that the first response of every
+    interaction is recorded. call once at startup (calling again does nothing).
+    """
+    global _installed
+    if _installed:
+        return
+    for method_name in _RESPONSE_METHODS:
+        method = getattr(discord.InteractionResponse, method_name)
+
+        def wrap(method: Callable[..., Awaitable[Any]]):
+            @functools.wraps(method)
+            async def wrapper(self: discord.InteractionResponse, *args, **kwargs):
+                # 締め切りを過ぎた応答はNotFound(10062)で失敗するので、失敗しても記録する
+                try:
+                    return await method(self, *args, **kwargs)
+                finally:
+                    record_first_response(self._parent)
+
+            return wrapper
+
+        setattr(discord.InteractionResponse, method_name, wrap(method))
+    _installed = True
+
+
+def trace_callback(
+    callback: Callable[[Any, discord.Interaction], Awaitable[None]]
+) -> Callable[[Any, discord.Interaction], Awaitable[None]]:
+    """
+    decorator for the callback (or on_submit) of a view item / modal.
+    the interaction is recorded under the class name of the item, e.g. ChannelSelect.
+    """
+
+    @functools.wraps(callback)
+    async def wrapper(self, interaction: discord.Interaction):
+        interaction.extras["trace_name"] = type(self).__name__
+        try:
+            await callback(self, interaction)
+        except Exception:
+            record_error(interaction)
+            raise
+        record_completion(interaction)
+
+    return wrapper
@@ -5,3 +5,8 @@ class SingletonMeta(type):
         if cls not in cls._instances:
             cls._instances[cls] = super(SingletonMeta, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
+
+def chunked(items: list, size: int) -> list[list]:
+    """split items into lists of at most size elements"""
+    return [items[i : i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,56 @@
+"""
+shared fixtures: the sources in src/ and a local moto server as DynamoDB.
+
+run: python -m pytest tests
+"""
+
+import os
+import sys
+import socket
+import pathlib
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+
+
+@pytest.fixture(scope="session")
+def endpoint():
+    """the url of a moto server. the environment points DynamoDB at it"""
+    moto_server = pytest.importorskip("moto.server")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(
+        ip_address="127.0.0.1", port=port, verbose=False
+    )
+    server.start()
+    url = f"http://127.0.0.1:{port}"
+    env = {
+        "DYNAMODB_ENDPOINT_URL": url,
+        "AWS_ACCESS_KEY_ID": "test",
+        "AWS_SECRET_ACCESS_KEY": "test",
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+    }
+    saved = {key: os.environ.get(key) for key in [*env, "STORAGE_BACKEND"]}
+    os.environ.update(env)
+    yield url
+    server.stop()
+    for key, value in saved.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+@pytest.fixture
+def dynamodb(endpoint):
+    """an empty moto server: a boto3 resource to create tables with"""
+    boto3 = pytest.importorskip("boto3")
+    urllib.request.urlopen(
+        urllib.request.Request(f"{endpoint}/moto-api/reset", method="POST")
+    )
+    return boto3.resource(
+        "dynamodb", endpoint_url=endpoint, region_name="ap-northeast-1"
+    )
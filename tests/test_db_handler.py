@@ -0,0 +1,164 @@
+"""DBHandler against a local moto server"""
+
+import asyncio
+
+import pytest
+
+from db_handler import DBHandler, MemberTaggerNotifyDBHandler
+
+
+@pytest.fixture
+def table(dynamodb):
+    """a table of 40 items: {'id': 0..39}"""
+    table = dynamodb.create_table(
+        TableName="scan_test",
+        KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "N"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    with table.batch_writer() as batch:
+        for i in range(40):
+            batch.put_item(Item={"id": i})
+    return DBHandler("scan_test")
+
+
+@pytest.fixture
+def notify_table(dynamodb):
+    dynamodb.create_table(
+        TableName="member_tagger_notify",
+        KeySchema=[{"AttributeName": "guild_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "guild_id", "AttributeType": "N"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    MemberTaggerNotifyDBHandler.invalidate_cache()
+    return dynamodb.Table("member_tagger_notify")
+
+
+async def _collect(pages) -> dict[int, list]:
+    """segment -> [(ids, last_key), ...]"""
+    segments: dict[int, list] = {}
+    try:
+        async for segment, items, last_key in pages:
+            segments.setdefault(segment, []).append(
+                (sorted(int(item["id"]) for item in items), last_key)
+            )
+    finally:
+        await DBHandler.close()
+    return segments
+
+
+def test_parallel_scan_reads_every_segment_once(table):
+    segments = asyncio.run(_collect(table.parallel_scan_pages(4, page_size=3)))
+    assert sorted(segments) == [0, 1, 2, 3]
+    for pages in segments.values():
+        # 最後のページだけlast_keyがNone
+        assert [last_key is None for _, last_key in pages] == [False] * (
+            len(pages) - 1
+        ) + [True]
+    ids = [i for pages in segments.values() for page, _ in pages for i in page]
+    assert sorted(ids) == list(range(40))
+
+
+def test_parallel_scan_resumes_from_start_keys(table):
+    segments = asyncio.run(_collect(table.parallel_scan_pages(2, page_size=3)))
+    first_page, last_key = segments[1][0]
+    resumed = asyncio.run(
+        _collect(table.parallel_scan_pages(2, {1: last_key}, page_size=3))
+    )
+    assert list(resumed) == [1]
+    assert [page for page, _ in resumed[1]] == [page for page, _ in segments[1][1:]]
+
+
+def test_parallel_scan_raises_and_cancels_the_other_segments():
+    cancelled = []
+
+    class Failing(DBHandler):
+        async def scan_page(self, page_size, last_key, *args):
+            segment = args[2]
+            if segment == 0:
+                await asyncio.sleep(0)
+                raise RuntimeError("segment 0 failed")
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.append(segment)
+                raise
+
+    async def scan():
+        async for _ in Failing("scan_test").parallel_scan_pages(3):
+            pass
+
+    with pytest.raises(RuntimeError, match="segment 0 failed"):
+        asyncio.run(scan())
+    assert sorted(cancelled) == [1, 2]
+
+
+def test_parallel_scan_of_a_missing_table_raises(dynamodb):
+    with pytest.raises(Exception, match="ResourceNotFound"):
+        asyncio.run(_collect(DBHandler("missing").parallel_scan_pages(2)))
+
+
+def test_batch_get_chunks_keys_and_skips_missing_items(table):
+    async def batch_get():
+        try:
+            # 100キーずつに分けて読む。存在しないキー(40以上)は結果に含まれない
+            return await table.batch_get([{"id": i} for i in range(150)])
+        finally:
+            await DBHandler.close()
+
+    assert sorted(int(item["id"]) for item in asyncio.run(batch_get())) == list(
+        range(40)
+    )
+
+
+def test_set_notify_state_keeps_a_map_cached_during_its_write(notify_table):
+    notify_table.put_item(Item={"guild_id": 1, "info": {"1": True, "2": True}})
+    other = MemberTaggerNotifyDBHandler()
+
+    class Racing(MemberTaggerNotifyDBHandler):
+        async def update(self, *args, **kwargs):
+            result = await super().update(*args, **kwargs)
+            # 書き込みの間に、他の書き込みが新しいinfoをキャッシュする
+            await other.sync_members(1, [1, 2, 3])
+            return result
+
+    async def toggle() -> dict[int, bool]:
+        try:
+            handler = Racing()
+            await handler._get_info(1)
+            await handler.set_notify_state(1, 1, False)
+            return await handler.get_guild_notify_states(1)
+        finally:
+            await DBHandler.close()
+
+    assert asyncio.run(toggle()) == {"1": False, "2": True, "3": True}
+
+
+def test_update_tells_a_failed_condition_from_other_errors(table):
+    async def update(handler: DBHandler, **kwargs) -> bool:
+        try:
+            return await handler.update(
+                {"id": 1},
+                "SET a = :a",
+                {":a": 1},
+                condition_expression="attribute_not_exists(id)",
+                **kwargs,
+            )
+        finally:
+            await DBHandler.close()
+
+    assert asyncio.run(update(table, raise_errors=True)) is False
+    assert asyncio.run(update(DBHandler("missing"))) is False
+    with pytest.raises(Exception, match="ResourceNotFound"):
+        asyncio.run(update(DBHandler("missing"), raise_errors=True))
+
+
+def test_update_logs_a_client_that_cannot_be_created(monkeypatch):
+    async def get_client(self):
+        raise RuntimeError("no credentials")
+
+    monkeypatch.setattr(DBHandler, "get_client", get_client)
+    assert (
+        asyncio.run(DBHandler("scan_test").update({"id": 1}, "SET a = :a", {":a": 1}))
+        is False
+    )
@@ -0,0 +1,211 @@
+"""
+src/migrate.py against legacy tables served by a local moto server,
+migrated to the in-memory storage.
+
+run: python -m pytest tests
+"""
+
+import os
+import json
+import asyncio
+import argparse
+import pathlib
+
+import pytest
+
+import migrate
+import storage
+
+
+@pytest.fixture
+def legacy(dynamodb):
+    """create the baseline tables: legacy(posts=[...], notify=[...])"""
+    storage.get_tag_db.cache_clear()
+    storage.get_notify_db.cache_clear()
+
+    def create(name: str, key: str, key_type: str, items: list[dict]):
+        table = dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": key_type}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        for item in items:
+            table.put_item(Item=item)
+
+    def legacy(posts: list[dict] | None = None, notify: list[dict] | None = None):
+        if posts is not None:
+            create("member_tagger_posts", "member_id", "S", posts)
+        if notify is not None:
+            create("member_tagger_notify", "guild_id", "N", notify)
+
+    return legacy
+
+
+def _args(tmp_path: pathlib.Path, **kwargs) -> argparse.Namespace:
+    args = {
+        "target": "memory",
+        "jobs": migrate.JOBS,
+        "segments": 3,
+        "workers": 4,
+        "page_size": 2,
+        "chunk_size": 2,
+        "checkpoint": str(tmp_path / "checkpoint.json"),
+        "create_tables": False,
+        "resolve_with_discord": False,
+        "drop_unresolved": False,
+        "verify_only": False,
+    }
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def _segments(tmp_path: pathlib.Path, job: str) -> list[dict]:
+    with open(tmp_path / "checkpoint.json", encoding="utf-8") as f:
+        return list(json.load(f)["jobs"][job]["segments"].values())
+
+
+NOTIFY = [
+    {"guild_id": 1, "info": {"100": True, "200": False}},
+    {"guild_id": 2, "info": {"200": True, "300": True}},
+    {"guild_id": 3, "info": {}},
+]
+
+
+def test_migrates_tags_to_the_guild_of_their_member(tmp_path, legacy):
+    legacy(
+        posts=[
+            {"member_id": "100", "10": "2026-01-01", "11": "2026-01-02"},
+            {"member_id": "300", "20": "2026-02-01"},
+        ],
+        notify=NOTIFY,
+    )
+    assert asyncio.run(migrate.run(_args(tmp_path)))
+
+    tag_db = storage.get_tag_db()
+    assert asyncio.run(tag_db.get_all_tagged_threads(1)) == {
+        "100": {"10": "2026-01-01", "11": "2026-01-02"}
+    }
+    assert asyncio.run(tag_db.get_all_tagged_threads(2)) == {
+        "300": {"20": "2026-02-01"}
+    }
+    notify_db = storage.get_notify_db()
+    assert asyncio.run(notify_db.get_guild_notify_states(2)) == {
+        "200": True,
+        "300": True,
+    }
+    assert sorted(asyncio.run(notify_db.get_guilds())) == [1, 2, 3]
+    # 移行済みなら何も読み書きせずに検証だけする
+    assert asyncio.run(migrate.run(_args(tmp_path)))
+
+
+def test_unresolved_tags_fail_until_dropped(tmp_path, legacy):
+    # 200は2つのguildに、400はどのguildにもいない
+    legacy(
+        posts=[
+            {"member_id": "100", "10": "2026-01-01"},
+            {"member_id": "200", "10": "2026-01-01"},
+            {"member_id": "400", "30": "2026-03-01"},
+        ],
+        notify=NOTIFY,
+    )
+    assert not asyncio.run(migrate.run(_args(tmp_path, jobs=["tags"])))
+    segments = _segments(tmp_path, "tags")
+    assert all(segment["scanned"] for segment in segments)
+    assert sorted(
+        tuple(value) for segment in segments for value in segment["unresolved"]
+    ) == [("200", "10", "2026-01-01"), ("400", "30", "2026-03-01")]
+    assert not asyncio.run(
+        migrate.run(_args(tmp_path, jobs=["tags"], verify_only=True))
+    )
+
+    assert asyncio.run(
+        migrate.run(_args(tmp_path, jobs=["tags"], drop_unresolved=True))
+    )
+    assert sum(segment["dropped"] for segment in _segments(tmp_path, "tags")) == 2
+    assert asyncio.run(storage.get_tag_db().get_all_tagged_threads(1)) == {
+        "100": {"10": "2026-01-01"}
+    }
+
+
+def test_unresolved_tags_are_resolved_by_their_thread(tmp_path, legacy):
+    legacy(
+        posts=[
+            {"member_id": "200", "10": "2026-01-01", "20": "2026-02-01"},
+            {"member_id": "400", "30": "2026-03-01"},
+        ],
+        notify=NOTIFY,
+    )
+
+    class Resolver:
+        guilds = {"10": 1, "20": 2}
+
+        async def guild_of(self, thread_id: str) -> int | None:
+            return self.guilds.get(thread_id)
+
+    async def run(resolver: Resolver) -> bool:
+        job = migrate.TagsJob(storage.get_tag_db(), 2, resolver)
+        migrator = migrate.Migrator(
+            migrate.Checkpoint(str(tmp_path / "checkpoint.json"))
+        )
+        try:
+            await migrator.migrate(job)
+            return await migrator.verify(job)
+        finally:
+            await migrate.DBHandler.close()
+
+    os.environ["STORAGE_BACKEND"] = "memory"
+    assert not asyncio.run(run(Resolver()))
+    # 解決できなかった行だけが次の実行で読み直される
+    Resolver.guilds["30"] = 2
+    assert asyncio.run(run(Resolver()))
+    tag_db = storage.get_tag_db()
+    assert asyncio.run(tag_db.get_all_tagged_threads(1)) == {
+        "200": {"10": "2026-01-01"}
+    }
+    assert asyncio.run(tag_db.get_all_tagged_threads(2)) == {
+        "200": {"20": "2026-02-01"},
+        "400": {"30": "2026-03-01"},
+    }
+
+
+def test_missing_source_table_fails(tmp_path, legacy):
+    # 元のnotifyテーブルがないと、タグのguildを決められない
+    legacy(posts=[{"member_id": "100", "10": "2026-01-01"}])
+    assert not asyncio.run(migrate.run(_args(tmp_path, jobs=["tags"])))
+    assert not (tmp_path / "checkpoint.json").exists()
+    assert not asyncio.run(migrate.run(_args(tmp_path, jobs=["notify"])))
+
+
+def test_marks_the_dynamodb_target_as_migrated(tmp_path, legacy):
+    legacy(posts=[{"member_id": "100", "10": "2026-01-01"}], notify=NOTIFY)
+    os.environ["STORAGE_BACKEND"] = "dynamodb"
+    tag_db = storage.get_tag_db()
+
+    async def check_migrated() -> bool:
+        try:
+            return await tag_db.check_migrated()
+        finally:
+            await migrate.DBHandler.close()
+
+    # 移行前はbotを起動できない
+    assert not asyncio.run(check_migrated())
+    assert asyncio.run(
+        migrate.run(_args(tmp_path, target="dynamodb", create_tables=True))
+    )
+    assert asyncio.run(check_migrated())
+
+
+def test_notify_is_not_written_back_into_its_own_table(tmp_path, legacy, dynamodb):
+    legacy(notify=NOTIFY)
+    os.environ["STORAGE_BACKEND"] = "dynamodb"
+    table = dynamodb.Table("member_tagger_notify")
+    # 移行中にbotが切り替えた通知設定
+    table.put_item(Item={"guild_id": 1, "info": {"100": False}, "version": 5})
+    assert asyncio.run(migrate.run(_args(tmp_path, target="dynamodb", jobs=["notify"])))
+    assert table.get_item(Key={"guild_id": 1})["Item"] == {
+        "guild_id": 1,
+        "info": {"100": False},
+        "version": 5,
+    }
+    assert not (tmp_path / "checkpoint.json").exists()
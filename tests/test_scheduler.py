@@ -0,0 +1,111 @@
+"""ReminderScheduler: the saved schedule, restarts and the order jobs fire in"""
+
+import json
+import time
+import asyncio
+import datetime
+
+from scheduler import JST, ReminderScheduler, next_jst_midnight
+
+
+def _after(seconds: float):
+    return lambda after: after + datetime.timedelta(seconds=seconds)
+
+
+def _saved(path: str) -> dict[str, float]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_next_jst_midnight_is_strictly_after():
+    midnight = datetime.datetime(2026, 10, 18, 0, 0, tzinfo=JST)
+    assert next_jst_midnight(midnight) == midnight + datetime.timedelta(days=1)
+    # UTCの15:00はJSTの翌日0:00
+    utc = datetime.datetime(2026, 10, 17, 14, 59, tzinfo=datetime.timezone.utc)
+    assert next_jst_midnight(utc) == midnight
+
+
+def test_jobs_fire_in_order_and_the_next_time_is_saved_first(tmp_path):
+    path = str(tmp_path / "state.json")
+    fired = []
+
+    async def run():
+        scheduler = ReminderScheduler(path)
+
+        def job(name: str):
+            async def callback():
+                # 実行中には、もう次回の時刻が保存されている
+                fired.append((name, _saved(path)[name] > time.time()))
+
+            return callback
+
+        scheduler.add_job("late", job("late"), _after(0.5))
+        scheduler.add_job("early", job("early"), _after(0.2))
+        scheduler.start()
+        scheduler.start()  # 二度目は何もしない
+        await asyncio.sleep(0.55)
+        scheduler.stop()
+
+    asyncio.run(run())
+    # early: 0.2s, 0.4s / late: 0.5s
+    assert fired == [("early", True), ("early", True), ("late", True)]
+
+
+def test_a_restart_keeps_the_saved_schedule(tmp_path):
+    path = str(tmp_path / "state.json")
+    scheduler = ReminderScheduler(path)
+    scheduler.add_job("daily", None, _after(3600))
+    saved = _saved(path)["daily"]
+
+    restarted = ReminderScheduler(path)
+    restarted.add_job("daily", None, _after(60))
+    assert restarted._fire_at["daily"] == saved
+
+
+def test_a_time_missed_while_down_fires_once_then_follows_the_schedule(tmp_path):
+    path = str(tmp_path / "state.json")
+    # botが止まっている間に過ぎた時刻
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"daily": time.time() - 3 * 86400}, f)
+    fired = []
+
+    async def run() -> float:
+        scheduler = ReminderScheduler(path)
+
+        async def callback():
+            fired.append(time.time())
+
+        scheduler.add_job("daily", callback, _after(3600))
+        scheduler.start()
+        await asyncio.sleep(0.1)
+        scheduler.stop()
+        return scheduler._fire_at["daily"]
+
+    started = time.time()
+    next_fire = asyncio.run(run())
+    assert len(fired) == 1
+    # 過ぎた回をまとめて実行せず、今から次の時刻を決める
+    assert started + 3600 <= next_fire <= time.time() + 3600
+    assert _saved(path)["daily"] == next_fire
+
+
+def test_a_failing_job_does_not_stop_the_others(tmp_path):
+    fired = []
+
+    async def run():
+        scheduler = ReminderScheduler(str(tmp_path / "state.json"))
+
+        async def failing():
+            raise RuntimeError("failed")
+
+        async def callback():
+            fired.append("ok")
+
+        scheduler.add_job("failing", failing, _after(0.05))
+        scheduler.add_job("ok", callback, _after(0.2))
+        scheduler.start()
+        await asyncio.sleep(0.3)
+        scheduler.stop()
+
+    asyncio.run(run())
+    assert fired == ["ok"]
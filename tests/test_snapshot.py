@@ -0,0 +1,182 @@
+"""Snapshot over DynamoDB (moto): enable, build, catch up, restore and expiry"""
+
+import time
+import asyncio
+
+import pytest
+
+from db_handler import (
+    DBHandler,
+    MemberTaggerChangeLogDBHandler,
+    MemberTaggerDBHandler,
+    MemberTaggerNotifyDBHandler,
+)
+from snapshot import Snapshot
+
+
+@pytest.fixture
+def dbs(dynamodb):
+    """(tag_db, notify_db) on empty tables, without the change log table"""
+    dynamodb.create_table(
+        TableName="member_tagger_notify",
+        KeySchema=[{"AttributeName": "guild_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "guild_id", "AttributeType": "N"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    MemberTaggerDBHandler.invalidate_cache()
+    MemberTaggerNotifyDBHandler.invalidate_cache()
+    tag_db = MemberTaggerDBHandler()
+    asyncio.run(_closing(tag_db.create_table_if_missing()))
+    return tag_db, MemberTaggerNotifyDBHandler()
+
+
+async def _closing(coroutine):
+    try:
+        return await coroutine
+    finally:
+        await DBHandler.close()
+
+
+async def _enabled(dbs, path) -> Snapshot:
+    await MemberTaggerChangeLogDBHandler().create_table_if_missing()
+    snapshot = Snapshot(*dbs, str(path))
+    assert await snapshot.enable()
+    return snapshot
+
+
+async def _populate(tag_db, notify_db, guild_ids: list[int]):
+    for guild_id in guild_ids:
+        await tag_db.tag_members(guild_id, ["1", "2"], ["100"], "2026-10-20")
+        await notify_db.sync_members(guild_id, [1, 2])
+
+
+def test_enable_needs_the_change_log_table(dbs, tmp_path):
+    tag_db, notify_db = dbs
+
+    async def run() -> list:
+        snapshot = Snapshot(tag_db, notify_db, str(tmp_path / "snapshot.bin"))
+        # テーブルがなければ変更ログには何も書かない
+        disabled = await snapshot.enable()
+        await tag_db.tag_member(1, "1", "100", "2026-10-20")
+        attached = (tag_db.change_log, notify_db.change_log)
+        await MemberTaggerChangeLogDBHandler().create_table_if_missing()
+        enabled = await snapshot.enable()
+        await tag_db.tag_member(1, "2", "100", "2026-10-20")
+        return [
+            disabled,
+            attached,
+            enabled,
+            await snapshot.change_log.get_changes(1, 0),
+        ]
+
+    disabled, attached, enabled, changes = asyncio.run(_closing(run()))
+    assert disabled is False and attached == (None, None)
+    assert enabled is True
+    assert changes == {"members": {"2"}, "notify": False}
+
+
+def test_refresh_builds_then_catches_up_with_the_change_log(dbs, tmp_path):
+    tag_db, notify_db = dbs
+
+    async def run() -> list:
+        snapshot = await _enabled(dbs, tmp_path / "snapshot.bin")
+        await _populate(tag_db, notify_db, [1, 2])
+        built = await snapshot.refresh([1, 2])
+        await tag_db.untag_member(1, "1", "100")
+        await tag_db.tag_member(1, "3", "101", "2026-10-21")
+        await notify_db.toggle_notify_state(2, 2)
+        caught_up = await snapshot.refresh([1, 2])
+        sections = [snapshot._section(1), snapshot._section(2)]
+        snapshot.close()
+        return [built, caught_up, *sections]
+
+    built, caught_up, guild_1, guild_2 = asyncio.run(_closing(run()))
+    assert built == {"built": 2, "caught_up": 0, "failed": 0}
+    assert caught_up == {"built": 0, "caught_up": 2, "failed": 0}
+    assert guild_1["tags"] == {"2": {"100": "2026-10-20"}, "3": {"101": "2026-10-21"}}
+    assert guild_2["notify"] == {"1": True, "2": False}
+
+
+def test_restore_warms_the_caches_and_drops_expired_guilds(dbs, tmp_path):
+    tag_db, notify_db = dbs
+    path = tmp_path / "snapshot.bin"
+
+    async def run() -> list:
+        snapshot = await _enabled(dbs, path)
+        await _populate(tag_db, notify_db, [1, 2, 3])
+        await snapshot.refresh([1, 2, 3])
+        # guild 3は変更ログの保存期間より前に同期されたことにする
+        snapshot._entries[3]["synced_at"] = time.time() - snapshot.change_log.ttl
+        await snapshot.save()
+        snapshot.close()
+
+        # 再起動: キャッシュは空
+        MemberTaggerDBHandler.invalidate_cache()
+        MemberTaggerNotifyDBHandler.invalidate_cache()
+        restored = await _enabled(dbs, path)
+        result = await restored.restore()
+        cached = list(MemberTaggerDBHandler._cache.keys())
+        notify_cached = sorted(MemberTaggerNotifyDBHandler._cache.keys())
+        # 期限切れのguildは次のrefreshで丸ごと読み直される
+        refreshed = await restored.refresh([1, 2, 3])
+        restored.close()
+        return [result, sorted(cached), notify_cached, refreshed]
+
+    result, cached, notify_cached, refreshed = asyncio.run(_closing(run()))
+    # 直前の変更は追いつく時に読み直されるので、温めた数ではなくキャッシュの中身を見る
+    assert result["guilds"] == 3
+    assert cached == [(1, "1"), (1, "2"), (2, "1"), (2, "2")]
+    assert notify_cached == [1, 2]
+    assert refreshed == {"built": 1, "caught_up": 2, "failed": 0}
+
+
+def test_a_guild_is_rebuilt_after_the_rebuild_interval(dbs, tmp_path, monkeypatch):
+    tag_db, notify_db = dbs
+    monkeypatch.setattr(Snapshot, "rebuild_interval", 3600.0)
+
+    async def run() -> list:
+        snapshot = await _enabled(dbs, tmp_path / "snapshot.bin")
+        await _populate(tag_db, notify_db, [1])
+        await snapshot.refresh([1])
+        # 変更ログへの書き込みが失敗した変更は、読み直しで直る
+        tag_db.change_log = None
+        await tag_db.tag_member(1, "9", "109", "2026-10-29")
+        missed = await snapshot.refresh([1])
+        lost = "9" in snapshot._section(1)["tags"]
+        snapshot._entries[1]["built_at"] -= 3601
+        rebuilt = await snapshot.refresh([1])
+        found = "9" in snapshot._section(1)["tags"]
+        snapshot.close()
+        return [missed, lost, rebuilt, found]
+
+    missed, lost, rebuilt, found = asyncio.run(_closing(run()))
+    assert missed == {"built": 0, "caught_up": 1, "failed": 0} and not lost
+    assert rebuilt == {"built": 1, "caught_up": 0, "failed": 0} and found
+
+
+def test_refresh_forgets_guilds_the_bot_left(dbs, tmp_path):
+    tag_db, notify_db = dbs
+    path = tmp_path / "snapshot.bin"
+
+    async def run() -> list[int]:
+        snapshot = await _enabled(dbs, path)
+        await _populate(tag_db, notify_db, [1, 2])
+        await snapshot.refresh([1, 2])
+        await snapshot.refresh([2])
+        snapshot.close()
+        reopened = Snapshot(tag_db, notify_db, str(path))
+        reopened._open()
+        guilds = sorted(reopened._entries)
+        reopened.close()
+        return guilds
+
+    assert asyncio.run(_closing(run())) == [2]
+
+
+def test_discard_removes_the_file(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(b"stale")
+    Snapshot.discard(str(path))
+    assert not path.exists()
+    # ファイルがなくても失敗しない
+    Snapshot.discard(str(path))
@@ -0,0 +1,111 @@
+"""the TagStorage / NotifyStorage contracts, shared by every backend"""
+
+import asyncio
+
+import pytest
+
+from db_handler import MemberTaggerDBHandler, MemberTaggerNotifyDBHandler
+from memory_handler import (
+    MemoryMemberTaggerDBHandler,
+    MemoryMemberTaggerNotifyDBHandler,
+)
+from sqlite_handler import (
+    SQLiteHandler,
+    SQLiteMemberTaggerDBHandler,
+    SQLiteMemberTaggerNotifyDBHandler,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite", "dynamodb"])
+def tag_db(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryMemberTaggerDBHandler()
+    if request.param == "sqlite":
+        monkeypatch.setattr(SQLiteHandler, "path", str(tmp_path / "tags.db"))
+        return SQLiteMemberTaggerDBHandler()
+    request.getfixturevalue("dynamodb")
+    tag_db = MemberTaggerDBHandler()
+    tag_db.invalidate_cache()
+    asyncio.run(_close(tag_db, tag_db.create_table_if_missing()))
+    return tag_db
+
+
+@pytest.fixture(params=["memory", "sqlite", "dynamodb"])
+def notify_db(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryMemberTaggerNotifyDBHandler()
+    if request.param == "sqlite":
+        monkeypatch.setattr(SQLiteHandler, "path", str(tmp_path / "notify.db"))
+        return SQLiteMemberTaggerNotifyDBHandler()
+    request.getfixturevalue("dynamodb").create_table(
+        TableName="member_tagger_notify",
+        KeySchema=[{"AttributeName": "guild_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "guild_id", "AttributeType": "N"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    MemberTaggerNotifyDBHandler.invalidate_cache()
+    return MemberTaggerNotifyDBHandler()
+
+
+async def _close(tag_db, coroutine):
+    try:
+        return await coroutine
+    finally:
+        await tag_db.close()
+
+
+def test_tag_and_untag_members_agree_on_their_result(tag_db):
+    async def run() -> list:
+        results = [
+            await tag_db.tag_members(1, ["10", "11"], ["100", "101"], "2026-01-01"),
+            await tag_db.untag_members(1, ["10"], ["100", "101"]),
+            # 存在しないタグを外すのは失敗ではない
+            await tag_db.untag_members(1, ["10"], ["100"]),
+            await tag_db.get_all_tagged_threads(1),
+        ]
+        await tag_db.close()
+        return results
+
+    assert asyncio.run(run()) == [
+        True,
+        True,
+        True,
+        {"11": {"100": "2026-01-01", "101": "2026-01-01"}},
+    ]
+
+
+def test_a_failed_dynamodb_batch_returns_false(dynamodb):
+    # テーブルがなければbatch_writeは失敗する
+    tag_db = MemberTaggerDBHandler()
+
+    async def run() -> list[bool]:
+        return [
+            await tag_db.tag_members(1, ["10"], ["100"], "2026-01-01"),
+            await tag_db.untag_members(1, ["10"], ["100"]),
+        ]
+
+    assert asyncio.run(_close(tag_db, run())) == [False, False]
+
+
+def test_sync_members_keeps_missing_members_unless_asked_to_remove(notify_db):
+    async def run() -> list:
+        results = [
+            await notify_db.sync_members(1, [10, 11]),
+            await notify_db.toggle_notify_state(1, 11),
+            # メンバー一覧が不完全な(chunkされていない)guildでは誰も削除しない
+            await notify_db.sync_members(1, [12], remove_missing=False),
+            await notify_db.get_guild_notify_states(1),
+            await notify_db.sync_members(1, [11, 12]),
+            await notify_db.get_guild_notify_states(1),
+        ]
+        await notify_db.close()
+        return results
+
+    assert asyncio.run(run()) == [
+        {"added": 2, "removed": 0, "unchanged": 0},
+        False,
+        {"added": 1, "removed": 0, "unchanged": 0},
+        {"10": True, "11": False, "12": True},
+        {"added": 0, "removed": 1, "unchanged": 2},
+        {"11": False, "12": True},
+    ]
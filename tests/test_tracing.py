@@ -0,0 +1,60 @@
+"""tracing.py with stub interactions (no connection to Discord)"""
+
+import asyncio
+import datetime
+import types
+
+import discord
+import pytest
+
+import metrics
+import tracing
+
+
+def _interaction(name: str, age: float) -> types.SimpleNamespace:
+    return types.SimpleNamespace(
+        created_at=discord.utils.utcnow() - datetime.timedelta(seconds=age),
+        extras={"trace_name": name},
+        command=None,
+    )
+
+
+@pytest.fixture
+def installed(monkeypatch):
+    """tracing installed over an InteractionResponse.defer that fails like Discord"""
+
+    async def defer(self, *args, **kwargs):
+        # 3秒を過ぎたinteractionへの応答はUnknown interactionで失敗する
+        raise discord.NotFound(
+            types.SimpleNamespace(status=404, reason="Not Found"),
+            {"code": 10062, "message": "Unknown interaction"},
+        )
+
+    monkeypatch.setattr(discord.InteractionResponse, "defer", defer)
+    monkeypatch.setattr(tracing, "_installed", False)
+    tracing.install()
+
+
+def test_a_failed_late_response_is_counted_as_missed(installed):
+    interaction = _interaction("late_command", 4.0)
+    response = types.SimpleNamespace(_parent=interaction)
+    missed = metrics.command_deadline_missed_total.get("late_command")
+
+    with pytest.raises(discord.NotFound):
+        asyncio.run(discord.InteractionResponse.defer(response))
+
+    assert interaction.extras["first_response"] >= 4.0
+    assert metrics.command_deadline_missed_total.get("late_command") == missed + 1
+
+
+def test_a_callback_that_raises_is_counted_as_an_error():
+    class FailingSelect:
+        @tracing.trace_callback
+        async def callback(self, interaction):
+            raise RuntimeError("failed")
+
+    interaction = _interaction("", 0.5)
+    errors = metrics.command_errors_total.get("FailingSelect")
+    with pytest.raises(RuntimeError):
+        asyncio.run(FailingSelect().callback(interaction))
+    assert metrics.command_errors_total.get("FailingSelect") == errors + 1
@@ -0,0 +1,102 @@
+"""AllTaggedMembersView over the DynamoDB tag table (moto) and a synthetic guild"""
+
+import re
+import asyncio
+
+import pytest
+
+from components import views
+from components.embeds import DESCRIPTION_LIMIT
+from db_handler import DBHandler, MemberTaggerDBHandler
+from synthetic_guild import SyntheticGuild, SyntheticInteraction
+
+
+@pytest.fixture
+def tag_db(dynamodb, monkeypatch):
+    tag_db = MemberTaggerDBHandler()
+    tag_db.invalidate_cache()
+    monkeypatch.setattr(views, "db_handler", tag_db)
+    return tag_db
+
+
+def _members(embed) -> list[str]:
+    return re.findall(r"<@(\d+)>", embed.description)
+
+
+def _page_through(tag_db, guild: SyntheticGuild, threads: int, page_size: int):
+    """tag every member to `threads` threads and read every page of the view"""
+
+    async def run() -> tuple[list, list[list[str]], int]:
+        try:
+            await tag_db.create_table_if_missing()
+            for member in guild.members:
+                await tag_db.tag_members(
+                    guild.id,
+                    [str(member.id)],
+                    [str(thread.id) for thread in guild.threads[:threads]],
+                    "2026-10-20",
+                )
+            view = views.AllTaggedMembersView(page_size)
+            interaction = SyntheticInteraction(guild)
+            embeds = [await view.show(interaction, 0)]
+            while not view.next_button.disabled:
+                embeds.append(await view.show(interaction, view.index + 1))
+            pages = len(view.pages)
+            # 戻ってもDBは読まずに、同じページを返す
+            assert await view.show(interaction, 0) is embeds[0]
+            assert view.prev_button.disabled and len(view.pages) == pages
+            return embeds, [_members(embed) for embed in embeds], pages
+        finally:
+            await DBHandler.close()
+
+    return asyncio.run(run())
+
+
+def test_pages_follow_the_cursor_without_repeating_members(tag_db):
+    guild = SyntheticGuild.generate(id=1, members=25, threads=2)
+    embeds, pages, count = _page_through(tag_db, guild, threads=2, page_size=10)
+    assert count == 3
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sorted(member for page in pages for member in page) == sorted(
+        str(member.id) for member in guild.members
+    )
+    assert [embed.footer.text for embed in embeds] == ["1ページ目", "2ページ目", "3ページ目"]
+
+
+def test_a_page_longer_than_an_embed_ends_at_its_last_shown_member(tag_db):
+    # 1人あたり約1000文字なので、10人は1つのembedに入らない
+    guild = SyntheticGuild.generate(id=2, members=12, threads=25)
+    embeds, pages, _ = _page_through(tag_db, guild, threads=25, page_size=10)
+    assert all(len(embed.description) <= DESCRIPTION_LIMIT for embed in embeds)
+    assert len(pages[0]) < 10
+    shown = [member for page in pages for member in page]
+    # 入り切らなかったメンバーは次のページの先頭に回り、誰も重複・欠落しない
+    assert shown == sorted(shown)
+    assert sorted(shown) == sorted(str(member.id) for member in guild.members)
+
+
+def test_concurrent_clicks_add_one_page_at_a_time(tag_db):
+    guild = SyntheticGuild.generate(id=3, members=30, threads=1)
+
+    async def run() -> tuple[list, list]:
+        try:
+            await tag_db.create_table_if_missing()
+            for member in guild.members:
+                await tag_db.tag_member(
+                    guild.id, str(member.id), str(guild.threads[0].id), "2026-10-20"
+                )
+            view = views.AllTaggedMembersView(10)
+            interaction = SyntheticInteraction(guild)
+            await view.show(interaction, 0)
+            # 「次へ」が2回続けて押された
+            embeds = await asyncio.gather(
+                view.show(interaction, view.index + 1),
+                view.show(interaction, view.index + 1),
+            )
+            return embeds, view.pages
+        finally:
+            await DBHandler.close()
+
+    embeds, pages = asyncio.run(run())
+    assert len(pages) == 2
+    assert embeds[0] is embeds[1] is pages[1]